@@ -4,98 +4,704 @@ Receive file(s) and/or folder(s) across the network
 https://wingxel.github.io/website/index.html
 """
 
-import json
+import asyncio
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from socket import socket, AF_INET, SOCK_STREAM
 from threading import Thread
 
+import compress
+import delta
+import integrity
+import metrics
+import protocol
+import ratelimit
 import receiver_utils
+import relay
+import sparse
+import tuning
 import util
 
 
-def communicate(connection_socket: socket, client_address: tuple) -> None:
+def prepare_folder(head: dict) -> None:
     """
-    Worker function handles incoming content
-    :param connection_socket: Connection socket with the sending end
+    Create the sub-folder(s) a described file should be put in
+    :param head: Decoded file description
+    :return:
+    """
+    # Determine if the file currently being received should be put
+    # in sub-folder(s), each folder is only created once
+    if len(head["name"]) > 1:
+        receiver_utils.get_destination_index().makedirs(receiver_utils.save_path(head["name"][:-1]))
+
+
+def held_bytes(head: dict):
+    """
+    Apply the skip and resume rules to a described file
+    :param head: Decoded file description
+    :return: None if a file with that name already exists, otherwise the
+             number of bytes already held in its partial file
+    """
+    index = receiver_utils.get_destination_index()
+    if index.exists(receiver_utils.save_path(head["name"])):
+        return None
+    if not index.exists(receiver_utils.part_path(head["name"])):
+        return 0
+    # Only a partial file created for this very size is resumed, any other is another version
+    if receiver_utils.marked_size(receiver_utils.save_path(head["name"])) != head["size"]:
+        return 0
+    try:
+        held = os.path.getsize(receiver_utils.part_path(head["name"]))
+    except OSError:
+        return 0
+    return held if held <= head["size"] else 0
+
+
+def destination_offset(head: dict):
+    """
+    Prepare the destination folder and apply the skip and resume rules
+    :param head: Decoded file description
+    :return: See held_bytes
+    """
+    prepare_folder(head)
+    return held_bytes(head)
+
+
+def resume_digest(head: dict, offset: int) -> bytes:
+    """
+    Digest of the bytes already held, if senders should check them
+    :param head: Decoded file description
+    :param offset: Number of bytes held
+    :return: Empty if RESUME_CHECKSUM is off
+    """
+    if not receiver_utils.RESUME_CHECKSUM:
+        return b""
+    return util.prefix_digest(receiver_utils.part_path(head["name"]), offset)
+
+
+def wanted_files(entries: list) -> tuple:
+    """
+    Apply the skip and resume rules to a whole manifest
+    :param entries: Decoded file descriptions
+    :return: (one boolean per entry, True if the file should be sent,
+              {index: (offset, digest)} for the partially held files)
+    """
+    wanted, resumes = [], {}
+    for index, head in enumerate(entries):
+        offset = held_bytes(head)
+        wanted.append(offset is not None)
+        if offset:
+            resumes[index] = (offset, resume_digest(head, offset))
+    return wanted, resumes
+
+
+def write_bundle(bundled: list, bundle: memoryview) -> None:
+    """
+    Write out the files packed in a bundle
+    :param bundled: File descriptions of the bundled files
+    :param bundle: Bundle frame payload
+    :return:
+    """
+    # Create each sub-folder once for the whole bundle
+    folders = {}
+    for head in bundled:
+        folders.setdefault(tuple(head["name"][:-1]), head)
+    for head in folders.values():
+        prepare_folder(head)
+    position = protocol.BUNDLE_COUNT.size
+    for head in bundled:
+        # Partial name first, a crash never leaves a truncated file under the real name
+        fd = receiver_utils.create_part(receiver_utils.save_path(head["name"]), head["size"], os.O_TRUNC)
+        try:
+            receiver_utils.write_fully(fd, bundle[position:position + head["size"]])
+        finally:
+            os.close(fd)
+        receiver_utils.land(receiver_utils.save_path(head["name"]))
+        position += head["size"]
+
+
+def open_destination(head: dict, offset: int, reserve: bool = True) -> int:
+    """
+    Open the partial destination file, keep what is resumed and preallocate the rest
+    :param head: Decoded file description
+    :param offset: Number of bytes kept
+    :param reserve: Preallocate the rest, not for sparse content whose holes must stay holes
+    :return: File descriptor positioned at offset
+    """
+    fd = receiver_utils.create_part(receiver_utils.save_path(head["name"]), head["size"])
+    os.ftruncate(fd, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    if reserve:
+        receiver_utils.preallocate(fd, head["size"], keep_size=True, offset=offset)
+    return fd
+
+
+def write_block(codec: str, payload: bytes, write, remaining: int) -> int:
+    """
+    Decompress a block frame and write its content
+    :param codec: Codec name
+    :param payload: Block frame payload
+    :param write: Called with the block content
+    :param remaining: Number of content bytes still expected
+    :return: Number of content bytes written
+    """
+    data = compress.decompress_block(codec, payload)
+    if len(data) > remaining:
+        raise protocol.ProtocolError(f"Block of {len(data)} bytes overruns the {remaining} bytes left")
+    write(data)
+    return len(data)
+
+
+async def receive_blocks(connection, codec: str, write, length: int) -> None:
+    """
+    Receive compressed content as block frames
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param codec: Codec name
+    :param write: Called with each block content
+    :param length: Uncompressed content length
+    :return:
+    """
+    remaining = length
+    while remaining > 0:
+        _, block_length = protocol.check_frame(await connection.recv_header(), protocol.BLOCK)
+        if block_length > compress.MAX_BLOCK_SIZE + compress.BLOCK_PREFIX.size:
+            raise protocol.ProtocolError(f"Block frame too large ({block_length} bytes)")
+        payload = await connection.recv_exact(block_length)
+        remaining -= await connection.run_disk(write_block, codec, payload, write, remaining)
+
+
+def write_hashed(hasher, write, data: memoryview) -> None:
+    """
+    Hash a chunk on its way to the disk (runs on the writer thread)
+    :param hasher: Running digest
+    :param write: Called with the chunk once hashed
+    :param data: Chunk content
+    :return:
+    """
+    hasher.update(data)
+    write(data)
+
+
+async def recv_verify(connection, length: int) -> str:
+    """
+    Receive the hash a content frame is announced with
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param length: Verify frame payload length
+    :return: Hash name
+    """
+    names = protocol.decode_names(await recv_control(connection, length))
+    if len(names) != 1 or names[0] not in integrity.HASHES:
+        raise protocol.ProtocolError(f"Content verified with unsupported hash {names}")
+    return names[0]
+
+
+async def digest_matches(connection, digest: bytes) -> bool:
+    """
+    Compare the digest trailing some content with the one computed here
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param digest: Digest of what was written
+    :return:
+    """
+    _, length = protocol.check_frame(await connection.recv_header(), protocol.DIGEST)
+    return bytes(await recv_control(connection, length)) == digest
+
+
+async def receive_content(connection, head: dict, frame: tuple, offset: int = 0, verify: str = None) -> int:
+    """
+    Receive the content of a described file sent as a data frame, as
+    compressed blocks or as the data extents of a sparse file
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param head: Decoded file description
+    :param frame: (message type, payload length) of the data, compressed or sparse frame
+    :param offset: Number of bytes already held
+    :param verify: Hash the content is announced with, a digest frame follows it; None if not
+    :return: Number of content bytes received
+    """
+    message_type, length = frame
+    codec, extents = None, None
+    if message_type == protocol.COMPRESSED:
+        length, codec = protocol.decode_compressed(await recv_control(connection, length))
+        if codec not in compress.CODECS:
+            raise protocol.ProtocolError(f"Content compressed with unsupported codec {codec}")
+    elif message_type == protocol.SPARSE:
+        length, extents = protocol.decode_sparse(await recv_control(connection, length))
+    return await receive_payload(connection, head, length, offset, codec, verify, extents)
+
+
+async def receive_payload(connection, head: dict, length: int, offset: int = 0, codec: str = None,
+                          verify: str = None, extents: list = None) -> int:
+    """
+    Receive the content of a described file and save it, the data frame
+    either resumes at offset or starts over with the whole file
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param head: Decoded file description
+    :param length: Content length
+    :param offset: Number of bytes already held
+    :param codec: Codec of the block frames carrying the content, None for a data frame
+    :param verify: Hash the content is announced with, a digest frame follows it; None if not
+    :param extents: Data extents of sparse content, a data frame carries only them; None if not sparse
+    :return: Number of content bytes received
+    """
+    if length == head["size"]:
+        offset = 0
+    elif length != head["size"] - offset:
+        raise protocol.ProtocolError(f"Expected {head['size'] - offset} bytes, got a {length} byte data frame")
+    streamed = length
+    if extents is not None:
+        streamed = sparse.check_extents(extents, head["size"] - length, head["size"])
+        _, data_length = protocol.check_frame(await connection.recv_header(), protocol.DATA)
+        if data_length != streamed:
+            raise protocol.ProtocolError(f"Expected {streamed} bytes of data extents, got {data_length}")
+    # Open the destination file for writing binary, its blocks reserved up front unless it is sparse
+    fd = await connection.run_disk(open_destination, head, offset, extents is None)
+    write, hasher = partial(receiver_utils.write_fully, fd), None
+    if extents is not None:
+        # Each extent lands at its offset, what lies between is never written and stays a hole
+        write = sparse.ExtentWriter(fd, extents)
+    if verify is not None:
+        # What is written is hashed on the way, the file is never read back
+        hasher = integrity.new_hash(verify)
+        write = partial(write_hashed, hasher, write)
+    try:
+        # Receive until file full size is reached, saving chunks as they fill
+        if codec is None:
+            await connection.receive_to(write, streamed)
+        else:
+            await receive_blocks(connection, codec, write, length)
+        if extents is not None:
+            # Trailing hole
+            await connection.run_disk(os.ftruncate, fd, head["size"])
+            connection.metrics.add("hole_bytes", length - streamed)
+    finally:
+        await connection.run_disk(os.close, fd)
+    if hasher is not None and not await digest_matches(connection, hasher.digest()):
+        # A copy that does not match is not kept, the sender sends it again
+        await connection.run_disk(receiver_utils.remove_part, receiver_utils.save_path(head["name"]))
+        raise integrity.DigestMismatch(os.sep.join(head["name"]))
+    # Complete, the partial file takes its real name
+    await connection.run_disk(receiver_utils.land, receiver_utils.save_path(head["name"]))
+    connection.metrics.add("files_received")
+    connection.metrics.add("bytes_received", length)
+    return length
+
+
+async def receive_bundle(connection, heads: list, index: int, length: int, verify: str = None) -> tuple:
+    """
+    Receive a bundle of small files and write them out in bulk
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param heads: Wanted file descriptions in manifest order
+    :param index: Position in heads of the first bundled file
+    :param length: Bundle frame payload length
+    :param verify: Hash the bundle is announced with, a digest frame follows it; None if not
+    :return: (number of files in the bundle, False if they did not match the digest and were dropped)
+    """
+    if length > protocol.MAX_BUNDLE_LENGTH or length < protocol.BUNDLE_COUNT.size:
+        raise protocol.ProtocolError(f"Invalid bundle frame length {length}")
+    bundle = memoryview(await connection.recv_exact(length))
+    count, = protocol.BUNDLE_COUNT.unpack_from(bundle)
+    bundled = heads[index:index + count]
+    if len(bundled) != count or sum(head["size"] for head in bundled) != length - protocol.BUNDLE_COUNT.size:
+        raise protocol.ProtocolError(f"Bundle of {count} files does not match the manifest")
+    if verify is not None and not await digest_matches(
+            connection, await connection.run_disk(integrity.digest_of, verify, bundle)):
+        # None of the bundled files is written, the sender sends them again
+        return count, False
+    await connection.run_disk(write_bundle, bundled, bundle)
+    connection.metrics.add("files_received", count)
+    connection.metrics.add("bytes_received", length - protocol.BUNDLE_COUNT.size)
+    return count, True
+
+
+def finish_delta(head: dict, old_size: int, changed: bool) -> bool:
+    """
+    Put the file rebuilt from a delta in place of the receiver copy
+    :param head: Decoded file description
+    :param old_size: Size of the receiver copy
+    :param changed: If the sender sent any delta operation
+    :return: False if the receiver copy was already up to date
+    """
+    if not changed and head["size"] == old_size:
+        receiver_utils.remove_part(receiver_utils.save_path(head["name"]))
+        return False
+    rebuilt = os.path.getsize(receiver_utils.part_path(head["name"]))
+    if rebuilt != head["size"]:
+        receiver_utils.remove_part(receiver_utils.save_path(head["name"]))
+        raise protocol.ProtocolError(f"Delta rebuilt {rebuilt} bytes, expected {head['size']}")
+    receiver_utils.land(receiver_utils.save_path(head["name"]))
+    return True
+
+
+async def receive_delta(connection, head: dict) -> None:
+    """
+    Update a file the receiver already has: send its block signatures, then
+    rebuild the new version from copied blocks and literal data
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param head: Decoded file description
+    :return:
+    """
+    signature = await connection.run_disk(delta.file_signature, receiver_utils.save_path(head["name"]))
+    await connection.send_frame(protocol.SIGNATURE, signature)
+    old_size, block = delta.SIGNATURE_HEADER.unpack_from(signature)
+    # The new version is built next to the old one, the old one stays readable until the end
+    old_fd = await connection.run_disk(os.open, receiver_utils.save_path(head["name"]), os.O_RDONLY)
+    changed = False
+    try:
+        new_fd = await connection.run_disk(open_destination, head, 0)
+        try:
+            while True:
+                message_type, length = protocol.check_frame(
+                    await connection.recv_header(), protocol.DELTA_COPY, protocol.DELTA_DATA, protocol.DELTA_END
+                )
+                if message_type == protocol.DELTA_END:
+                    break
+                changed = True
+                if message_type == protocol.DELTA_COPY:
+                    if length != delta.COPY.size:
+                        raise protocol.ProtocolError(f"Invalid delta copy frame length {length}")
+                    first, count = delta.COPY.unpack(await connection.recv_exact(length))
+                    await connection.run_disk(delta.copy_blocks, old_fd, new_fd, (old_size, block), first, count)
+                else:
+                    await connection.receive_to(partial(receiver_utils.write_fully, new_fd), length)
+                    connection.metrics.add("bytes_received", length)
+        finally:
+            await connection.run_disk(os.close, new_fd)
+    finally:
+        await connection.run_disk(os.close, old_fd)
+    if await connection.run_disk(finish_delta, head, old_size, changed):
+        connection.metrics.add("files_delta")
+        print(f"Updated {os.sep.join(head['name'])} from a delta : {datetime.now()}")
+    # Tell sender to send next file
+    await connection.send_frame(protocol.NEXT)
+
+
+async def recv_content_header(connection, *expected: int) -> tuple:
+    """
+    Receive the header of the next content frame and the hash it is announced with
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param expected: Accepted content frame types
+    :return: ((message type, payload length), hash name or None)
+    """
+    frame, verify = protocol.check_frame(await connection.recv_header(), protocol.VERIFY, *expected), None
+    if frame[0] == protocol.VERIFY:
+        verify = await recv_verify(connection, frame[1])
+        frame = protocol.check_frame(await connection.recv_header(), *expected)
+    return frame, verify
+
+
+def report_mismatch(connection, what: str) -> None:
+    """
+    Report content that did not match its digest
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param what: File name or description of the content
+    :return:
+    """
+    print(f"Digest mismatch, asking for {what} again : {datetime.now()}")
+    util.log_error(f"Digest mismatch : {what}", "warning")
+    connection.metrics.add("files_retried")
+
+
+async def receive_file(connection, head: dict, sync: bool = False) -> None:
+    """
+    Receive a single described file
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param head: Decoded file description {"name": [...], "size": int, "size_d": int}
+    :param sync: The sender can send a delta of a file that already exists
+    :return:
+    """
+    started = time.perf_counter()
+    offset = await connection.run_disk(destination_offset, head)
+    # Check if the file with that name already exists
+    if offset is None and sync:
+        # Only the changed blocks are sent
+        await receive_delta(connection, head)
+        connection.metrics.file_done(head["name"], 0, time.perf_counter() - started, 0.0, "delta")
+        return
+    if offset is None:
+        # Tell the sender to skip that file because a file with that name already exists
+        await connection.send_frame(protocol.NOT)
+        connection.metrics.add("files_skipped")
+        return
+    if offset:
+        # Tell the sender how much of the file already landed
+        digest = await connection.run_disk(resume_digest, head, offset)
+        await connection.send_frame(protocol.RESUME, protocol.encode_resume(offset, digest))
+        connection.metrics.add("files_resumed")
+    else:
+        # If not tell the sender to go ahead and start sending
+        await connection.send_frame(protocol.OK)
+    frame, verify = await recv_content_header(connection, protocol.DATA, protocol.COMPRESSED, protocol.SPARSE)
+    content_started = time.perf_counter()
+    try:
+        received = await receive_content(connection, head, frame, offset, verify)
+    except integrity.DigestMismatch:
+        # Ask for the file again
+        report_mismatch(connection, os.sep.join(head["name"]))
+        await connection.send_frame(protocol.RETRY)
+        return
+    payload = time.perf_counter() - content_started
+    # Tell sender to send next file
+    await connection.send_frame(protocol.NEXT)
+    how = protocol.FRAME_NAMES[frame[0]]
+    connection.metrics.file_done(head["name"], received, content_started - started, payload, how)
+
+
+async def receive_batch(connection, entries: list) -> None:
+    """
+    Receive a whole manifest: answer once with the wanted files then receive
+    them back-to-back (single or bundled) without per-file acknowledgements
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param entries: Decoded file descriptions from the first manifest frame
+    :return:
+    """
+    started = time.perf_counter()
+    # Collect the rest of the manifest
+    while True:
+        message_type, length = protocol.check_frame(
+            await connection.recv_header(), protocol.MANIFEST, protocol.MANIFEST_END
+        )
+        if message_type == protocol.MANIFEST_END:
+            break
+        entries.extend(protocol.decode_entries(await recv_control(connection, length)))
+    # Same skip and resume rules as single files: existing files are not wanted
+    wanted, resumes = await connection.run_disk(wanted_files, entries)
+    await connection.send_frame(protocol.WANT, protocol.encode_want(wanted, resumes))
+    connection.metrics.add("handshake_seconds", time.perf_counter() - started)
+    connection.metrics.add("files_skipped", len(entries) - sum(wanted))
+    connection.metrics.add("files_resumed", len(resumes))
+    print(f"Batch => {sum(wanted)} of {len(entries)} files wanted ({len(resumes)} resumed) : {datetime.now()}")
+    heads = [head for head, want in zip(entries, wanted) if want]
+    offsets = [resumes.get(index, (0, b""))[0] for index, want in enumerate(wanted) if want]
+    # Manifest position of each wanted file, and the files to ask for again
+    positions = [index for index, want in enumerate(wanted) if want]
+    retry = [False] * len(entries)
+    index = 0
+    # Large files come as data frames, runs of small files as bundle frames
+    while index < len(heads):
+        frame, verify = await recv_content_header(
+            connection, protocol.DATA, protocol.COMPRESSED, protocol.SPARSE, protocol.BUNDLE
+        )
+        content_started = time.perf_counter()
+        if frame[0] == protocol.BUNDLE:
+            count, matched = await receive_bundle(connection, heads, index, frame[1], verify)
+            connection.metrics.add("payload_seconds", time.perf_counter() - content_started)
+            if not matched:
+                for position in range(index, index + count):
+                    report_mismatch(connection, os.sep.join(heads[position]["name"]))
+                    retry[positions[position]] = True
+            index += count
+        else:
+            await connection.run_disk(prepare_folder, heads[index])
+            try:
+                received = await receive_content(connection, heads[index], frame, offsets[index], verify)
+            except integrity.DigestMismatch:
+                report_mismatch(connection, os.sep.join(heads[index]["name"]))
+                retry[positions[index]] = True
+            else:
+                how = protocol.FRAME_NAMES[frame[0]]
+                payload = time.perf_counter() - content_started
+                connection.metrics.file_done(heads[index]["name"], received, 0.0, payload, how)
+            index += 1
+    # Tell sender the whole batch landed, or which files to send again
+    if any(retry):
+        await connection.send_frame(protocol.RETRY, protocol.encode_bitmap(retry))
+    else:
+        await connection.send_frame(protocol.NEXT)
+
+
+def register_stripe(token: bytes, head: dict) -> bool:
+    """
+    Create the pre-sized destination of a striped file
+    :param token: Striped file token
+    :param head: Decoded file description
+    :return: False if a file with that name already exists
+    """
+    if destination_offset(head) is None:
+        return False
+    striped = receiver_utils.StripedFile(receiver_utils.save_path(head["name"]), head["size"])
+    with receiver_utils.striped_files_lock:
+        receiver_utils.striped_files[token] = striped
+    return True
+
+
+async def receive_stripe(connection, payload: bytes) -> None:
+    """
+    Register a file whose content will arrive as ranges over several connections
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param payload: Stripe frame payload (token then file description)
+    :return:
+    """
+    token, head = bytes(payload[:protocol.TOKEN_SIZE]), protocol.decode_entry(payload[protocol.TOKEN_SIZE:])
+    # Same skip rule as single files
+    if await connection.run_disk(register_stripe, token, head):
+        await connection.send_frame(protocol.OK)
+    else:
+        await connection.send_frame(protocol.NOT)
+
+
+async def receive_range(connection, length: int, verify: str = None) -> None:
+    """
+    Write one range of a striped file at its offset
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param length: Range frame payload length
+    :param verify: Hash the range is announced with, a digest frame follows it; None if not
+    :return:
+    """
+    if length < protocol.RANGE_PREFIX.size:
+        raise protocol.ProtocolError(f"Invalid range frame length {length}")
+    token, offset = protocol.RANGE_PREFIX.unpack(await connection.recv_exact(protocol.RANGE_PREFIX.size))
+    with receiver_utils.striped_files_lock:
+        striped = receiver_utils.striped_files.get(token)
+    if striped is None:
+        raise protocol.ProtocolError("Range for an unknown striped file")
+
+    def write_range(data: memoryview) -> None:
+        """
+        Write the next chunk of the range at its position
+        :param data: Chunk content
+        :return:
+        """
+        nonlocal offset
+        striped.write(offset, data)
+        offset += len(data)
+
+    write, hasher = write_range, None
+    if verify is not None:
+        hasher = integrity.new_hash(verify)
+        write = partial(write_hashed, hasher, write_range)
+    try:
+        await connection.receive_to(write, length - protocol.RANGE_PREFIX.size)
+        connection.metrics.add("bytes_received", length - protocol.RANGE_PREFIX.size)
+        if hasher is not None and not await digest_matches(connection, hasher.digest()):
+            # The whole striped file fails, the sender sends it again
+            report_mismatch(connection, "a striped file")
+            striped.fail()
+    except Exception:
+        striped.fail()
+        raise
+
+
+def close_stripe(token: bytes, striped: receiver_utils.StripedFile, complete: bool) -> None:
+    """
+    Forget a striped file and close it
+    :param token: Striped file token
+    :param striped: The striped file
+    :param complete: If every range landed
+    :return:
+    """
+    with receiver_utils.striped_files_lock:
+        del receiver_utils.striped_files[token]
+    striped.close(complete)
+
+
+async def finish_stripe(connection, payload: bytes) -> None:
+    """
+    Report completion of a striped file once every range has landed
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param payload: Stripe end frame payload (token)
+    :return:
+    """
+    token = bytes(payload)
+    with receiver_utils.striped_files_lock:
+        striped = receiver_utils.striped_files.get(token)
+    if striped is None:
+        raise protocol.ProtocolError("End of an unknown striped file")
+    # Ranges may still be in flight on the other connections
+    complete = await connection.wait(striped.wait)
+    await connection.run_disk(close_stripe, token, striped, complete)
+    if complete:
+        connection.metrics.add("files_received")
+    await connection.send_frame(protocol.NEXT if complete else protocol.NOT)
+
+
+async def recv_control(connection, length: int) -> bytes:
+    """
+    Receive the payload of a control frame whose header was already read
+    :param connection: Connection with the sending end (see receiver_utils)
+    :param length: Payload length from the header
+    :return:
+    """
+    if length > protocol.MAX_CONTROL_LENGTH:
+        raise protocol.ProtocolError(f"Control frame too large ({length} bytes)")
+    return await connection.recv_exact(length)
+
+
+async def serve(connection, client_address) -> None:
+    """
+    Handle every frame a sender sends over one connection
+    :param connection: Connection with the sending end (see receiver_utils)
     :param client_address: Sender IP address
     :return:
     """
     print(f"Client Sending Files => {client_address} : {datetime.now()}")
+    connection.metrics = metrics.start_session("receiver", client_address)
+    # Rate limits are shared by every connection from the same address
+    connection.client = client_address[0]
     try:
         while util.receiving:
-            # Receive each file description (metadata)
-            head = json.loads(connection_socket.recv(1024).decode())
-            # Disassemble some metadata to help track overall progress
-            receive_progress_tracker, directory_size = 0, head["size_d"]
-            # Keep receiving data until the expected directory size is reached
-            while receive_progress_tracker != directory_size:
-                # Exit if not receiving
-                if not util.receiving:
-                    break
-                # Determine if the file currently being received should be put
-                # in sub-folder(s)
-                if len(head["name"]) > 1:
-                    p = os.sep.join([
-                        receiver_utils.DEFAULT_SAVE_FOLDER,
-                        os.sep.join(head["name"][0:len(head["name"]) - 1:1])
-                    ])
-                    # Create the sub-folder(s) if they do not exist
-                    try:
-                        os.makedirs(p)
-                    except FileExistsError as error:
-                        util.log_error(f"An error occurred : {str(error)}")
-                    except Exception as error:
-                        util.log_error(f"An error occurred : {str(error)}")
-                # Disassemble some metadata to help track individual file progress
-                full_file_size, received_size = head["size"], 0
-                # Create absolute destination file path
-                save_file = os.sep.join([
-                    receiver_utils.DEFAULT_SAVE_FOLDER,
-                    os.sep.join(head["name"])
-                ])
-                # Check if the file with that name already exists
-                if not os.path.exists(save_file):
-                    # If not tell the sender to go ahead and start sending
-                    connection_socket.send(b"ok")
-                    # Open the destination file for writing binary
-                    with open(save_file, "wb") as the_file:
-                        # Receive first chunk
-                        data = connection_socket.recv(1024)
-                        # Keep receiving until file full size is reached
-                        while received_size != full_file_size:
-                            # Increment file size tracker
-                            received_size += len(data)
-                            # Increment overall progress
-                            receive_progress_tracker += len(data)
-                            # Save the received chunk into the opened file
-                            the_file.write(data)
-                            # If the expected file size is reached or the receiver has stopped,
-                            # stop receiving and writing
-                            if received_size == full_file_size or not util.receiving:
-                                break
-                            # Receive subsequent chunks for current file
-                            data = connection_socket.recv(1024)
-                    # Tell sender to send next file
-                    connection_socket.send(b"next")
-                    """if receive_progress_tracker < directory_size:
-                        connection_socket.send(b"next")"""
-                else:
-                    # Increment the received folder size progress
-                    receive_progress_tracker += full_file_size
-                    # Tell the sender to skip that file because a file with that name already exists
-                    connection_socket.send(b"not")
-                if receive_progress_tracker < directory_size:
-                    # Get metadata for the next file
-                    head = json.loads(connection_socket.recv(1024).decode())
+            # Receive each frame header, None when the sender is done
+            frame = await connection.recv_header()
+            if frame is None:
+                break
+            message_type, length = frame
+            if message_type == protocol.HEAD:
+                # File description (metadata) followed by its content
+                head = protocol.decode_entry(await recv_control(connection, length))
+                await receive_file(connection, head)
+            elif message_type == protocol.SYNC:
+                # Same as a file description, existing files are updated with a delta
+                head = protocol.decode_entry(await recv_control(connection, length))
+                await receive_file(connection, head, sync=True)
+            elif message_type == protocol.HELLO:
+                # Answer with the offered codecs this receiver supports
+                offered = protocol.decode_names(await recv_control(connection, length))
+                await connection.send_frame(protocol.HELLO, protocol.encode_names(compress.accept_codecs(offered)))
+            elif message_type == protocol.HASHES:
+                # Answer with the offered content hashes this receiver supports
+                offered = protocol.decode_names(await recv_control(connection, length))
+                await connection.send_frame(protocol.HASHES, protocol.encode_names(integrity.accept_hashes(offered)))
+            elif message_type == protocol.VERIFY:
+                # Range of a striped file followed by its digest
+                verify = await recv_verify(connection, length)
+                _, length = protocol.check_frame(await connection.recv_header(), protocol.RANGE)
+                await receive_range(connection, length, verify)
+            elif message_type == protocol.MANIFEST:
+                # Manifest-first batch of files
+                entries = protocol.decode_entries(await recv_control(connection, length))
+                await receive_batch(connection, entries)
+            elif message_type == protocol.STRIPE:
+                # Large file split into ranges sent over several connections
+                await receive_stripe(connection, await recv_control(connection, length))
+            elif message_type == protocol.RANGE:
+                await receive_range(connection, length)
+            elif message_type == protocol.STRIPE_END:
+                await finish_stripe(connection, await recv_control(connection, length))
+            else:
+                raise protocol.ProtocolError(
+                    f"Unexpected {protocol.FRAME_NAMES.get(message_type, message_type)} frame"
+                )
     except Exception as error_value:
         util.log_error(str(error_value))
     finally:
         # Cleanup
         print(f"Client Done => {client_address} : {datetime.now()}")
         print("Closing Connection...")
-        connection_socket.close()
+        metrics.end_session(connection.metrics)
+        await connection.close()
+
+
+def communicate(connection_socket: socket, client_address: tuple) -> None:
+    """
+    Worker function handles incoming content
+    :param connection_socket: Connection socket with the sending end
+    :param client_address: Sender IP address
+    :return:
+    """
+    connection = receiver_utils.BlockingConnection(connection_socket, receiver_utils.get_buffer_pool())
+    receiver_utils.run_blocking(serve(connection, client_address))
 
 
 class Receiver:
@@ -106,6 +712,7 @@ class Receiver:
         """
         self.__port_address = port
         self.server_socket = socket(AF_INET, SOCK_STREAM)
+        tuning.tune_listener(self.server_socket)
 
     def start(self) -> None:
         """
@@ -125,13 +732,14 @@ class Receiver:
         :return:
         """
         try:
-            self.server_socket.listen(10)
+            self.server_socket.listen(receiver_utils.LISTEN_BACKLOG)
             print(f"Files will be saved at: {receiver_utils.DEFAULT_SAVE_FOLDER}")
             print(f"Server started at port : {self.__port_address} : (Press ctrl+c to exit) Waiting...")
-            util.log_error(f"Server started at port : {self.__port_address}")
+            util.log_info(f"Server started at port : {self.__port_address}")
             while True:
                 try:
                     connection_socket, client_address = self.server_socket.accept()
+                    tuning.tune_connection(connection_socket, buffers=False)
                     print(f"Client Connected => {client_address} : {datetime.now()}")
                     # Each sender client is handled by a different thread
                     t = Thread(target=communicate, args=(connection_socket, client_address))
@@ -154,6 +762,67 @@ class Receiver:
             util.log_error(f"An error occurred (rc 2) : {str(error)}")
 
 
+class AsyncReceiver:
+    def __init__(self, port: int) -> None:
+        """
+        Init event-loop receive server, every session shares one thread and
+        blocking disk work goes to a bounded executor
+        :param port: Receiver process port number
+        """
+        self.__port_address = port
+
+    def start(self) -> None:
+        """
+        Start receive server
+        :return:
+        """
+        try:
+            asyncio.run(self.__work())
+        except KeyboardInterrupt:
+            # Stopped receiving
+            util.receiving = False
+            print(f"{datetime.now()} : Server stopped")
+        except Exception as error:
+            print(f"An error occurred : {str(error)}")
+            util.log_error(f"An error occurred (rc 3) : {str(error)}")
+
+    async def __work(self) -> None:
+        """
+        Receive incoming items
+        :return:
+        """
+        disk_executor = ThreadPoolExecutor(max_workers=receiver_utils.DISK_THREADS, thread_name_prefix="disk")
+
+        async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            """
+            Session for each accepted sender
+            :param reader: Stream reader of the connection
+            :param writer: Stream writer of the connection
+            :return:
+            """
+            client_address = writer.get_extra_info("peername")
+            print(f"Client Connected => {client_address} : {datetime.now()}")
+            tuning.tune_connection(writer.get_extra_info("socket"), buffers=False)
+            connection = receiver_utils.StreamConnection(reader, writer, disk_executor)
+            await serve(connection, client_address)
+
+        try:
+            # Listening socket tuned before bind, accepted connections inherit its buffers
+            server_socket = socket(AF_INET, SOCK_STREAM)
+            tuning.tune_listener(server_socket)
+            server_socket.bind(("", self.__port_address))
+            server = await asyncio.start_server(
+                accept, sock=server_socket, backlog=receiver_utils.LISTEN_BACKLOG, limit=receiver_utils.BUFFER_SIZE
+            )
+            print(f"Files will be saved at: {receiver_utils.DEFAULT_SAVE_FOLDER}")
+            print(f"Server started at port : {self.__port_address} (event loop) : (Press ctrl+c to exit) Waiting...")
+            util.log_info(f"Server started at port : {self.__port_address} (event loop)")
+            async with server:
+                await server.serve_forever()
+        finally:
+            disk_executor.shutdown(wait=False)
+
+
 if __name__ == "__main__":
     # Prepare the log file
     if os.path.exists(util.LOG_FILE):
@@ -166,5 +835,35 @@ if __name__ == "__main__":
     arguments = receiver_utils.get_receiver_args()
     # Set where to save received files
     receiver_utils.DEFAULT_SAVE_FOLDER = arguments["folder"]
-    receiver = Receiver(arguments["port"])
-    receiver.start()
+    receiver_utils.LISTEN_BACKLOG = arguments["backlog"]
+    receiver_utils.DISK_THREADS = arguments["disk_threads"]
+    receiver_utils.BUFFER_SIZE = arguments["buffer_size"]
+    receiver_utils.BUFFER_MEMORY = arguments["buffer_memory"]
+    receiver_utils.RESUME_CHECKSUM = arguments["resume_checksum"]
+    util.LOG_LEVEL = arguments["log_level"]
+    tuning.SOCKET_BUFFER = arguments["socket_buffer"]
+    tuning.NOTSENT_LOWAT = arguments["notsent_lowat"]
+    # Rate limits and disk turns, the limits file overrides them and can change them later
+    receiver_utils.limits.update({key: arguments[key] for key in ("rate", "client_rate", "disk_rate", "disk_slots")})
+    if arguments["limits"]:
+        ratelimit.watch_limits(receiver_utils.limits, arguments["limits"])
+    # Transfer metrics: periodic JSON lines and/or a Prometheus endpoint
+    stats_writer = None
+    if arguments["stats"]:
+        stats_writer = metrics.StatsWriter(arguments["stats"], arguments["stats_interval"])
+    if arguments["metrics_port"]:
+        metrics.serve_metrics(arguments["metrics_port"])
+    if arguments["relay"]:
+        receiver_utils.relay = relay.Relay(*arguments["relay"], arguments["relay_verify"])
+    if arguments["event_loop"]:
+        receiver = AsyncReceiver(arguments["port"])
+    else:
+        receiver = Receiver(arguments["port"])
+    try:
+        receiver.start()
+    finally:
+        # Files that already landed are still forwarded
+        if receiver_utils.relay is not None:
+            receiver_utils.relay.close()
+        if stats_writer is not None:
+            stats_writer.close()
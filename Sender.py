@@ -4,14 +4,34 @@ Send file(s) and/or folder(s) across the network
 https://wingxel.github.io/website/index.html
 """
 
-import json
 import os
+import time
 from datetime import datetime
+from functools import partial
+from queue import Queue, Empty
 from socket import socket, AF_INET, SOCK_STREAM
 from threading import Thread
 
+import compress
+import delta
+import fanout
+import integrity
+import metrics
+import protocol
+import ratelimit
+import scanner
+import scheduler
+import send_engine
+import sparse
+import sync_index
+import tuning
 import util
-from sender_utils import get_args
+from sender_utils import get_args, DEFAULT_STRIPE_SIZE
+
+# Number of file descriptions per manifest frame
+MANIFEST_CHUNK = 1024
+# Target size of a bundle frame packing small files
+BUNDLE_SIZE = 4 * 1024 * 1024
 
 
 class Sender:
@@ -24,6 +44,10 @@ class Sender:
         self.__ip_address = ip_address
         self.__port_address = port_address
         self.client_socket = socket(AF_INET, SOCK_STREAM)
+        # Buffers are sized before connecting so the window scale covers them
+        tuning.tune_connection(self.client_socket)
+        # Transfer counters of this connection, once connected
+        self.metrics = None
 
     def connect_to_receiver(self) -> bool:
         """
@@ -32,6 +56,9 @@ class Sender:
         """
         try:
             self.client_socket.connect((self.__ip_address, self.__port_address))
+            self.metrics = metrics.start_session(
+                "sender", f"{self.__ip_address}:{self.__port_address}", self.client_socket
+            )
             return True
         except Exception as error_data:
             print(f"An error_data occurred : {str(error_data)}")
@@ -52,113 +79,831 @@ class Sender:
         """
         return self.__port_address
 
+    def disconnect(self) -> None:
+        """
+        Close the connection to the receiver
+        :return:
+        """
+        if self.metrics is not None:
+            metrics.end_session(self.metrics)
+        try:
+            self.client_socket.shutdown(2)
+            self.client_socket.close()
+        except Exception as error:
+            util.log_error(str(error))
+
+
+class StripePool:
+    def __init__(self, ip_address: str, port_address: int, stripes: int, stripe_size: int) -> None:
+        """
+        Extra connections used to send large files as parallel ranges
+        :param ip_address: Receiver IP address
+        :param port_address: Receiver port number
+        :param stripes: Number of range connections
+        :param stripe_size: Size of each range in bytes
+        """
+        self.stripe_size = stripe_size
+        self.senders = [Sender(ip_address, port_address) for _ in range(stripes)]
+        self.connected = all([sender.connect_to_receiver() for sender in self.senders])
+
+    def send(self, connection_socket: socket, metadata: dict, filename_to_send: str, verify: str = None) -> int:
+        """
+        Send a single file split into ranges over every pool connection
+        :param connection_socket: Main connection to the receiver socket
+        :param metadata: File information
+        :param filename_to_send: File absolute path
+        :param verify: Negotiated hash every range is checked with, None to not check
+        :return: One of
+                 protocol.NEXT once every range landed,
+                 protocol.NOT if the receiver already has a file with that name,
+                 None if ranges were lost
+        """
+        session, started = metrics.session_for(connection_socket), time.perf_counter()
+        token = os.urandom(protocol.TOKEN_SIZE)
+        protocol.send_frame(
+            connection_socket, protocol.STRIPE,
+            token + protocol.encode_entry(metadata["name"], metadata["size"], metadata["size_d"])
+        )
+        reply, _ = protocol.recv_frame(connection_socket, protocol.OK, protocol.NOT)
+        if reply == protocol.NOT:
+            print(f"{datetime.now()} : File already exists : {os.sep.join(metadata['name'])}")
+            session.add("files_skipped")
+            return protocol.NOT
+        print(f"Sending {os.sep.join(metadata['name'])} over {len(self.senders)} connections")
+        content_started = time.perf_counter()
+        # Shared queue of offsets, each connection takes the next one when free
+        ranges = Queue()
+        for offset in range(0, metadata["size"], self.stripe_size):
+            ranges.put(offset)
+        errors = []
+        workers = [
+            Thread(target=self.__send_ranges, args=(sender.client_socket, ranges, metadata["size"],
+                                                    token, filename_to_send, errors, verify))
+            for sender in self.senders
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        payload = time.perf_counter() - content_started
+        # Completion is only reported once the receiver has every range
+        protocol.send_frame(connection_socket, protocol.STRIPE_END, token)
+        reply, _ = protocol.recv_frame(connection_socket, protocol.NEXT, protocol.NOT)
+        if reply == protocol.NEXT:
+            print(f"{datetime.now()} : Done sending {os.sep.join(metadata['name'])} (striped)")
+            # Range bytes are counted by the session of the connection that carried them
+            session.add("files_sent")
+            session.file_done(metadata["name"], metadata["size"], time.perf_counter() - started - payload, payload,
+                              "striped")
+            return protocol.NEXT
+        print(f"{datetime.now()} : Receiver did not get every range of {os.sep.join(metadata['name'])}")
+        return None
+
+    def __send_ranges(self, range_socket: socket, ranges: Queue, size: int, token: bytes,
+                      filename_to_send: str, errors: list, verify: str = None) -> None:
+        """
+        Worker sending ranges over one connection until none are left
+        :param range_socket: Pool connection
+        :param ranges: Queue of range offsets
+        :param size: Full file size
+        :param token: Striped file token
+        :param filename_to_send: File absolute path
+        :param errors: Collects the worker exception if any
+        :param verify: Negotiated hash every range is checked with, None to not check
+        :return:
+        """
+        try:
+            with open(filename_to_send, "rb", buffering=0) as the_file:
+                while not errors:
+                    try:
+                        offset = ranges.get_nowait()
+                    except Empty:
+                        return
+                    count, hasher = min(self.stripe_size, size - offset), None
+                    if verify is not None:
+                        protocol.send_frame(range_socket, protocol.VERIFY, protocol.encode_names([verify]))
+                        hasher = integrity.StreamHasher(verify)
+                    protocol.send_header(range_socket, protocol.RANGE, protocol.RANGE_PREFIX.size + count)
+                    range_socket.sendall(protocol.RANGE_PREFIX.pack(token, offset))
+                    send_engine.send_payload(range_socket, the_file, offset, count, hasher)
+                    if hasher is not None:
+                        protocol.send_frame(range_socket, protocol.DIGEST, hasher.digest())
+                    metrics.session_for(range_socket).add("bytes_sent", count)
+        except Exception as error:
+            errors.append(error)
+
+    def close(self) -> None:
+        """
+        Close every pool connection
+        :return:
+        """
+        for sender in self.senders:
+            sender.disconnect()
+
 
-def send_files(connection_socket: socket, metadata: dict, filename_to_send: str) -> None:
+def send_content(connection_socket: socket, the_file, offset: int, count: int, codec: str = None,
+                 verify: str = None) -> str:
+    """
+    Send part of a file as a data frame, only its data extents if it has
+    holes, or as compressed blocks if the negotiated codec shrinks a sample of it
+    :param connection_socket: Connection to the receiver socket
+    :param the_file: File opened for binary reading
+    :param offset: Position of the first byte
+    :param count: Number of bytes
+    :param codec: Negotiated codec name, None to never compress
+    :param verify: Negotiated hash name, the content is followed by its digest; None to not check
+    :return: The path used (codec name, sparse, sendfile or buffered)
+    """
+    hasher, extents = None, None
+    if verify is not None:
+        # The receiver hashes what it writes with the announced hash
+        protocol.send_frame(connection_socket, protocol.VERIFY, protocol.encode_names([verify]))
+        hasher = integrity.StreamHasher(verify)
+    if sparse.has_holes(os.fstat(the_file.fileno())):
+        extents = sparse.data_extents(the_file.fileno(), offset, count)
+    if extents is not None:
+        # Holes are not sent, the receiver leaves them unwritten
+        protocol.send_frame(connection_socket, protocol.SPARSE, protocol.encode_sparse(count, extents))
+        protocol.send_header(connection_socket, protocol.DATA, sum(length for _, length in extents))
+        for start, length in extents:
+            send_engine.send_payload(connection_socket, the_file, start, length, hasher)
+        metrics.session_for(connection_socket).add("hole_bytes", count - sum(length for _, length in extents))
+        send_path = "sparse"
+    elif codec is not None and compress.worth_compressing(
+            codec, os.pread(the_file.fileno(), min(compress.SAMPLE_SIZE, count), offset)):
+        protocol.send_frame(connection_socket, protocol.COMPRESSED, protocol.encode_compressed(count, codec))
+        for block in compress.compressed_blocks(
+                codec, the_file, offset, count, hasher, metrics.session_for(connection_socket)):
+            send_engine.throttle(len(block))
+            protocol.send_frame(connection_socket, protocol.BLOCK, block)
+        send_path = codec
+    else:
+        protocol.send_header(connection_socket, protocol.DATA, count)
+        # Zero-copy when the platform allows it, large buffered copies otherwise
+        send_path = send_engine.send_payload(connection_socket, the_file, offset, count, hasher)
+    if hasher is not None:
+        protocol.send_frame(connection_socket, protocol.DIGEST, hasher.digest())
+    return send_path
+
+
+def send_shared_content(connection_socket: socket, shared: tuple, the_file, offset: int, count: int,
+                        verify: str = None) -> str:
+    """
+    Send part of a file as a data frame made of the chunks shared with the
+    connections to the other receivers, each chunk is read from disk once
+    :param connection_socket: Connection to the receiver socket
+    :param shared: (fanout.SharedManifest, manifest position of the file)
+    :param the_file: File opened for binary reading
+    :param offset: Position of the first byte
+    :param count: Number of bytes
+    :param verify: Negotiated hash name, the content is followed by its digest; None to not check
+    :return: The path used (shared, or sparse for files sent on their own)
+    """
+    if sparse.has_holes(os.fstat(the_file.fileno())):
+        # Reading only the data extents beats sharing the holes
+        return send_content(connection_socket, the_file, offset, count, verify=verify)
+    manifest, index = shared
+    manifest.advance(connection_socket, index, offset)
+    hasher = None
+    if verify is not None:
+        protocol.send_frame(connection_socket, protocol.VERIFY, protocol.encode_names([verify]))
+        hasher = integrity.StreamHasher(verify)
+    protocol.send_header(connection_socket, protocol.DATA, count)
+    position, end = offset, offset + count
+    while position < end:
+        number = position // fanout.CHUNK_SIZE
+        data = memoryview(manifest.chunk(connection_socket, index, number))[position - number * fanout.CHUNK_SIZE:]
+        if hasher is not None:
+            hasher.update(data)
+        send_engine.throttle(len(data))
+        connection_socket.sendall(data)
+        position += len(data)
+    if hasher is not None:
+        protocol.send_frame(connection_socket, protocol.DIGEST, hasher.digest())
+    return "shared"
+
+
+def negotiate_compression(connection_socket: socket, offered: list):
+    """
+    Offer compression codecs to the receiver
+    :param connection_socket: Connection to the receiver socket
+    :param offered: Codec names in order of preference
+    :return: The codec to use, None if the receiver supports none of them
+    """
+    protocol.send_frame(connection_socket, protocol.HELLO, protocol.encode_names(offered))
+    _, payload = protocol.recv_frame(connection_socket, protocol.HELLO)
+    accepted = compress.accept_codecs(protocol.decode_names(payload))
+    if not accepted:
+        print(f"{datetime.now()} : Receiver supports none of {', '.join(offered)}, sending uncompressed")
+        return None
+    print(f"{datetime.now()} : Compressing with {accepted[0]}")
+    return accepted[0]
+
+
+def negotiate_verification(connection_socket: socket, offered: list):
+    """
+    Offer content hashes to the receiver
+    :param connection_socket: Connection to the receiver socket
+    :param offered: Hash names in order of preference
+    :return: The hash to use, None if the receiver supports none of them
+    """
+    protocol.send_frame(connection_socket, protocol.HASHES, protocol.encode_names(offered))
+    _, payload = protocol.recv_frame(connection_socket, protocol.HASHES)
+    accepted = integrity.accept_hashes(protocol.decode_names(payload))
+    if not accepted:
+        print(f"{datetime.now()} : Receiver supports none of {', '.join(offered)}, content is not verified")
+        return None
+    print(f"{datetime.now()} : Verifying content with {accepted[0]}")
+    return accepted[0]
+
+
+def send_files(connection_socket: socket, metadata: dict, filename_to_send: str, sync: bool = False,
+               codec: str = None, verify: str = None, attempt: int = 0, shared: tuple = None) -> bool:
     """
     Send single file
     :param connection_socket: Connection to the receiver socket
     :param metadata: File information
     :param filename_to_send: File absolute path /home/user/Videos/Example.mp4
-    :return:
+    :param sync: Send only the changed blocks if the receiver already has the file
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with, None to not check
+    :param attempt: Number of times the content was already sent and did not match
+    :param shared: (fanout.SharedManifest, manifest position of the file) to take the content from
+                   chunks shared with the other receivers, None to read it here
+    :return: False if the receiver still did not get a matching copy
     """
-    # Create json object describing the file being sent
-    head = json.dumps(metadata).encode()
-    # Send file description
-    connection_socket.send(head)
-    # If the receiver agrees to receive the file (the file does not exist)
-    ok = connection_socket.recv(1024)
-    if ok.decode() == "ok":
-        # Go ahead and send the file content
+    session, started = metrics.session_for(connection_socket), time.perf_counter()
+    # Send the binary file description
+    protocol.send_frame(
+        connection_socket, protocol.SYNC if sync else protocol.HEAD,
+        protocol.encode_entry(metadata["name"], metadata["size"], metadata["size_d"])
+    )
+    # If the receiver agrees to receive the file (the file does not exist or is partial)
+    reply, payload = protocol.recv_frame(
+        connection_socket, protocol.OK, protocol.NOT, protocol.RESUME, protocol.SIGNATURE
+    )
+    if reply == protocol.SIGNATURE:
+        # The receiver has an older copy, send what changed
+        content_started = time.perf_counter()
+        literal = send_delta(connection_socket, metadata, filename_to_send, payload)
+        session.file_done(metadata["name"], literal, content_started - started,
+                          time.perf_counter() - content_started, "delta")
+    elif reply != protocol.NOT:
+        offset = 0
+        if reply == protocol.RESUME:
+            offset = resume_offset(metadata, filename_to_send, *protocol.decode_resume(payload))
+            if offset:
+                session.add("files_resumed")
+        # Go ahead and send the (rest of the) file content
         print(f"Sending {os.sep.join(metadata['name'])}")
-        with open(filename_to_send, "rb") as the_file:
-            # 1024 bytes at a time
-            data = the_file.read(1024)
-            while data:
-                # Send
-                connection_socket.send(data)
-                # Read next chunk
-                data = the_file.read(1024)
+        with open(filename_to_send, "rb", buffering=0) as the_file:
+            content_started = time.perf_counter()
+            if shared is not None:
+                send_path = send_shared_content(
+                    connection_socket, shared, the_file, offset, metadata["size"] - offset, verify
+                )
+            else:
+                send_path = send_content(
+                    connection_socket, the_file, offset, metadata["size"] - offset, codec, verify
+                )
+            payload = time.perf_counter() - content_started
             # Log when done sending a given file
-            print(f"{datetime.now()} : Done sending {os.sep.join(metadata['name'])}")
-            # Receiver requests the next file
-            next_data = connection_socket.recv(1024)
-            # Write log to file
-            Thread(target=util.log_error, args=(f"{datetime.now()} : {next_data}",)).start()
-    elif ok.decode() == "not":
+            print(f"{datetime.now()} : Done sending {os.sep.join(metadata['name'])} ({send_path})")
+            # Receiver requests the next file, or the same one again if it did not match its digest
+            next_data, _ = protocol.recv_frame(connection_socket, protocol.NEXT, protocol.RETRY)
+            # Write log to file (queued, written by the log thread)
+            util.log_debug(f"{protocol.FRAME_NAMES[next_data]} : {os.sep.join(metadata['name'])}")
+        session.add("files_sent")
+        session.add("bytes_sent", metadata["size"] - offset)
+        # Everything but the content itself (description, reply, acknowledgement) is handshake
+        session.file_done(metadata["name"], metadata["size"] - offset,
+                          time.perf_counter() - started - payload, payload, send_path)
+        if next_data == protocol.RETRY:
+            return retry_file(connection_socket, metadata, filename_to_send, codec, verify, attempt + 1)
+    else:
         # If the receiver does not agree to receive the file (file exists) skip the file
         print(f"{datetime.now()} : File already exists : {os.sep.join(metadata['name'])}")
+        session.add("files_skipped")
+        # The receiver holds some version of it, not necessarily this one
+        metadata["skipped"] = True
+    return True
+
+
+def retry_file(connection_socket: socket, metadata: dict, filename_to_send: str, codec: str = None,
+               verify: str = None, attempt: int = 1) -> bool:
+    """
+    Send a file again after the receiver dropped a copy that did not match its digest
+    :param connection_socket: Connection to the receiver socket
+    :param metadata: File information
+    :param filename_to_send: File absolute path
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with
+    :param attempt: Number of times the content was already sent and did not match
+    :return: False once every attempt failed
+    """
+    if attempt > integrity.VERIFY_RETRIES:
+        print(f"{datetime.now()} : Giving up on {os.sep.join(metadata['name'])}, "
+              f"it did not match its digest {attempt} times")
+        util.log_error(f"Digest mismatch, gave up : {os.sep.join(metadata['name'])}")
+        return False
+    print(f"{datetime.now()} : Digest mismatch, sending {os.sep.join(metadata['name'])} again")
+    util.log_error(f"Digest mismatch, retrying : {os.sep.join(metadata['name'])}", "warning")
+    metrics.session_for(connection_socket).add("files_retried")
+    return send_files(connection_socket, metadata, filename_to_send, codec=codec, verify=verify, attempt=attempt)
+
+
+def send_delta(connection_socket: socket, metadata: dict, filename_to_send: str, signature: bytes) -> int:
+    """
+    Send a file as references to the blocks the receiver already has plus the
+    literal bytes in between
+    :param connection_socket: Connection to the receiver socket
+    :param metadata: File information
+    :param filename_to_send: File absolute path
+    :param signature: Signature frame payload of the receiver copy
+    :return: Number of literal bytes sent
+    """
+    operations = delta.compute_delta(filename_to_send, delta.parse_signature(signature))
+    literal = 0
+    with open(filename_to_send, "rb", buffering=0) as the_file:
+        for operation in operations:
+            if operation[0] == "copy":
+                protocol.send_frame(connection_socket, protocol.DELTA_COPY, delta.COPY.pack(*operation[1:]))
+            else:
+                _, start, end = operation
+                protocol.send_header(connection_socket, protocol.DELTA_DATA, end - start)
+                send_engine.send_payload(connection_socket, the_file, start, end - start)
+                literal += end - start
+    protocol.send_frame(connection_socket, protocol.DELTA_END)
+    # Receiver requests the next file once the new version is in place
+    protocol.recv_frame(connection_socket, protocol.NEXT)
+    session = metrics.session_for(connection_socket)
+    session.add("bytes_sent", literal)
+    if operations or metadata["size"] == 0:
+        print(f"{datetime.now()} : Done sending {os.sep.join(metadata['name'])} "
+              f"(delta, {literal} of {metadata['size']} bytes)")
+        session.add("files_delta")
+    else:
+        print(f"{datetime.now()} : File unchanged : {os.sep.join(metadata['name'])}")
+        session.add("files_skipped")
+    return literal
+
+
+def resume_offset(metadata: dict, filename: str, offset: int, digest: bytes) -> int:
+    """
+    Decide where to resume a file the receiver partially holds
+    :param metadata: File information
+    :param filename: File absolute path
+    :param offset: Number of bytes the receiver holds
+    :param digest: Digest of those bytes, empty if the receiver did not send one
+    :return: offset if the held bytes can be kept, 0 to send the whole file again
+    """
+    if offset > metadata["size"] or (digest and util.prefix_digest(filename, offset) != digest):
+        print(f"{datetime.now()} : Partial copy differs, sending all of {os.sep.join(metadata['name'])}")
+        return 0
+    print(f"{datetime.now()} : Resuming {os.sep.join(metadata['name'])} at byte {offset}")
+    return offset
+
+
+def send_bundle(connection_socket: socket, bundle: list, verify: str = None) -> None:
+    """
+    Pack small files into a single bundle frame
+    :param connection_socket: Connection to the receiver socket
+    :param bundle: List of (metadata, absolute file path) in manifest order
+    :param verify: Negotiated hash the bundle is checked with, None to not check
+    :return:
+    """
+    session, started = metrics.session_for(connection_socket), time.perf_counter()
+    length = protocol.BUNDLE_COUNT.size + sum(metadata["size"] for metadata, _ in bundle)
+    packed = bytearray(protocol.HEADER.size + length)
+    protocol.HEADER.pack_into(packed, 0, protocol.MAGIC, protocol.VERSION, protocol.BUNDLE, length)
+    protocol.BUNDLE_COUNT.pack_into(packed, protocol.HEADER.size, len(bundle))
+    view, position = memoryview(packed), protocol.HEADER.size + protocol.BUNDLE_COUNT.size
+    # Read every file straight into its slot of the frame
+    for metadata, filename in bundle:
+        with open(filename, "rb", buffering=0) as the_file:
+            end = position + metadata["size"]
+            while position < end:
+                read_size = the_file.readinto(view[position:end])
+                if not read_size:
+                    raise EOFError(f"{filename} shrank while packing")
+                position += read_size
+    session.add("disk_read_seconds", time.perf_counter() - started)
+    hasher = None
+    if verify is not None:
+        # The bundle is hashed while it is being sent
+        protocol.send_frame(connection_socket, protocol.VERIFY, protocol.encode_names([verify]))
+        hasher = integrity.StreamHasher(verify)
+        hasher.update(view[protocol.HEADER.size:])
+    send_engine.throttle(len(view))
+    connection_socket.sendall(view)
+    if hasher is not None:
+        protocol.send_frame(connection_socket, protocol.DIGEST, hasher.digest())
+    session.add("files_sent", len(bundle))
+    session.add("bytes_sent", length - protocol.BUNDLE_COUNT.size)
+    session.add("payload_seconds", time.perf_counter() - started)
+    print(f"{datetime.now()} : Done sending bundle of {len(bundle)} files ({length} bytes)")
+
+
+def send_batch(connection_socket: socket, manifest, pack_threshold: int = 0, sync: bool = False,
+               codec: str = None, verify: str = None) -> list:
+    """
+    Send files manifest-first: stream every file description, get the wanted
+    files back in one reply, then send them back-to-back without per-file acks
+    :param connection_socket: Connection to the receiver socket
+    :param manifest: Iterable of (metadata, absolute file path)
+    :param pack_threshold: Files up to this size are packed into bundle frames, 0 disables packing
+    :param sync: Follow up with a delta of every file the receiver already has
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with, None to not check
+    :return: Every (metadata, absolute file path) of the manifest the receiver holds now
+    """
+    described, chunk = [], []
+    for metadata, filename in manifest:
+        described.append((metadata, filename))
+        chunk.append(protocol.encode_entry(metadata["name"], metadata["size"], metadata["size_d"]))
+        # Stream the manifest as it is built
+        if len(chunk) == MANIFEST_CHUNK:
+            protocol.send_frame(connection_socket, protocol.MANIFEST, protocol.encode_entries(chunk))
+            chunk = []
+    if not described:
+        return described
+    if chunk:
+        protocol.send_frame(connection_socket, protocol.MANIFEST, protocol.encode_entries(chunk))
+    protocol.send_frame(connection_socket, protocol.MANIFEST_END)
+    session, started = metrics.session_for(connection_socket), time.perf_counter()
+    # One reply for the whole manifest
+    _, payload = protocol.recv_frame(connection_socket, protocol.WANT)
+    wanted, resumes = protocol.decode_want(payload, len(described))
+    session.add("handshake_seconds", time.perf_counter() - started)
+    print(f"{datetime.now()} : Receiver wants {sum(wanted)} of {len(described)} files")
+    bundle, bundle_size, existing = [], 0, []
+    for index, ((metadata, filename), want) in enumerate(zip(described, wanted)):
+        if not want:
+            if sync:
+                existing.append(index)
+            else:
+                print(f"{datetime.now()} : File already exists : {os.sep.join(metadata['name'])}")
+                session.add("files_skipped")
+                metadata["skipped"] = True
+            continue
+        offset = 0
+        if index in resumes:
+            offset = resume_offset(metadata, filename, *resumes[index])
+            if offset:
+                session.add("files_resumed")
+        # Resumed files always travel as data frames
+        if not offset and pack_threshold and metadata["size"] <= min(pack_threshold, BUNDLE_SIZE):
+            # Keep collecting small files until the bundle is full
+            bundle.append((metadata, filename))
+            bundle_size += metadata["size"]
+            if bundle_size >= BUNDLE_SIZE:
+                send_bundle(connection_socket, bundle, verify)
+                bundle, bundle_size = [], 0
+            continue
+        # Flush pending small files first, files stay in manifest order
+        if bundle:
+            send_bundle(connection_socket, bundle, verify)
+            bundle, bundle_size = [], 0
+        content_started = time.perf_counter()
+        with open(filename, "rb", buffering=0) as the_file:
+            send_path = send_content(
+                connection_socket, the_file, offset, metadata["size"] - offset, codec, verify
+            )
+        print(f"{datetime.now()} : Done sending {os.sep.join(metadata['name'])} ({send_path})")
+        session.add("files_sent")
+        session.add("bytes_sent", metadata["size"] - offset)
+        session.file_done(metadata["name"], metadata["size"] - offset, 0.0,
+                          time.perf_counter() - content_started, send_path)
+    if bundle:
+        send_bundle(connection_socket, bundle, verify)
+    # Receiver confirms once everything landed, or lists the files that did not match their digest
+    started = time.perf_counter()
+    reply, payload = protocol.recv_frame(connection_socket, protocol.NEXT, protocol.RETRY)
+    session.add("handshake_seconds", time.perf_counter() - started)
+    failed = set()
+    if reply == protocol.RETRY:
+        for index, again in enumerate(protocol.decode_bitmap(payload, len(described))):
+            if again and not retry_file(connection_socket, *described[index], codec, verify):
+                failed.add(index)
+    # Files the receiver already has are compared one at a time
+    for index in existing:
+        if not send_files(connection_socket, *described[index], sync=True, codec=codec, verify=verify):
+            failed.add(index)
+    return [item for index, item in enumerate(described) if index not in failed]
+
+
+def send_worker(sender: Sender, work: scheduler.WorkQueue, worker: int, sync: bool = False,
+                codec: str = None, verify: str = None, record=None) -> None:
+    """
+    Send whole files over one pool connection until the scheduler runs dry
+    :param sender: Connected sender used by this worker
+    :param work: Shared work-stealing queue
+    :param worker: Worker index
+    :param sync: Send only the changed blocks of files the receiver already has
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with, None to not check
+    :param record: Called with (metadata, absolute file path) of each file the receiver holds
+    :return:
+    """
+    item = work.take(worker)
+    while item is not None:
+        metadata_d, filename = item
+        try:
+            held = send_files(sender.client_socket, metadata_d, filename, sync, codec, verify)
+        except Exception as error:
+            # The connection is unusable now, the other workers steal what is left, this file included
+            print(f"{datetime.now()} : Failed sending {os.sep.join(metadata_d['name'])} : {str(error)}")
+            util.log_error(f"Worker {worker} failed : {str(error)}")
+            if not work.put_back(worker, item):
+                util.log_error(f"Gave up on {os.sep.join(metadata_d['name'])} after "
+                               f"{scheduler.MAX_PUT_BACK + 1} failed connections")
+            return
+        if held and record is not None:
+            record(metadata_d, filename)
+        item = work.take(worker)
+
+
+def send_concurrently(senders: list, manifest, ordering: str, sync: bool = False, codec: str = None,
+                      verify: str = None, record=None) -> None:
+    """
+    Overlap many whole files, one at a time per connection
+    :param senders: Connected senders, one worker each
+    :param manifest: Iterable of (metadata, absolute file path)
+    :param ordering: Key of scheduler.ORDERINGS
+    :param sync: Send only the changed blocks of files the receiver already has
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with, None to not check
+    :param record: Called with (metadata, absolute file path) of each file the receiver holds
+    :return:
+    """
+    work = scheduler.WorkQueue(manifest, len(senders), ordering)
+    print(f"{datetime.now()} : Sending files over {len(senders)} connections ({ordering} first)")
+    workers = [
+        Thread(target=send_worker, args=(sender, work, index, sync, codec, verify, record))
+        for index, sender in enumerate(senders)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def fan_out_worker(sender: Sender, shared: fanout.SharedManifest, sync: bool = False, verify: str = None) -> None:
+    """
+    Send a shared manifest to one receiver, file by file at the pace of that receiver
+    :param sender: Connected sender of this receiver
+    :param shared: Manifest and file chunks shared by every receiver
+    :param sync: Send only the changed blocks of files the receiver already has
+    :param verify: Hash negotiated with this receiver, None to not check
+    :return:
+    """
+    index, item = 0, shared.file(0)
+    try:
+        while item is not None:
+            metadata_d, filename = item
+            # Chunks before this file are not needed by this connection any more
+            shared.advance(sender.client_socket, index)
+            send_files(sender.client_socket, metadata_d, filename, sync, verify=verify, shared=(shared, index))
+            index += 1
+            item = shared.file(index)
+    except Exception as error:
+        # Only this receiver stops, the others keep going
+        print(f"{datetime.now()} : Failed sending to {sender.get_ip_address()}:{sender.get_port_address()} : "
+              f"{str(error)}")
+        util.log_error(f"Fan-out to {sender.get_ip_address()}:{sender.get_port_address()} failed : {str(error)}")
+    finally:
+        shared.leave(sender.client_socket)
 
 
-def main(ip_address: str, port_number: int, files: list) -> None:
+def fan_out(targets: list, files: list, sync: bool = False, verification: list = None, scan_threads: int = 1,
+            max_lag: int = fanout.DEFAULT_MAX_LAG) -> None:
+    """
+    Send the same files to several receivers, reading each file once
+    :param targets: (IP address, port number) of every receiver
+    :param files: List of file(s) and/or folder(s) to send
+    :param sync: Send only the changed blocks of files a receiver already has (rsync-style delta)
+    :param verification: Content hashes to offer in order of preference, None or empty to not verify
+    :param scan_threads: Number of directories listed at the same time while scanning
+    :param max_lag: Bytes a receiver may fall behind the fastest one and still share its reads
+    :return:
+    """
+    senders = [Sender(ip_address, port_number) for ip_address, port_number in targets]
+    connected = [sender for sender in senders if sender.connect_to_receiver()]
+    if connected:
+        # Every receiver agrees on its own hash
+        verifies = [
+            negotiate_verification(sender.client_socket, verification) if verification else None
+            for sender in connected
+        ]
+        shared = fanout.SharedManifest(scanner.scan(files, scan_threads), max_lag)
+        workers = [
+            Thread(target=fan_out_worker, args=(sender, shared, sync, verify))
+            for sender, verify in zip(connected, verifies)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print(f"{datetime.now()} : Sent to {len(connected)} of {len(targets)} receivers, "
+              f"{shared.disk_bytes} bytes read from disk")
+    for sender in connected:
+        sender.disconnect()
+
+
+def split_striped(manifest, stripe_size: int, striped: list):
+    """
+    Set aside the files large enough to be striped
+    :param manifest: Iterable of (metadata, absolute file path)
+    :param stripe_size: Size of each range in bytes
+    :param striped: Collects the files set aside
+    :return: Generator of the remaining (metadata, absolute file path)
+    """
+    for metadata, filename in manifest:
+        if metadata["size"] >= 2 * stripe_size and not is_sparse(filename):
+            striped.append((metadata, filename))
+        else:
+            yield metadata, filename
+
+
+def is_sparse(filename: str) -> bool:
+    """
+    If a file has holes, such files are sent whole over one connection since
+    skipping the holes saves more than striping
+    :param filename: File absolute path
+    :return:
+    """
+    try:
+        return sparse.has_holes(os.stat(filename))
+    except OSError:
+        return False
+
+
+def no_record(metadata: dict, filename: str) -> None:
+    """
+    Record callback used when no index is kept
+    :param metadata: File information
+    :param filename: File absolute path
+    :return:
+    """
+
+
+def send_manifest(the_sender: Sender, manifest, batch: bool = False, pack_threshold: int = 0,
+                  stripes: int = 1, stripe_size: int = DEFAULT_STRIPE_SIZE, concurrency: int = 1,
+                  ordering: str = "manifest", sync: bool = False, codec: str = None, verify: str = None,
+                  record=None) -> None:
+    """
+    Send every file of a manifest over a connected sender
+    :param the_sender: Connected sender
+    :param manifest: Iterable of (metadata, absolute file path)
+    :param batch: Send the whole manifest first and skip the per-file round trips
+    :param pack_threshold: Files up to this size are packed into bundle frames, 0 disables packing
+    :param stripes: Number of parallel connections large files are split over, 1 disables striping
+    :param stripe_size: Size of each range of a striped file
+    :param concurrency: Number of connections sending whole files at the same time
+    :param ordering: Order the concurrent scheduler starts files in (see scheduler.ORDERINGS)
+    :param sync: Send only the changed blocks of files the receiver already has (rsync-style delta)
+    :param codec: Negotiated compression codec, None to send uncompressed
+    :param verify: Negotiated hash the content is checked with, None to not check
+    :param record: Called with (metadata, absolute file path) of each file the receiver holds
+    :return:
+    """
+    if record is None:
+        record = no_record
+    ip_address, port_number = the_sender.get_ip_address(), the_sender.get_port_address()
+    striped = []
+    if stripes > 1:
+        manifest = split_striped(manifest, stripe_size, striped)
+    if concurrency > 1:
+        senders = [the_sender] + [Sender(ip_address, port_number) for _ in range(concurrency - 1)]
+        senders = [the_sender] + [sender for sender in senders[1:] if sender.connect_to_receiver()]
+        send_concurrently(senders, manifest, ordering, sync, codec, verify, record)
+        for sender in senders[1:]:
+            sender.disconnect()
+    elif batch:
+        for metadata_d, filename in send_batch(
+                the_sender.client_socket, manifest, pack_threshold, sync, codec, verify):
+            record(metadata_d, filename)
+    else:
+        pending, pending_size = [], 0
+        for metadata_d, filename in manifest:
+            if pack_threshold and metadata_d["size"] <= min(pack_threshold, BUNDLE_SIZE):
+                # Small files travel as small batches with a single round trip
+                pending.append((metadata_d, filename))
+                pending_size += metadata_d["size"]
+                if pending_size >= BUNDLE_SIZE or len(pending) == MANIFEST_CHUNK:
+                    for item in send_batch(the_sender.client_socket, pending, pack_threshold, sync, codec, verify):
+                        record(*item)
+                    pending, pending_size = [], 0
+                continue
+            # Send file metadata and file content
+            if send_files(the_sender.client_socket, metadata_d, filename, sync, codec, verify):
+                record(metadata_d, filename)
+        if pending:
+            for item in send_batch(the_sender.client_socket, pending, pack_threshold, sync, codec, verify):
+                record(*item)
+    if striped:
+        stripe_pool = StripePool(ip_address, port_number, stripes, stripe_size)
+        if stripe_pool.connected:
+            for metadata_d, filename in striped:
+                reply = stripe_pool.send(the_sender.client_socket, metadata_d, filename, verify)
+                held = reply == protocol.NEXT
+                if reply == protocol.NOT:
+                    # Ranges only fill new files, existing ones are compared block by block
+                    metadata_d["skipped"] = not sync
+                    held = not sync or send_files(the_sender.client_socket, metadata_d, filename, sync=True,
+                                                  codec=codec, verify=verify)
+                elif reply is None and verify is not None:
+                    # A range that did not match its digest fails the file, it is sent again whole
+                    held = retry_file(the_sender.client_socket, metadata_d, filename, codec, verify)
+                if held:
+                    record(metadata_d, filename)
+        stripe_pool.close()
+
+
+def main(ip_address: str, port_number: int, files: list, batch: bool = False, pack_threshold: int = 0,
+         stripes: int = 1, stripe_size: int = DEFAULT_STRIPE_SIZE, concurrency: int = 1,
+         ordering: str = "manifest", sync: bool = False, compression: list = None, scan_threads: int = 1,
+         index: sync_index.SyncIndex = None, watch: float = 0, verification: list = None) -> None:
     """
     Main program
     :param ip_address: Receiver IP address
     :param port_number: Receiver process port number
     :param files: List of file(s) and/or folder(s) to send to the receiver
+    :param batch: Send the whole manifest first and skip the per-file round trips
+    :param pack_threshold: Files up to this size are packed into bundle frames, 0 disables packing
+    :param stripes: Number of parallel connections large files are split over, 1 disables striping
+    :param stripe_size: Size of each range of a striped file
+    :param concurrency: Number of connections sending whole files at the same time
+    :param ordering: Order the concurrent scheduler starts files in (see scheduler.ORDERINGS)
+    :param sync: Send only the changed blocks of files the receiver already has (rsync-style delta)
+    :param compression: Compression codecs to offer in order of preference, None or empty to never compress
+    :param scan_threads: Number of directories listed at the same time while scanning
+    :param index: Record of what the receiver holds, only new or changed files are offered
+    :param watch: Rescan every this many seconds over the same connection, 0 to send once
+    :param verification: Content hashes to offer in order of preference, None or empty to not verify
     :return:
     """
     the_sender = Sender(ip_address, port_number)
     if the_sender.connect_to_receiver():
-        # Iterate over all the provided files/folders
-        for abs_file_path in files:
-            # If folder is provided and the path has path seperator at the end (/)
-            # remove it
-            if abs_file_path.endswith(os.sep):
-                abs_file_path = os.sep.join(abs_file_path.split(os.sep)[0:len(abs_file_path.split(os.sep)) - 1:1])
-            # Check if the file or folder exists
-            if os.path.exists(abs_file_path):
-                # For file
-                if os.path.isfile(abs_file_path):
-                    # Get file info
-                    print(f"{datetime.now()} : Getting file metadata. Please wait...")
-                    metadata_d = {
-                        "name": [os.path.basename(abs_file_path)],
-                        "size_d": os.path.getsize(abs_file_path),
-                        "size": os.path.getsize(abs_file_path)
-                    }
-                    # Send file metadata and file content
-                    send_files(the_sender.client_socket, metadata_d, abs_file_path)
-                # For folder
-                elif os.path.isdir(abs_file_path):
-                    print(f"{datetime.now()} : Getting file metadata. Please wait...")
-                    # Get folder size
-                    directory_size = util.get_dir_size(abs_file_path)
-                    # Walk the folder to get to files
-                    for folder_path, folder_list, filenames_list in os.walk(abs_file_path):
-                        for filename_item in filenames_list:
-                            # Don't send empty files
-                            if os.path.getsize(os.path.join(folder_path, filename_item)) > 0:
-                                # Get each file path relative to the folder being sent in a list of folders
-                                # example [folder_being_sent, sub-folder1, sub-folder2, file.ext]
-                                # to help recreate the folder structure in the receiver end.
-                                root = folder_path.split(os.sep)[
-                                       folder_path.split(os.sep).index(abs_file_path.split(os.sep)[-1]):len(
-                                           folder_path.split(os.sep)
-                                       ):1]
-                                # Append base filename
-                                root.append(filename_item)
-                                # Create file description
-                                metadata_d = {
-                                    "name": root,
-                                    "size_d": directory_size,
-                                    "size": os.path.getsize(os.path.join(folder_path, filename_item))
-                                }
-                                # Send file metadata and file content
-                                send_files(
-                                    the_sender.client_socket,
-                                    metadata_d, os.path.join(folder_path, filename_item)
-                                )
-            else:
-                print(f"{abs_file_path} : File or directory not found!")
-    try:
-        # Cleanup
-        the_sender.client_socket.shutdown(2)
-        the_sender.client_socket.close()
-    except Exception as error:
-        util.log_error(str(error))
+        # The codec is agreed once, every connection uses it
+        codec = negotiate_compression(the_sender.client_socket, compression) if compression else None
+        verify = negotiate_verification(the_sender.client_socket, verification) if verification else None
+        receiver, record = f"{ip_address}:{port_number}", None
+        if index is not None:
+            record = partial(index.record, receiver)
+        while True:
+            # Files are sent while the folders are still being scanned
+            manifest = scanner.scan(files, scan_threads)
+            if index is not None:
+                manifest = index.changed(receiver, manifest)
+            try:
+                send_manifest(the_sender, manifest, batch, pack_threshold, stripes, stripe_size, concurrency,
+                              ordering, sync, codec, verify, record)
+            finally:
+                if index is not None:
+                    index.commit()
+            if not watch:
+                break
+            try:
+                time.sleep(watch)
+            except KeyboardInterrupt:
+                print(f"{datetime.now()} : Stopped watching")
+                break
+    # Cleanup
+    the_sender.disconnect()
+    if index is not None:
+        index.close()
 
 
 if __name__ == "__main__":
     # Get commandline arguments
     arguments = get_args()
-    main(arguments["address"], arguments["port"], arguments["files"])
+    util.LOG_LEVEL = arguments["log_level"]
+    tuning.SOCKET_BUFFER = arguments["socket_buffer"]
+    tuning.NOTSENT_LOWAT = arguments["notsent_lowat"]
+    # Rate of this sender over all its connections, the limits file can change it while sending
+    send_engine.limits.update({"rate": arguments["rate"]})
+    if arguments["limits"]:
+        ratelimit.watch_limits(send_engine.limits, arguments["limits"])
+    sender_index = None
+    if arguments["index"]:
+        sender_index = sync_index.SyncIndex(arguments["index"], arguments["index_hash"])
+    stats_writer = None
+    if arguments["stats"]:
+        stats_writer = metrics.StatsWriter(arguments["stats"], arguments["stats_interval"])
+    try:
+        if len(arguments["targets"]) > 1:
+            # Several receivers share every read
+            fan_out(arguments["targets"], arguments["files"], arguments["delta"], arguments["verify"],
+                    arguments["scan_threads"], arguments["max_lag"])
+        else:
+            main(arguments["address"], arguments["port"], arguments["files"], arguments["batch"], arguments["pack"],
+                 arguments["stripes"], arguments["stripe_size"], arguments["concurrency"], arguments["order"],
+                 arguments["delta"], arguments["compress"], arguments["scan_threads"], sender_index,
+                 arguments["watch"], arguments["verify"])
+    finally:
+        # Last snapshot holds the totals of the run
+        if stats_writer is not None:
+            stats_writer.close()
@@ -0,0 +1,452 @@
+#!/usr/bin/python3
+"""
+Loopback benchmark of Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+Generates a synthetic workload, starts a Receiver and a Sender as
+subprocesses on loopback (optionally through a proxy adding latency and a
+bandwidth limit) and reports throughput, files/s, CPU time and peak memory
+of both ends as JSON so runs can be compared across versions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+
+import util
+
+# Workload names and what they generate, see make_workload
+WORKLOADS = {
+    "huge": "One large file",
+    "tiny": "Many one-block files spread over sub-folders",
+    "mixed": "A tree of small, medium and large files",
+    "sparse": "Large files that are mostly holes",
+}
+# Size of the huge workload file and of each sparse file if --size is not given
+DEFAULT_SIZE = 1024 * 1024 * 1024
+# Number of files of the tiny workload if --count is not given
+DEFAULT_COUNT = 10000
+# Files per sub-folder of the tiny and mixed workloads
+FILES_PER_FOLDER = 1000
+# Chunk written at a time while generating files
+WRITE_CHUNK = 4 * 1024 * 1024
+# Proxy reads at most this much before forwarding
+PROXY_CHUNK = 256 * 1024
+# Seconds to wait for the Receiver to start accepting connections, or to stop
+START_TIMEOUT = 10
+
+
+def write_file(path: str, size: int, seed: int = 0) -> None:
+    """
+    Write a file of pseudo-random (incompressible) content
+    :param path: File path
+    :param size: File size in bytes
+    :param seed: Varies the content between files
+    :return:
+    """
+    # One random chunk rotated per write, generating is not what is measured
+    chunk = os.urandom(min(WRITE_CHUNK, max(size, 1)))
+    with open(path, "wb") as the_file:
+        written = 0
+        while written < size:
+            shift = (seed + written) % len(chunk)
+            data = chunk[shift:] + chunk[:shift]
+            written += the_file.write(data[:size - written])
+
+
+def write_sparse_file(path: str, size: int) -> None:
+    """
+    Write a file with a few data regions and holes everywhere else
+    :param path: File path
+    :param size: File size in bytes
+    :return:
+    """
+    with open(path, "wb") as the_file:
+        the_file.truncate(size)
+        # A 1 MiB data region at every eighth of the file
+        for index in range(8):
+            the_file.seek(index * size // 8)
+            the_file.write(os.urandom(min(1024 * 1024, size // 8)))
+
+
+def make_workload(name: str, folder: str, size: int = DEFAULT_SIZE, count: int = DEFAULT_COUNT) -> str:
+    """
+    Generate a workload once, later runs reuse it
+    :param name: Key of WORKLOADS
+    :param folder: Folder the workloads are kept in
+    :param size: Size of the huge file and of each sparse file
+    :param count: Number of tiny files
+    :return: Path of the item to send
+    """
+    root = os.sep.join([folder, f"{name}-{size}-{count}"])
+    if os.path.exists(root):
+        return root
+    building = root + ".part"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    print(f"{datetime.now()} : Generating {name} workload in {root}")
+    if name == "huge":
+        write_file(os.sep.join([building, "huge.bin"]), size)
+    elif name == "tiny":
+        for index in range(count):
+            sub_folder = os.sep.join([building, f"d{index // FILES_PER_FOLDER}"])
+            if index % FILES_PER_FOLDER == 0:
+                os.makedirs(sub_folder)
+            with open(os.sep.join([sub_folder, f"f{index}.txt"]), "wb") as the_file:
+                the_file.write(f"tiny file {index}\n".encode() * 8)
+    elif name == "mixed":
+        # Sizes cycle from a few hundred bytes to a few MiB
+        sizes = [512, 4 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 * 1024]
+        for index in range(max(1, count // 10)):
+            sub_folder = os.sep.join([building, f"d{index // FILES_PER_FOLDER}", f"s{index % 7}"])
+            os.makedirs(sub_folder, exist_ok=True)
+            write_file(os.sep.join([sub_folder, f"f{index}.bin"]), sizes[index % len(sizes)], index)
+        write_file(os.sep.join([building, "large.bin"]), size // 4)
+    elif name == "sparse":
+        for index in range(4):
+            write_sparse_file(os.sep.join([building, f"sparse{index}.img"]), size)
+    else:
+        raise ValueError(f"Unknown workload {name}")
+    os.rename(building, root)
+    return root
+
+
+def tree_totals(path: str) -> tuple:
+    """
+    Count the non-empty files under a path and their total size
+    :param path: File or folder
+    :return: (number of files, total bytes)
+    """
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+    files, total = 0, 0
+    for folder, _, names in os.walk(path):
+        for name in names:
+            size = os.path.getsize(os.sep.join([folder, name]))
+            if size > 0:
+                files, total = files + 1, total + size
+    return files, total
+
+
+def get_free_port() -> int:
+    """
+    Ask the kernel for an unused loopback port
+    :return:
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = START_TIMEOUT) -> None:
+    """
+    Wait until something accepts connections on a loopback port
+    :param port: Port number
+    :param timeout: Seconds before giving up
+    :return:
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Nothing listening on port {port} after {timeout} seconds")
+            time.sleep(0.05)
+
+
+class Proxy:
+    def __init__(self, target_port: int, latency: float = 0.0, bandwidth: float = 0.0) -> None:
+        """
+        Loopback TCP proxy delaying and throttling both directions, so a
+        benchmark can look like a WAN link
+        :param target_port: Port connections are forwarded to
+        :param latency: One-way delay in seconds added to every chunk
+        :param bandwidth: Bytes per second in each direction, 0 for no limit
+        """
+        self.target_port, self.latency, self.bandwidth = target_port, latency, bandwidth
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(64)
+        self.port = self.server_socket.getsockname()[1]
+        Thread(target=self.__accept, name="proxy", daemon=True).start()
+
+    def __accept(self) -> None:
+        """
+        Forward every accepted connection to the target
+        :return:
+        """
+        while True:
+            try:
+                client, _ = self.server_socket.accept()
+            except OSError:
+                return
+            try:
+                upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            except OSError:
+                client.close()
+                continue
+            for source, destination in ((client, upstream), (upstream, client)):
+                delayed = Queue()
+                Thread(target=self.__read, args=(source, delayed), daemon=True).start()
+                Thread(target=self.__write, args=(destination, delayed), daemon=True).start()
+
+    def __read(self, source: socket.socket, delayed: Queue) -> None:
+        """
+        Stamp each chunk read with the time it may be delivered
+        :param source: Reading side
+        :param delayed: Chunks on their way, None once the side closed
+        :return:
+        """
+        try:
+            while True:
+                data = source.recv(PROXY_CHUNK)
+                if not data:
+                    break
+                delayed.put((time.monotonic() + self.latency, data))
+        except OSError:
+            pass
+        delayed.put(None)
+
+    def __write(self, destination: socket.socket, delayed: Queue) -> None:
+        """
+        Deliver chunks once their delay passed, no faster than the bandwidth
+        :param destination: Writing side
+        :param delayed: Chunks on their way
+        :return:
+        """
+        # The link is busy until this time with what was already sent
+        busy_until = time.monotonic()
+        try:
+            while True:
+                item = delayed.get()
+                if item is None:
+                    break
+                deliver_at, data = item
+                if self.bandwidth > 0:
+                    busy_until = max(busy_until, deliver_at) + len(data) / self.bandwidth
+                    deliver_at = busy_until
+                pause = deliver_at - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+                destination.sendall(data)
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        """
+        Stop accepting connections
+        :return:
+        """
+        self.server_socket.close()
+
+
+def wait_with_usage(process: subprocess.Popen, timeout: float = None) -> dict:
+    """
+    Wait for a child process and collect its resource usage
+    :param process: Started process
+    :param timeout: Seconds before the process is killed, None to wait as long as it runs
+    :return: {"exit_code", "cpu_user", "cpu_system", "peak_rss"} (peak_rss in bytes)
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+    while pid == 0:
+        if time.monotonic() > deadline:
+            process.kill()
+            deadline = None
+        time.sleep(0.05)
+        pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {"exit_code": process.returncode, "cpu_user": round(usage.ru_utime, 3),
+            "cpu_system": round(usage.ru_stime, 3), "peak_rss": peak_rss}
+
+
+def run_once(item: str, sender_args: list, receiver_args: list, latency: float = 0.0,
+             bandwidth: float = 0.0, keep: bool = False) -> dict:
+    """
+    Send an item from a new Sender to a new Receiver and measure both
+    :param item: File or folder to send
+    :param sender_args: Extra Sender arguments
+    :param receiver_args: Extra Receiver arguments
+    :param latency: One-way delay added by the proxy in seconds
+    :param bandwidth: Proxy bandwidth limit in bytes per second, 0 for none
+    :param keep: Keep the received copy
+    :return: Measurements of the run
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    save_folder, port = tempfile.mkdtemp(prefix="sendfiles-bench-"), get_free_port()
+    receiver = subprocess.Popen(
+        [sys.executable, os.sep.join([here, "Receiver.py"]), "-p", str(port), "-s", save_folder + os.sep]
+        + receiver_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    proxy = None
+    try:
+        wait_for_port(port)
+        if latency > 0 or bandwidth > 0:
+            proxy = Proxy(port, latency, bandwidth)
+        started = time.perf_counter()
+        sender = subprocess.Popen(
+            [sys.executable, os.sep.join([here, "Sender.py"]), "-a", "127.0.0.1",
+             "-p", str(proxy.port if proxy else port), "-f", item] + sender_args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        sender_usage = wait_with_usage(sender)
+        elapsed = time.perf_counter() - started
+    finally:
+        # The Receiver stops on ctrl+c once its sessions are done
+        receiver.send_signal(signal.SIGINT)
+        receiver_usage = wait_with_usage(receiver, START_TIMEOUT)
+        if proxy is not None:
+            proxy.close()
+    files, total = tree_totals(item)
+    received = tree_totals(os.sep.join([save_folder, os.path.basename(item.rstrip(os.sep))]))
+    if not keep:
+        shutil.rmtree(save_folder, ignore_errors=True)
+    return {
+        "seconds": round(elapsed, 3),
+        "files": files,
+        "bytes": total,
+        "throughput_mib_s": round(total / elapsed / 1024 / 1024, 2),
+        "files_per_second": round(files / elapsed, 1),
+        "complete": received == (files, total),
+        "sender": sender_usage,
+        "receiver": receiver_usage,
+    }
+
+
+def version() -> str:
+    """
+    Commit of the code being measured, if this is a git checkout
+    :return:
+    """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def get_args() -> dict:
+    """
+    Get commandline arguments for the benchmark script
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Measure Sender and Receiver on loopback",
+        epilog="python3 benchmark.py -w huge tiny --sender-args='-b -k' --receiver-args=-e -o results.json"
+    )
+    parser.add_argument(
+        "-w", "--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS),
+        help="Workloads to run, all of them if not provided"
+    )
+    parser.add_argument(
+        "--size", type=int, default=DEFAULT_SIZE,
+        help="Size of the huge file and of each sparse file in bytes (1 GiB by default)"
+    )
+    parser.add_argument(
+        "--count", type=int, default=DEFAULT_COUNT,
+        help=f"Number of tiny files ({DEFAULT_COUNT} by default), the mixed tree has a tenth of that"
+    )
+    parser.add_argument(
+        "--work-dir", default=os.sep.join([tempfile.gettempdir(), "sendfiles-workloads"]),
+        help="Folder the generated workloads are kept in between runs"
+    )
+    parser.add_argument(
+        "--sender-args", default="",
+        help="Extra Sender arguments, quoted and given with = (e.g. --sender-args='-b -k -z')"
+    )
+    parser.add_argument(
+        "--receiver-args", default="",
+        help="Extra Receiver arguments, quoted and given with = (e.g. --receiver-args=-e)"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0,
+        help="One-way delay in milliseconds added by a loopback proxy"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=0,
+        help="Bandwidth limit of the loopback proxy in MiB/s, each direction"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1,
+        help="Runs per workload"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="Append the results to this JSON-lines file instead of printing them"
+    )
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="Keep the received copies"
+    )
+
+    args = parser.parse_args()
+    return {
+        "workloads": args.workloads,
+        "size": max(1, args.size),
+        "count": max(1, args.count),
+        "work_dir": args.work_dir,
+        "sender_args": shlex.split(args.sender_args),
+        "receiver_args": shlex.split(args.receiver_args),
+        "latency": max(0.0, args.latency) / 1000,
+        "bandwidth": max(0.0, args.bandwidth) * 1024 * 1024,
+        "repeat": max(1, args.repeat),
+        "output": args.output,
+        "keep": args.keep
+    }
+
+
+def main(arguments: dict) -> None:
+    """
+    Main program
+    :param arguments: See get_args
+    :return:
+    """
+    os.makedirs(arguments["work_dir"], exist_ok=True)
+    code_version, host = version(), {"python": platform.python_version(), "platform": platform.platform(),
+                                     "cpus": os.cpu_count()}
+    for workload in arguments["workloads"]:
+        item = make_workload(workload, arguments["work_dir"], arguments["size"], arguments["count"])
+        for run in range(arguments["repeat"]):
+            result = {
+                "time": datetime.now().isoformat(), "version": code_version, "host": host,
+                "workload": workload, "run": run, "sender_args": arguments["sender_args"],
+                "receiver_args": arguments["receiver_args"], "latency": arguments["latency"],
+                "bandwidth": arguments["bandwidth"],
+                **run_once(item, arguments["sender_args"], arguments["receiver_args"], arguments["latency"],
+                           arguments["bandwidth"], arguments["keep"])
+            }
+            line = json.dumps(result)
+            if arguments["output"]:
+                with open(arguments["output"], "a") as results:
+                    results.write(line + "\n")
+                print(f"{datetime.now()} : {workload} run {run} : {result['throughput_mib_s']} MiB/s, "
+                      f"{result['files_per_second']} files/s, complete={result['complete']}")
+            else:
+                print(line)
+            if not result["complete"]:
+                util.log_error(f"Benchmark {workload} run {run} did not receive every file", "warning")
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,207 @@
+"""
+Streaming block compression negotiated between Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+File content is cut into independent blocks, each compressed on its own so
+several worker threads can work on one file while earlier blocks are sent.
+Every block frame starts with its uncompressed length and a stored flag: a
+block that did not shrink travels as is.
+"""
+
+import bz2
+import lzma
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import protocol
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Uncompressed size of each block
+BLOCK_SIZE = 1024 * 1024
+# Largest uncompressed block accepted by the receiver
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+# Leading bytes of a file compressed to decide if compressing it is worth it
+SAMPLE_SIZE = 64 * 1024
+# Files whose sample does not shrink by at least this much are sent as is
+MIN_SAVING = 0.1
+# Block frame prefix: uncompressed length, stored flag
+BLOCK_PREFIX = struct.Struct("!IB")
+STORED = 1
+# Compression worker threads, blocks in flight per file is twice that
+COMPRESS_THREADS = os.cpu_count() or 2
+
+
+def zlib_decompress(data: bytes, length: int) -> bytes:
+    """
+    Decompress a zlib block, never producing more than its announced length
+    :param data: Compressed block
+    :param length: Uncompressed length
+    :return:
+    """
+    return zlib.decompressobj().decompress(data, length)
+
+
+def bz2_decompress(data: bytes, length: int) -> bytes:
+    """
+    Decompress a bz2 block, never producing more than its announced length
+    :param data: Compressed block
+    :param length: Uncompressed length
+    :return:
+    """
+    return bz2.BZ2Decompressor().decompress(data, max_length=length)
+
+
+def lzma_decompress(data: bytes, length: int) -> bytes:
+    """
+    Decompress an lzma block, never producing more than its announced length
+    :param data: Compressed block
+    :param length: Uncompressed length
+    :return:
+    """
+    return lzma.LZMADecompressor().decompress(data, max_length=length)
+
+
+def zstd_compress(data: bytes) -> bytes:
+    """
+    Compress a zstd block
+    :param data: Uncompressed block
+    :return:
+    """
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def zstd_decompress(data: bytes, length: int) -> bytes:
+    """
+    Decompress a zstd block, never producing more than its announced length
+    :param data: Compressed block
+    :param length: Uncompressed length
+    :return:
+    """
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=length)
+
+
+# Codec name: (compress(data), decompress(data, length)), preferred first
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib_decompress),
+    "bz2": (lambda data: bz2.compress(data, 9), bz2_decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), lzma_decompress),
+}
+if zstandard is not None:
+    CODECS = {"zstd": (zstd_compress, zstd_decompress), **CODECS}
+
+# Compression worker pool, created on first use
+compress_executor = None
+compress_executor_lock = Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    The process wide compression worker pool
+    :return:
+    """
+    global compress_executor
+    with compress_executor_lock:
+        if compress_executor is None:
+            compress_executor = ThreadPoolExecutor(max_workers=COMPRESS_THREADS, thread_name_prefix="compress")
+        return compress_executor
+
+
+def accept_codecs(offered: list) -> list:
+    """
+    The offered codecs this side supports, in the order they were offered
+    :param offered: Codec names
+    :return:
+    """
+    return [codec for codec in offered if codec in CODECS]
+
+
+def worth_compressing(codec: str, sample: bytes) -> bool:
+    """
+    Check if the start of a file shrinks enough to compress the whole file
+    (media and archives do not)
+    :param codec: Codec name
+    :param sample: Leading bytes of the file
+    :return:
+    """
+    if not sample:
+        return False
+    return len(CODECS[codec][0](sample)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def compress_block(codec: str, data: bytes) -> bytes:
+    """
+    Build the payload of a block frame
+    :param codec: Codec name
+    :param data: Uncompressed block
+    :return:
+    """
+    compressed = CODECS[codec][0](data)
+    if len(compressed) >= len(data):
+        return BLOCK_PREFIX.pack(len(data), STORED) + data
+    return BLOCK_PREFIX.pack(len(data), 0) + compressed
+
+
+def decompress_block(codec: str, payload: bytes) -> bytes:
+    """
+    Restore the content of a block frame
+    :param codec: Codec name
+    :param payload: Block frame payload
+    :return:
+    """
+    if len(payload) < BLOCK_PREFIX.size:
+        raise protocol.ProtocolError("Truncated block frame")
+    length, flags = BLOCK_PREFIX.unpack_from(payload)
+    if length > MAX_BLOCK_SIZE:
+        raise protocol.ProtocolError(f"Block of {length} bytes is too large")
+    data = memoryview(payload)[BLOCK_PREFIX.size:]
+    if not flags & STORED:
+        try:
+            data = CODECS[codec][1](data, length)
+        except Exception as error:
+            raise protocol.ProtocolError(f"Corrupt {codec} block : {str(error)}")
+    if len(data) != length:
+        raise protocol.ProtocolError(f"Block expands to {len(data)} bytes, expected {length}")
+    return data
+
+
+def compressed_blocks(codec: str, the_file, offset: int, count: int, hasher=None, session=None):
+    """
+    Compress part of a file block by block on the worker pool, reading ahead
+    while earlier blocks are compressed and sent
+    :param codec: Codec name
+    :param the_file: File opened for binary reading
+    :param offset: Position of the first byte
+    :param count: Number of bytes
+    :param hasher: integrity.StreamHasher fed the uncompressed blocks, None to not hash
+    :param session: metrics.SessionMetrics the read time is added to, None to not measure
+    :return: Generator of block frame payloads in file order
+    """
+    executor, pending = get_executor(), deque()
+    position, end = offset, offset + count
+    try:
+        while position < end or pending:
+            # Keep every worker busy without reading the whole file in
+            while position < end and len(pending) < 2 * COMPRESS_THREADS:
+                started = time.perf_counter()
+                data = os.pread(the_file.fileno(), min(BLOCK_SIZE, end - position), position)
+                if session is not None:
+                    session.add("disk_read_seconds", time.perf_counter() - started)
+                if not data:
+                    raise EOFError(f"File shrank by {end - position} bytes while compressing")
+                pending.append(executor.submit(compress_block, codec, data))
+                if hasher is not None:
+                    hasher.update(data)
+                position += len(data)
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
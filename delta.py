@@ -0,0 +1,256 @@
+"""
+rsync-style delta of a changed file against the older copy the receiver holds
+https://wingxel.github.io/website/index.html
+
+The receiver cuts its copy into blocks and sends a weak (Adler-32) and a strong
+(BLAKE2b) checksum of each. The sender slides over its version, finds the
+blocks the receiver already has and sends only block references and the
+literal bytes in between.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+import protocol
+
+# Block size bounds, the size itself follows sqrt(file size) like rsync
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1024 * 1024
+# Most blocks in a signature, keeps it under protocol.MAX_CONTROL_LENGTH
+MAX_BLOCKS = 512 * 1024
+# Signature: size of the receiver copy and block size, then one record per block
+SIGNATURE_HEADER = struct.Struct("!QI")
+BLOCK_SIGNATURE = struct.Struct("!I16s")
+# Delta copy frame: first block index and number of consecutive blocks
+COPY = struct.Struct("!QI")
+# Adler-32 modulus, needed to roll the weak checksum one byte at a time
+ADLER_MOD = 65521
+# Chunk used when copying blocks without copy_file_range
+COPY_CHUNK = 1024 * 1024
+
+
+def block_size_for(size: int) -> int:
+    """
+    Block size used for a copy of the given size
+    :param size: Size of the receiver copy
+    :return:
+    """
+    block = 1 << max(0, math.isqrt(size).bit_length() - 1)
+    block = max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+    while size // block >= MAX_BLOCKS:
+        block *= 2
+    return block
+
+
+def strong_checksum(data) -> bytes:
+    """
+    Strong checksum of a block
+    :param data: Block content
+    :return:
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signature(filename: str) -> bytes:
+    """
+    Block signatures of the receiver copy, one read pass
+    :param filename: Receiver copy absolute path
+    :return: Signature frame payload
+    """
+    size = os.path.getsize(filename)
+    block = block_size_for(size)
+    records = [SIGNATURE_HEADER.pack(size, block)]
+    buffer = memoryview(bytearray(block))
+    with open(filename, "rb", buffering=0) as the_file:
+        while True:
+            read_size = the_file.readinto(buffer)
+            if not read_size:
+                break
+            # Short reads only happen on the last block
+            data = buffer[:read_size]
+            records.append(BLOCK_SIGNATURE.pack(zlib.adler32(data), strong_checksum(data)))
+    return b"".join(records)
+
+
+def parse_signature(payload: bytes) -> dict:
+    """
+    Index a signature for lookups by weak checksum
+    :param payload: Signature frame payload
+    :return: {"size", "block", "blocks", "weak": {weak: [(strong, index)]},
+              "tail": (index, length, weak, strong) or None}
+    """
+    if len(payload) < SIGNATURE_HEADER.size or (len(payload) - SIGNATURE_HEADER.size) % BLOCK_SIGNATURE.size:
+        raise protocol.ProtocolError("Invalid signature frame")
+    size, block = SIGNATURE_HEADER.unpack_from(payload)
+    count = (len(payload) - SIGNATURE_HEADER.size) // BLOCK_SIGNATURE.size
+    if block == 0 or count != (size + block - 1) // block:
+        raise protocol.ProtocolError("Signature does not cover the receiver copy")
+    weak_index, tail = {}, None
+    for index in range(count):
+        weak, strong = BLOCK_SIGNATURE.unpack_from(payload, SIGNATURE_HEADER.size + index * BLOCK_SIGNATURE.size)
+        length = min(block, size - index * block)
+        if length == block:
+            weak_index.setdefault(weak, []).append((strong, index))
+        else:
+            tail = (index, length, weak, strong)
+    return {"size": size, "block": block, "blocks": count, "weak": weak_index, "tail": tail}
+
+
+def find_block(signature: dict, weak: int, data, expected: int = -1) -> int:
+    """
+    Index of a receiver block with the same content
+    :param signature: Parsed signature
+    :param weak: Weak checksum of data
+    :param data: Candidate block content
+    :param expected: Block following the previous match, preferred among equal
+                     blocks (repeated content) so references stay consecutive
+    :return: Block index or -1
+    """
+    candidates = signature["weak"].get(weak)
+    if candidates:
+        strong, found = strong_checksum(data), -1
+        for candidate, index in candidates:
+            if candidate == strong:
+                if index == expected:
+                    return index
+                if found < 0:
+                    found = index
+        return found
+    return -1
+
+
+def roll(signature: dict, view: memoryview, position: int, expected: int = -1) -> tuple:
+    """
+    Slide the block window one byte at a time from position until it lines
+    up with a receiver block again (data inserted or removed)
+    :param signature: Parsed signature
+    :param view: Sender file content
+    :param position: Start of the window that did not match
+    :param expected: Block following the previous match, see find_block
+    :return: (window start, block index) or (-1, -1) if nothing lines up within one block
+    """
+    block, weak_index = signature["block"], signature["weak"]
+    checksum = zlib.adler32(view[position:position + block])
+    low, high = checksum & 0xFFFF, checksum >> 16
+    for start in range(position + 1, min(position + block, len(view) - block + 1)):
+        outgoing, incoming = view[start - 1], view[start + block - 1]
+        low = (low - outgoing + incoming) % ADLER_MOD
+        high = (high - block * outgoing + low - 1) % ADLER_MOD
+        weak = (high << 16) | low
+        if weak in weak_index:
+            index = find_block(signature, weak, view[start:start + block], expected)
+            if index >= 0:
+                return start, index
+    return -1, -1
+
+
+def add_copy(operations: list, index: int, count: int = 1) -> None:
+    """
+    Append a block reference, merged with the previous one when consecutive
+    :param operations: Delta operations
+    :param index: First block index
+    :param count: Number of blocks
+    :return:
+    """
+    if operations and operations[-1][0] == "copy" and operations[-1][1] + operations[-1][2] == index:
+        operations[-1] = ("copy", operations[-1][1], operations[-1][2] + count)
+    else:
+        operations.append(("copy", index, count))
+
+
+def compute_delta(filename: str, signature: dict) -> list:
+    """
+    Express a file as receiver blocks plus literal byte ranges
+    :param filename: Sender file absolute path
+    :param signature: Parsed receiver signature
+    :return: List of ("copy", first block, block count) and ("literal", start, end)
+             operations, empty if the receiver copy is identical (or the file is empty)
+    """
+    block, operations = signature["block"], []
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+    with open(filename, "rb") as the_file, mmap.mmap(the_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        # expected is the block after the previous match
+        position, literal_start, expected = 0, 0, 0
+        # Sliding byte by byte is slow in Python: only try it right after a
+        # match is lost, then after 1, 2, 4, ... missed blocks
+        misses, roll_at, roll_gap = 0, 0, 1
+        try:
+            while position + block <= size:
+                data = view[position:position + block]
+                index = find_block(signature, zlib.adler32(data), data, expected)
+                if index < 0 and misses == roll_at:
+                    start, index = roll(signature, view, position, expected)
+                    if index >= 0:
+                        position = start
+                    else:
+                        roll_at, roll_gap = roll_at + roll_gap, roll_gap * 2
+                if index >= 0:
+                    if literal_start < position:
+                        operations.append(("literal", literal_start, position))
+                    add_copy(operations, index)
+                    expected = index + 1
+                    position += block
+                    literal_start, misses, roll_at, roll_gap = position, 0, 0, 1
+                else:
+                    position += block
+                    misses += 1
+            # The receiver short last block can only match the end of the file
+            tail = signature["tail"]
+            if tail is not None and size - literal_start >= tail[1]:
+                data = view[size - tail[1]:size]
+                if zlib.adler32(data) == tail[2] and strong_checksum(data) == tail[3]:
+                    if literal_start < size - tail[1]:
+                        operations.append(("literal", literal_start, size - tail[1]))
+                    add_copy(operations, tail[0])
+                    literal_start = size
+            if literal_start < size:
+                operations.append(("literal", literal_start, size))
+        finally:
+            # The map cannot close while views of it are alive
+            data = None
+            view.release()
+    if size == signature["size"] and operations == [("copy", 0, signature["blocks"])]:
+        return []
+    return operations
+
+
+def copy_blocks(old_fd: int, new_fd: int, signature: tuple, first: int, count: int) -> None:
+    """
+    Append blocks of the old copy to the new file, in kernel when possible
+    :param old_fd: Receiver copy opened for reading
+    :param new_fd: New file opened for writing at its current position
+    :param signature: (receiver copy size, block size)
+    :param first: First block index
+    :param count: Number of blocks
+    :return:
+    """
+    size, block = signature
+    offset = first * block
+    if count == 0 or offset >= size:
+        raise protocol.ProtocolError(f"Delta copy of blocks {first}+{count} outside the receiver copy")
+    length = min(count * block, size - offset)
+    while length > 0:
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(old_fd, new_fd, length, offset)
+            except OSError:
+                copied = 0
+        else:
+            copied = 0
+        if copied == 0:
+            data = os.pread(old_fd, min(length, COPY_CHUNK), offset)
+            if not data:
+                raise EOFError("Receiver copy shrank while applying a delta")
+            view, written = memoryview(data), 0
+            while written < len(view):
+                written += os.write(new_fd, view[written:])
+            copied = len(data)
+        offset += copied
+        length -= copied
@@ -0,0 +1,179 @@
+"""
+Fan-out - every file read once and sent to several receivers
+https://wingxel.github.io/website/index.html
+
+The connections to the receivers walk the same manifest, each at its own
+pace. File content is read in chunks that are kept until every connection
+went past them: the fastest connection reads, the others take the chunks
+from memory. A connection that falls more than max_lag bytes behind the
+fastest one stops holding chunks back and reads what it needs itself until
+it catches up, so a slow receiver only ever slows down its own connection.
+"""
+
+import heapq
+import os
+import time
+from threading import Event, Lock
+
+import metrics
+import send_engine
+
+# Size of each shared chunk
+CHUNK_SIZE = send_engine.BUFFER_SIZE
+# Bytes a connection may fall behind the fastest one and still share its reads
+DEFAULT_MAX_LAG = 64 * 1024 * 1024
+
+
+class SharedManifest:
+    def __init__(self, manifest, max_lag: int = DEFAULT_MAX_LAG) -> None:
+        """
+        Manifest and file chunks shared by the connections to every receiver
+        :param manifest: Iterable of (metadata, absolute file path)
+        :param max_lag: Bytes a connection may fall behind and still share chunks
+        """
+        self.max_lag = max(CHUNK_SIZE, max_lag)
+        self.__manifest, self.__manifest_lock = iter(manifest), Lock()
+        # (metadata, absolute file path, position of the file in the whole stream) in manifest order
+        self.__files, self.__stream_size = [], 0
+        self.__lock = Lock()
+        # Chunks by (file index, chunk number), chunk ends to evict them in order, chunks being read
+        self.__chunks, self.__ends, self.__loading = {}, [], {}
+        # Stream position of each connection still sharing chunks, furthest position read
+        self.__cursors, self.__head = {}, 0
+        # Bytes read from disk, for the read-once ratio
+        self.disk_bytes = 0
+
+    def file(self, index: int):
+        """
+        File at a manifest position, the manifest is consumed as connections reach it
+        :param index: Manifest position
+        :return: (metadata, absolute file path) or None past the end
+        """
+        with self.__manifest_lock:
+            while len(self.__files) <= index:
+                item = next(self.__manifest, None)
+                if item is None:
+                    return None
+                self.__files.append((item[0], item[1], self.__stream_size))
+                self.__stream_size += item[0]["size"]
+            return self.__files[index][:2]
+
+    def advance(self, connection, index: int, offset: int = 0) -> None:
+        """
+        Move a connection to a file position, chunks before it are not needed by it any more
+        :param connection: Key of the connection
+        :param index: Manifest position of the file
+        :param offset: Position in the file
+        :return:
+        """
+        with self.__lock:
+            self.__attach(connection, self.__files[index][2] + offset)
+            self.__evict()
+
+    def leave(self, connection) -> None:
+        """
+        A connection is done (or failed), it holds no chunk back any more
+        :param connection: Key of the connection
+        :return:
+        """
+        with self.__lock:
+            self.__cursors.pop(connection, None)
+            self.__evict()
+
+    def chunk(self, connection, index: int, number: int) -> bytes:
+        """
+        Content of a file chunk, from memory when another connection read it already
+        :param connection: Key of the connection
+        :param index: Manifest position of the file
+        :param number: Chunk number in the file
+        :return:
+        """
+        metadata, filename, start = self.__files[index]
+        offset = number * CHUNK_SIZE
+        size, position = min(CHUNK_SIZE, metadata["size"] - offset), start + offset
+        key = (index, number)
+        while True:
+            with self.__lock:
+                data = self.__chunks.get(key)
+                if data is not None:
+                    self.__attach(connection, position)
+                    self.__evict()
+                    return data
+                loading = self.__loading.get(key)
+                shared = loading is None and position >= self.__head - self.max_lag
+                if shared:
+                    self.__loading[key] = Event()
+                elif loading is None:
+                    # Evicted long ago, a private read does not hold anyone back
+                    self.__cursors.pop(connection, None)
+            if loading is not None:
+                # Another connection is reading it
+                loading.wait()
+                continue
+            try:
+                data = self.__read(connection, filename, offset, size)
+            finally:
+                if shared:
+                    with self.__lock:
+                        self.__loading.pop(key).set()
+                        if data is not None:
+                            self.__store(connection, key, position, data)
+            return data
+
+    def __read(self, connection, filename: str, offset: int, size: int) -> bytes:
+        """
+        Read a chunk from disk
+        :param connection: Key of the connection, its socket, charged the read time
+        :param filename: File absolute path
+        :param offset: Position of the chunk in the file
+        :param size: Chunk size
+        :return:
+        """
+        started = time.perf_counter()
+        with open(filename, "rb", buffering=0) as the_file:
+            data = os.pread(the_file.fileno(), size, offset)
+        metrics.session_for(connection).add("disk_read_seconds", time.perf_counter() - started)
+        if len(data) != size:
+            raise EOFError(f"File shrank while sending ({offset + len(data)} bytes left of {filename})")
+        with self.__lock:
+            self.disk_bytes += size
+        return data
+
+    def __store(self, connection, key: tuple, position: int, data: bytes) -> None:
+        """
+        Keep a chunk read from disk for the other connections (lock held)
+        :param connection: Key of the connection that read it
+        :param key: (file index, chunk number)
+        :param position: Stream position of the chunk
+        :param data: Chunk content
+        :return:
+        """
+        self.__chunks[key] = data
+        heapq.heappush(self.__ends, (position + len(data), key))
+        self.__head = max(self.__head, position + len(data))
+        self.__attach(connection, position)
+        self.__evict()
+
+    def __attach(self, connection, position: int) -> None:
+        """
+        Record a connection position, it shares chunks only while within max_lag of the head (lock held)
+        :param connection: Key of the connection
+        :param position: Stream position
+        :return:
+        """
+        if position >= self.__head - self.max_lag:
+            self.__cursors[connection] = position
+        else:
+            self.__cursors.pop(connection, None)
+
+    def __evict(self) -> None:
+        """
+        Drop the connections too far behind, then the chunks every connection went past (lock held)
+        :return:
+        """
+        for connection in [key for key, value in self.__cursors.items() if value < self.__head - self.max_lag]:
+            del self.__cursors[connection]
+        tail = min(self.__cursors.values(), default=self.__head)
+        while self.__ends and self.__ends[0][0] <= tail:
+            _, key = heapq.heappop(self.__ends)
+            del self.__chunks[key]
@@ -0,0 +1,115 @@
+"""
+Streaming content digests checked end to end by Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+Content is hashed as it passes through, never read a second time: the
+Sender hashes the chunks it sends and the Receiver the chunks it writes.
+The Sender announces the hash before the content and sends the digest right
+after it; a file whose digests differ is not kept and is sent again.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Hash name: constructor, preferred first
+HASHES = {
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+}
+if xxhash is not None:
+    HASHES = {"xxh3_128": xxhash.xxh3_128, **HASHES}
+# Times a file whose digests differ is sent again before giving up
+VERIFY_RETRIES = 2
+# Sender hashing threads, chunks of one file are hashed in order
+HASH_THREADS = min(4, os.cpu_count() or 2)
+
+# Hashing worker pool, created on first use
+hash_executor = None
+hash_executor_lock = Lock()
+
+
+class DigestMismatch(Exception):
+    """
+    Raised when received content does not match the digest the Sender computed
+    """
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    The process wide hashing worker pool
+    :return:
+    """
+    global hash_executor
+    with hash_executor_lock:
+        if hash_executor is None:
+            hash_executor = ThreadPoolExecutor(max_workers=HASH_THREADS, thread_name_prefix="hash")
+        return hash_executor
+
+
+def accept_hashes(offered: list) -> list:
+    """
+    The offered hashes this side supports, in the order they were offered
+    :param offered: Hash names
+    :return:
+    """
+    return [name for name in offered if name in HASHES]
+
+
+def new_hash(name: str):
+    """
+    Start a digest
+    :param name: Key of HASHES
+    :return: Object with update(data) and digest()
+    """
+    return HASHES[name]()
+
+
+def digest_of(name: str, data) -> bytes:
+    """
+    Digest of content held in memory
+    :param name: Key of HASHES
+    :param data: Content
+    :return:
+    """
+    hasher = new_hash(name)
+    hasher.update(data)
+    return hasher.digest()
+
+
+class StreamHasher:
+    def __init__(self, name: str) -> None:
+        """
+        Digest updated on the hashing pool while the caller keeps sending,
+        one chunk in flight at a time so chunks are hashed in order
+        :param name: Key of HASHES
+        """
+        self.name = name
+        self.__hasher = new_hash(name)
+        self.__pending = None
+
+    def update(self, data) -> None:
+        """
+        Hash the next chunk in the background, the previous chunk (and its
+        buffer) is released once this returns
+        :param data: Chunk, left untouched until the next update or digest call
+        :return:
+        """
+        if self.__pending is not None:
+            self.__pending.result()
+        self.__pending = get_executor().submit(self.__hasher.update, data)
+
+    def digest(self) -> bytes:
+        """
+        Wait for the last chunk and return the digest
+        :return:
+        """
+        if self.__pending is not None:
+            self.__pending.result()
+            self.__pending = None
+        return self.__hasher.digest()
@@ -0,0 +1,290 @@
+"""
+Transfer metrics shared by Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+Every connection is a session with its own counters (plain additions under
+an uncontended lock). Snapshots of all sessions can be written periodically
+as JSON lines and, on the Receiver, served as Prometheus text over HTTP.
+"""
+
+import json
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+
+import util
+
+# Counters of every session, see SessionMetrics.add
+COUNTERS = {
+    "files_sent": "Files sent whole or resumed",
+    "files_received": "Files received whole or resumed",
+    "files_skipped": "Files the receiver already had",
+    "files_resumed": "Files resumed from a partial copy",
+    "files_delta": "Files updated from a delta",
+    "files_retried": "Files sent again because their content did not match its digest",
+    "bytes_sent": "Payload bytes sent",
+    "bytes_received": "Payload bytes received",
+    "hole_bytes": "Bytes of sparse file holes that were not sent",
+    "handshake_seconds": "Time spent on descriptions, replies and acknowledgements",
+    "payload_seconds": "Time spent moving file content",
+    "disk_read_seconds": "Time spent reading source files outside sendfile",
+    "disk_wait_seconds": "Time the network side waited for disk writes to catch up",
+}
+# Highest values seen, see SessionMetrics.peak
+PEAKS = {
+    "write_queue_peak": "Most chunks queued for a writer thread",
+}
+# Per-file records waiting for the stats writer, dropped when it falls behind
+FILE_RECORDS_SIZE = 10000
+
+# Sessions by id and totals of the finished ones by role
+sessions = {}
+finished = {}
+sessions_lock = Lock()
+# Sessions keyed by the sending socket, so Sender functions find theirs
+socket_sessions = {}
+# Per-file records, None until a stats file is configured
+file_records = None
+
+
+class SessionMetrics:
+    def __init__(self, role: str, peer: str) -> None:
+        """
+        Counters of one connection
+        :param role: sender or receiver
+        :param peer: Address of the other end
+        """
+        self.role, self.peer, self.started = role, peer, time.time()
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.values.update(dict.fromkeys(PEAKS, 0))
+        self.__lock = Lock()
+
+    def add(self, name: str, value=1) -> None:
+        """
+        Increase a counter
+        :param name: Key of COUNTERS
+        :param value: Amount
+        :return:
+        """
+        with self.__lock:
+            self.values[name] += value
+
+    def peak(self, name: str, value) -> None:
+        """
+        Keep the highest value of a gauge
+        :param name: Key of PEAKS
+        :param value: Current value
+        :return:
+        """
+        if value > self.values[name]:
+            with self.__lock:
+                self.values[name] = max(self.values[name], value)
+
+    def file_done(self, name: list, size: int, handshake: float, payload: float, how: str) -> None:
+        """
+        Account for one file and queue its record for the stats file
+        :param name: File name parts
+        :param size: Payload bytes moved
+        :param handshake: Seconds spent on the control exchange
+        :param payload: Seconds spent moving the content
+        :param how: How the content travelled (sendfile, buffered, codec, delta, bundle...)
+        :return:
+        """
+        with self.__lock:
+            self.values["handshake_seconds"] += handshake
+            self.values["payload_seconds"] += payload
+        if file_records is not None:
+            try:
+                file_records.put_nowait({
+                    "time": time.time(), "event": "file", "role": self.role, "peer": self.peer,
+                    "name": "/".join(name), "size": size, "handshake": round(handshake, 6),
+                    "payload": round(payload, 6), "how": how
+                })
+            except Full:
+                pass
+
+    def snapshot(self) -> dict:
+        """
+        Current values with rates
+        :return:
+        """
+        with self.__lock:
+            values = dict(self.values)
+        elapsed = max(time.time() - self.started, 1e-9)
+        moved = values["bytes_sent"] + values["bytes_received"]
+        return {
+            "role": self.role, "peer": self.peer, "elapsed": round(elapsed, 3),
+            "bytes_per_second": round(moved / elapsed), **values
+        }
+
+
+def start_session(role: str, peer, connection_socket=None) -> SessionMetrics:
+    """
+    Register a new session
+    :param role: sender or receiver
+    :param peer: Address of the other end
+    :param connection_socket: Socket the Sender functions will look the session up by
+    :return:
+    """
+    session = SessionMetrics(role, str(peer))
+    with sessions_lock:
+        sessions[id(session)] = session
+        if connection_socket is not None:
+            socket_sessions[connection_socket] = session
+    return session
+
+
+def end_session(session: SessionMetrics) -> None:
+    """
+    Fold a finished session into the totals of its role
+    :param session: The session
+    :return:
+    """
+    with sessions_lock:
+        if sessions.pop(id(session), None) is None:
+            return
+        for connection_socket in [key for key, value in socket_sessions.items() if value is session]:
+            del socket_sessions[connection_socket]
+        totals = finished.setdefault(session.role, dict.fromkeys(list(COUNTERS) + list(PEAKS) + ["sessions"], 0))
+        totals["sessions"] += 1
+        for name, value in session.values.items():
+            totals[name] = max(totals[name], value) if name in PEAKS else totals[name] + value
+
+
+def session_for(connection_socket) -> SessionMetrics:
+    """
+    Session of a Sender socket, a detached one if the socket was never registered
+    :param connection_socket: Connection to the receiver
+    :return:
+    """
+    session = socket_sessions.get(connection_socket)
+    if session is None:
+        session = SessionMetrics("sender", "unregistered")
+    return session
+
+
+def snapshot() -> dict:
+    """
+    Every active session and the totals per role, finished sessions included
+    :return:
+    """
+    with sessions_lock:
+        active = list(sessions.values())
+        totals = {role: dict(values) for role, values in finished.items()}
+    active_snapshots = [session.snapshot() for session in active]
+    for session in active_snapshots:
+        role_totals = totals.setdefault(
+            session["role"], dict.fromkeys(list(COUNTERS) + list(PEAKS) + ["sessions"], 0)
+        )
+        for name in list(COUNTERS) + list(PEAKS):
+            role_totals[name] = max(role_totals[name], session[name]) if name in PEAKS else \
+                role_totals[name] + session[name]
+    return {"time": time.time(), "event": "stats", "active": len(active), "sessions": active_snapshots,
+            "totals": totals}
+
+
+def prometheus_text() -> str:
+    """
+    Totals in the Prometheus text exposition format
+    :return:
+    """
+    state = snapshot()
+    lines = ["# HELP sendfiles_active_sessions Connections being served",
+             "# TYPE sendfiles_active_sessions gauge", f"sendfiles_active_sessions {state['active']}"]
+    for name, help_text in list(COUNTERS.items()) + list(PEAKS.items()):
+        metric = f"sendfiles_{name}" + ("_total" if name in COUNTERS else "")
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {'counter' if name in COUNTERS else 'gauge'}")
+        for role, values in sorted(state["totals"].items()):
+            lines.append(f'{metric}{{role="{role}"}} {values[name]}')
+    return "\n".join(lines) + "\n"
+
+
+class StatsWriter:
+    def __init__(self, stats_file: str, interval: float) -> None:
+        """
+        Background thread appending a snapshot (and the per-file records
+        queued since the last one) to a JSON-lines file every interval
+        :param stats_file: JSON-lines file path
+        :param interval: Seconds between snapshots
+        """
+        global file_records
+        file_records = Queue(maxsize=FILE_RECORDS_SIZE)
+        self.stats_file, self.interval = stats_file, interval
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__run, name="stats", daemon=True)
+        self.__thread.start()
+
+    def write(self) -> None:
+        """
+        Append the queued file records and a snapshot
+        :return:
+        """
+        lines = []
+        while True:
+            try:
+                lines.append(json.dumps(file_records.get_nowait()))
+            except Empty:
+                break
+        lines.append(json.dumps(snapshot()))
+        try:
+            with open(self.stats_file, "a") as stats:
+                stats.write("\n".join(lines) + "\n")
+        except OSError as error:
+            util.log_error(f"Cannot write stats : {str(error)}")
+
+    def __run(self) -> None:
+        """
+        Write every interval until stopped
+        :return:
+        """
+        while not self.__stop.wait(self.interval):
+            self.write()
+
+    def close(self) -> None:
+        """
+        Stop and write a last snapshot
+        :return:
+        """
+        self.__stop.set()
+        self.__thread.join(timeout=5)
+        self.write()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        """
+        Serve the Prometheus text on /metrics
+        :return:
+        """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        """
+        Scrapes are not logged
+        :return:
+        """
+
+
+def serve_metrics(port: int, address: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serve /metrics from a background thread
+    :param port: HTTP port
+    :param address: Listening address, local only by default
+    :return: The running server
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"{datetime.now()} : Metrics at http://{address}:{port}/metrics")
+    return server
@@ -0,0 +1,437 @@
+"""
+Length-prefixed binary framing shared by Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+Every message is a fixed 12 byte header followed by its payload:
+    magic (2s) | version (B) | message type (B) | payload length (Q)
+Only the header is parsed here, payloads are left in the socket for the
+caller to stream (file data) or read whole (small control messages).
+"""
+
+import struct
+from socket import socket
+
+# Frame header magic and protocol version
+MAGIC = b"SF"
+VERSION = 1
+HEADER = struct.Struct("!2sBBQ")
+
+# Message types
+HEAD = 1  # File description (see encode_entry)
+OK = 2  # Receiver wants the described file
+NOT = 3  # Receiver skips the described file
+NEXT = 4  # Receiver stored the file, send the next one
+DATA = 5  # File content, payload length is the number of bytes that follow
+MANIFEST = 6  # Batch of file descriptions (see encode_entries)
+MANIFEST_END = 7  # The manifest is complete
+WANT = 8  # Bitmap of the manifest files the receiver wants (see encode_bitmap)
+BUNDLE = 9  # File count then the packed content of that many wanted files
+STRIPE = 10  # Token then a file description, its content comes as range frames
+RANGE = 11  # Token, offset then part of a striped file, on any connection
+STRIPE_END = 12  # Token, every range of the striped file was sent
+RESUME = 13  # Receiver holds part of the described file (see encode_resume)
+SYNC = 14  # File description, the sender can send a delta if the receiver has an older copy
+SIGNATURE = 15  # Block signatures of the receiver copy (see delta.file_signature)
+DELTA_COPY = 16  # First block index and block count to copy from the receiver copy
+DELTA_DATA = 17  # Literal bytes of the new file, payload length is the number of bytes that follow
+DELTA_END = 18  # Every delta operation was sent
+HELLO = 19  # Capabilities (compression codecs) offered by the sender, answered with the accepted ones
+COMPRESSED = 20  # Content length and codec, the content follows as block frames (see compress)
+BLOCK = 21  # One compressed (or stored) block of file content
+HASHES = 22  # Content hashes offered by the sender, answered with the accepted ones
+VERIFY = 23  # Hash name, the next content frame is followed by a digest frame (see integrity)
+DIGEST = 24  # Digest of the content that was just sent
+RETRY = 25  # Content did not match its digest, send it again (bitmap of manifest files after a batch)
+SPARSE = 26  # Content length and its data extents, only the extents follow as a data frame (see sparse)
+
+FRAME_NAMES = {
+    HEAD: "head", OK: "ok", NOT: "not", NEXT: "next", DATA: "data",
+    MANIFEST: "manifest", MANIFEST_END: "manifest_end", WANT: "want", BUNDLE: "bundle",
+    STRIPE: "stripe", RANGE: "range", STRIPE_END: "stripe_end", RESUME: "resume",
+    SYNC: "sync", SIGNATURE: "signature", DELTA_COPY: "delta_copy", DELTA_DATA: "delta_data",
+    DELTA_END: "delta_end", HELLO: "hello", COMPRESSED: "compressed", BLOCK: "block",
+    HASHES: "hashes", VERIFY: "verify", DIGEST: "digest", RETRY: "retry",
+    SPARSE: "sparse"
+}
+
+# Largest control frame payload accepted by recv_frame
+MAX_CONTROL_LENGTH = 16 * 1024 * 1024
+# File description: size, size_d, then the name parts joined by NUL
+ENTRY = struct.Struct("!QQ")
+NAME_SEPARATOR = b"\0"
+# Length prefix of each description inside a manifest frame
+ENTRY_LENGTH = struct.Struct("!I")
+# Number of files packed in a bundle frame, their sizes come from the manifest
+BUNDLE_COUNT = struct.Struct("!I")
+# Largest bundle frame accepted by the receiver
+MAX_BUNDLE_LENGTH = 64 * 1024 * 1024
+# Striped file token and the range frame prefix (token, offset)
+TOKEN_SIZE = 16
+RANGE_PREFIX = struct.Struct(f"!{TOKEN_SIZE}sQ")
+# Bytes already held, then an optional digest of them
+RESUME_OFFSET = struct.Struct("!Q")
+# Want frame resume record: manifest index, bytes held, digest length
+WANT_RESUME = struct.Struct("!IQB")
+# Names the receiver keeps its partial files and their markers under, never valid file names
+PART_SUFFIX = ".sendfiles-part"
+MARKER_SUFFIX = ".sendfiles-size"
+# Compressed content: uncompressed length, then the codec name
+COMPRESSED_LENGTH = struct.Struct("!Q")
+# Sparse content: length (holes included), then one (offset, length) per data extent
+SPARSE_LENGTH = struct.Struct("!Q")
+EXTENT = struct.Struct("!QQ")
+# Most data extents a sparse frame can hold
+MAX_EXTENTS = (MAX_CONTROL_LENGTH - SPARSE_LENGTH.size) // EXTENT.size
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends something that is not a valid frame
+    """
+
+
+def pack_header(message_type: int, length: int = 0) -> bytes:
+    """
+    Build a frame header
+    :param message_type: One of the message type constants
+    :param length: Payload length in bytes
+    :return:
+    """
+    return HEADER.pack(MAGIC, VERSION, message_type, length)
+
+
+def send_header(connection_socket: socket, message_type: int, length: int) -> None:
+    """
+    Send a frame header only, the caller streams the payload afterwards
+    :param connection_socket: Connection to the peer
+    :param message_type: One of the message type constants
+    :param length: Payload length in bytes
+    :return:
+    """
+    connection_socket.sendall(pack_header(message_type, length))
+
+
+def send_frame(connection_socket: socket, message_type: int, payload: bytes = b"") -> None:
+    """
+    Send a complete (small) frame
+    :param connection_socket: Connection to the peer
+    :param message_type: One of the message type constants
+    :param payload: Frame payload
+    :return:
+    """
+    connection_socket.sendall(pack_header(message_type, len(payload)) + payload)
+
+
+def recv_exact_into(connection_socket: socket, view: memoryview) -> None:
+    """
+    Fill the whole view from the socket
+    :param connection_socket: Connection to the peer
+    :param view: Writable buffer to fill
+    :return:
+    """
+    received = 0
+    while received < len(view):
+        size = connection_socket.recv_into(view[received:])
+        if size == 0:
+            raise ConnectionError(f"Connection closed after {received} of {len(view)} bytes")
+        received += size
+
+
+def recv_exact(connection_socket: socket, length: int) -> bytearray:
+    """
+    Receive exactly length bytes
+    :param connection_socket: Connection to the peer
+    :param length: Number of bytes to receive
+    :return:
+    """
+    data = bytearray(length)
+    recv_exact_into(connection_socket, memoryview(data))
+    return data
+
+
+def parse_header(header: bytes) -> tuple:
+    """
+    Validate and unpack a frame header
+    :param header: HEADER.size bytes
+    :return: (message type, payload length)
+    """
+    magic, version, message_type, length = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return message_type, length
+
+
+def recv_header(connection_socket: socket, header_buffer: bytearray = None):
+    """
+    Receive the next frame header
+    :param connection_socket: Connection to the peer
+    :param header_buffer: Optional reusable HEADER.size buffer
+    :return: (message type, payload length) or None if the peer closed the
+             connection between frames
+    """
+    if header_buffer is None:
+        header_buffer = bytearray(HEADER.size)
+    view = memoryview(header_buffer)
+    first = connection_socket.recv_into(view)
+    if first == 0:
+        return None
+    recv_exact_into(connection_socket, view[first:])
+    return parse_header(header_buffer)
+
+
+def expect_header(connection_socket: socket, *expected: int) -> tuple:
+    """
+    Receive the next frame header and check its type
+    :param connection_socket: Connection to the peer
+    :param expected: Accepted message types, any type if not provided
+    :return: (message type, payload length)
+    """
+    return check_frame(recv_header(connection_socket), *expected)
+
+
+def check_frame(frame, *expected: int) -> tuple:
+    """
+    Check a received frame header against the accepted message types
+    :param frame: (message type, payload length) or None if the peer closed the connection
+    :param expected: Accepted message types, any type if not provided
+    :return: (message type, payload length)
+    """
+    if frame is None:
+        raise ConnectionError("Connection closed by peer")
+    if expected and frame[0] not in expected:
+        raise ProtocolError(f"Unexpected {FRAME_NAMES.get(frame[0], frame[0])} frame")
+    return frame
+
+
+def recv_frame(connection_socket: socket, *expected: int) -> tuple:
+    """
+    Receive a complete control frame
+    :param connection_socket: Connection to the peer
+    :param expected: Accepted message types, any type if not provided
+    :return: (message type, payload)
+    """
+    message_type, length = expect_header(connection_socket, *expected)
+    return message_type, recv_payload(connection_socket, length)
+
+
+def recv_payload(connection_socket: socket, length: int) -> bytearray:
+    """
+    Receive the payload of a control frame whose header was already read
+    :param connection_socket: Connection to the peer
+    :param length: Payload length from the header
+    :return:
+    """
+    if length > MAX_CONTROL_LENGTH:
+        raise ProtocolError(f"Control frame too large ({length} bytes)")
+    return recv_exact(connection_socket, length)
+
+
+def encode_entry(name: list, size: int, size_d: int) -> bytes:
+    """
+    Encode a file description
+    :param name: Path parts relative to the sent item [folder, sub-folder, file.ext]
+    :param size: File size
+    :param size_d: Size of the whole item (folder) the file belongs to, 0 if not known
+    :return:
+    """
+    return ENTRY.pack(size, size_d) + NAME_SEPARATOR.join(part.encode() for part in name)
+
+
+def is_reserved(name: str) -> bool:
+    """
+    If a name is one the receiver uses for a partial file or its marker
+    :param name: File name
+    :return:
+    """
+    return name.endswith(PART_SUFFIX) or name.endswith(MARKER_SUFFIX)
+
+
+def decode_entry(payload: bytes) -> dict:
+    """
+    Decode a file description, refusing names that escape the save folder or
+    that the receiver reserves for partial files
+    :param payload: Bytes produced by encode_entry
+    :return: {"name": [...], "size": int, "size_d": int}
+    """
+    if len(payload) <= ENTRY.size:
+        raise ProtocolError("File description without a name")
+    size, size_d = ENTRY.unpack_from(payload)
+    name = bytes(payload[ENTRY.size:]).decode().split(NAME_SEPARATOR.decode())
+    for part in name:
+        if part in ("", ".", "..") or "/" in part or "\\" in part or is_reserved(part):
+            raise ProtocolError(f"Invalid file name part {part!r}")
+    return {"name": name, "size": size, "size_d": size_d}
+
+
+def encode_entries(entries: list) -> bytes:
+    """
+    Pack encoded file descriptions into one manifest frame payload
+    :param entries: Descriptions produced by encode_entry
+    :return:
+    """
+    return b"".join(ENTRY_LENGTH.pack(len(entry)) + entry for entry in entries)
+
+
+def decode_entries(payload: bytes) -> list:
+    """
+    Unpack a manifest frame payload
+    :param payload: Bytes produced by encode_entries
+    :return: List of decoded file descriptions
+    """
+    entries, view, position = [], memoryview(payload), 0
+    while position < len(view):
+        if position + ENTRY_LENGTH.size > len(view):
+            raise ProtocolError("Truncated manifest frame")
+        length, = ENTRY_LENGTH.unpack_from(view, position)
+        position += ENTRY_LENGTH.size
+        if position + length > len(view):
+            raise ProtocolError("Truncated manifest frame")
+        entries.append(decode_entry(view[position:position + length]))
+        position += length
+    return entries
+
+
+def encode_resume(offset: int, digest: bytes = b"") -> bytes:
+    """
+    Encode what the receiver already holds of a file
+    :param offset: Number of bytes held
+    :param digest: Optional digest of those bytes
+    :return:
+    """
+    return RESUME_OFFSET.pack(offset) + digest
+
+
+def decode_resume(payload: bytes) -> tuple:
+    """
+    Decode a resume frame payload
+    :param payload: Bytes produced by encode_resume
+    :return: (offset, digest)
+    """
+    if len(payload) < RESUME_OFFSET.size:
+        raise ProtocolError("Truncated resume frame")
+    return RESUME_OFFSET.unpack_from(payload)[0], bytes(payload[RESUME_OFFSET.size:])
+
+
+def encode_want(wanted: list, resumes: dict) -> bytes:
+    """
+    Encode the wanted files of a manifest
+    :param wanted: One boolean per manifest entry
+    :param resumes: {manifest index: (offset, digest)} for the partially held files
+    :return: Bitmap followed by one resume record per partial file
+    """
+    return encode_bitmap(wanted) + b"".join(
+        WANT_RESUME.pack(index, offset, len(digest)) + digest for index, (offset, digest) in resumes.items()
+    )
+
+
+def decode_want(payload: bytes, count: int) -> tuple:
+    """
+    Decode a want frame payload
+    :param payload: Bytes produced by encode_want
+    :param count: Number of manifest entries
+    :return: (wanted, resumes) as given to encode_want
+    """
+    size = (count + 7) // 8
+    wanted, resumes, position, view = decode_bitmap(payload[:size], count), {}, size, memoryview(payload)
+    while position < len(view):
+        if position + WANT_RESUME.size > len(view):
+            raise ProtocolError("Truncated want frame")
+        index, offset, digest_size = WANT_RESUME.unpack_from(view, position)
+        position += WANT_RESUME.size
+        if index >= count or position + digest_size > len(view):
+            raise ProtocolError("Invalid want frame resume record")
+        resumes[index] = (offset, bytes(view[position:position + digest_size]))
+        position += digest_size
+    return wanted, resumes
+
+
+def encode_names(names: list) -> bytes:
+    """
+    Encode a list of capability names (hello frame payload)
+    :param names: ASCII names
+    :return:
+    """
+    return NAME_SEPARATOR.join(name.encode("ascii") for name in names)
+
+
+def decode_names(payload: bytes) -> list:
+    """
+    Decode a list of capability names
+    :param payload: Bytes produced by encode_names
+    :return:
+    """
+    try:
+        return [name.decode("ascii") for name in bytes(payload).split(NAME_SEPARATOR) if name]
+    except UnicodeDecodeError:
+        raise ProtocolError("Invalid capability name")
+
+
+def encode_compressed(length: int, codec: str) -> bytes:
+    """
+    Encode a compressed content announcement
+    :param length: Uncompressed content length
+    :param codec: Codec name
+    :return:
+    """
+    return COMPRESSED_LENGTH.pack(length) + codec.encode("ascii")
+
+
+def decode_compressed(payload: bytes) -> tuple:
+    """
+    Decode a compressed frame payload
+    :param payload: Bytes produced by encode_compressed
+    :return: (uncompressed length, codec name)
+    """
+    names = decode_names(payload[COMPRESSED_LENGTH.size:])
+    if len(payload) < COMPRESSED_LENGTH.size or len(names) != 1:
+        raise ProtocolError("Invalid compressed frame")
+    return COMPRESSED_LENGTH.unpack_from(payload)[0], names[0]
+
+
+def encode_bitmap(flags: list) -> bytes:
+    """
+    Pack a list of booleans, one bit each
+    :param flags: Booleans in manifest order
+    :return:
+    """
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for index, flag in enumerate(flags):
+        if flag:
+            bitmap[index >> 3] |= 1 << (index & 7)
+    return bytes(bitmap)
+
+
+def decode_bitmap(payload: bytes, count: int) -> list:
+    """
+    Unpack a bitmap produced by encode_bitmap
+    :param payload: Packed bits
+    :param count: Number of flags expected
+    :return: List of booleans
+    """
+    if len(payload) != (count + 7) // 8:
+        raise ProtocolError(f"Bitmap of {len(payload)} bytes does not cover {count} files")
+    return [bool(payload[index >> 3] & (1 << (index & 7))) for index in range(count)]
+
+
+def encode_sparse(length: int, extents: list) -> bytes:
+    """
+    Encode a sparse content announcement
+    :param length: Content length, holes included
+    :param extents: (file offset, length) of every data extent in file order
+    :return:
+    """
+    return SPARSE_LENGTH.pack(length) + b"".join(EXTENT.pack(start, size) for start, size in extents)
+
+
+def decode_sparse(payload: bytes) -> tuple:
+    """
+    Decode a sparse frame payload
+    :param payload: Bytes produced by encode_sparse
+    :return: (content length, [(file offset, length), ...])
+    """
+    if len(payload) < SPARSE_LENGTH.size or (len(payload) - SPARSE_LENGTH.size) % EXTENT.size:
+        raise ProtocolError("Invalid sparse frame")
+    length, = SPARSE_LENGTH.unpack_from(payload)
+    return length, list(EXTENT.iter_unpack(payload[SPARSE_LENGTH.size:]))
@@ -0,0 +1,304 @@
+"""
+Token bucket rate limits and a fair disk write scheduler
+https://wingxel.github.io/website/index.html
+
+Limits are bytes per second, 0 meaning unlimited. Every bucket hands out
+tokens as soon as it is asked and goes into debt, callers then sleep for the
+time the debt takes to pay back: concurrent users of a bucket are served in
+the order they asked and a limit can change at any time.
+"""
+
+import json
+import os
+import signal
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+import util
+
+# Seconds of traffic a bucket may send at once after being idle
+BURST_SECONDS = 0.25
+# Smallest burst, a single chunk never waits on itself
+MIN_BURST = 1024 * 1024
+# Per-client buckets idle this long are forgotten once there are too many
+IDLE_BUCKET_SECONDS = 60
+MAX_CLIENT_BUCKETS = 1024
+# Seconds between checks of the limits file for changes
+LIMITS_POLL_INTERVAL = 1
+# Settings a limits file may hold
+LIMIT_KEYS = ("rate", "client_rate", "clients", "disk_rate", "disk_slots")
+
+
+class TokenBucket:
+    def __init__(self, rate: float = 0) -> None:
+        """
+        Token bucket of bytes
+        :param rate: Bytes per second, 0 for unlimited
+        """
+        self.__lock = Lock()
+        self.rate, self.burst, self.tokens = 0, MIN_BURST, MIN_BURST
+        self.updated = self.used = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Change the rate, tokens already handed out are kept
+        :param rate: Bytes per second, 0 for unlimited
+        :return:
+        """
+        with self.__lock:
+            self.__refill()
+            self.rate = max(0, rate)
+            self.burst = max(self.rate * BURST_SECONDS, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def __refill(self) -> None:
+        """
+        Add the tokens earned since the last call (lock held)
+        :return:
+        """
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    def reserve(self, amount: int) -> float:
+        """
+        Take tokens, going into debt if there are not enough
+        :param amount: Number of bytes
+        :return: Seconds the caller should wait before using them
+        """
+        if not self.rate:
+            return 0.0
+        with self.__lock:
+            self.__refill()
+            self.tokens -= amount
+            self.used = self.updated
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self, amount: int) -> float:
+        """
+        Take tokens, sleeping until they are paid for
+        :param amount: Number of bytes
+        :return: Seconds slept
+        """
+        pause = self.reserve(amount)
+        if pause > 0:
+            time.sleep(pause)
+        return pause
+
+    def idle(self) -> bool:
+        """
+        If nobody used the bucket lately
+        :return:
+        """
+        return time.monotonic() - self.used > IDLE_BUCKET_SECONDS
+
+
+class FairScheduler:
+    def __init__(self, slots: int = 0) -> None:
+        """
+        Limit the disk writes running at the same time and hand turns to the
+        waiting sessions in round robin, so a session with a deep queue of
+        chunks does not starve the others
+        :param slots: Writes running at once, 0 for unlimited (no scheduling)
+        """
+        self.__lock = Lock()
+        self.slots, self.busy = max(0, slots), 0
+        # Waiting writes by session, sessions in turn order
+        self.__waiting = OrderedDict()
+
+    def set_slots(self, slots: int) -> None:
+        """
+        Change the number of writes running at once
+        :param slots: Writes running at once, 0 for unlimited
+        :return:
+        """
+        with self.__lock:
+            self.slots = max(0, slots)
+            while self.__waiting and (not self.slots or self.busy < self.slots):
+                self.busy += 1
+                self.__next_turn().set()
+
+    def __next_turn(self) -> Event:
+        """
+        Waiting write of the session whose turn it is (lock held)
+        :return:
+        """
+        session, waiting = self.__waiting.popitem(last=False)
+        turn = waiting.popleft()
+        if waiting:
+            # Back of the line until every other session had a turn
+            self.__waiting[session] = waiting
+        return turn
+
+    def acquire(self, session) -> None:
+        """
+        Wait for a turn to write
+        :param session: Key of the writing session
+        :return:
+        """
+        with self.__lock:
+            if not self.__waiting and (not self.slots or self.busy < self.slots):
+                self.busy += 1
+                return
+            turn = Event()
+            self.__waiting.setdefault(session, deque()).append(turn)
+        turn.wait()
+
+    def release(self) -> None:
+        """
+        End a write, the next session in line gets the slot
+        :return:
+        """
+        with self.__lock:
+            if self.__waiting and (not self.slots or self.busy <= self.slots):
+                self.__next_turn().set()
+            else:
+                self.busy -= 1
+
+
+class Limits:
+    def __init__(self) -> None:
+        """
+        Every limit of a process, unlimited until updated
+        """
+        self.__lock = Lock()
+        # Whole process network traffic
+        self.total = TokenBucket()
+        # Traffic of each client address, clients with their own rate override client_rate
+        self.client_rate, self.clients, self.__client_buckets = 0, {}, {}
+        # Disk writes: bandwidth and fair turns
+        self.disk = TokenBucket()
+        self.scheduler = FairScheduler()
+
+    def update(self, settings: dict) -> None:
+        """
+        Apply new limits, connections keep going at the new rates
+        :param settings: Any of LIMIT_KEYS, rates in bytes per second
+        :return:
+        """
+        if "rate" in settings:
+            self.total.set_rate(float(settings["rate"]))
+        if "disk_rate" in settings:
+            self.disk.set_rate(float(settings["disk_rate"]))
+        if "disk_slots" in settings:
+            self.scheduler.set_slots(int(settings["disk_slots"]))
+        with self.__lock:
+            if "client_rate" in settings:
+                self.client_rate = max(0.0, float(settings["client_rate"]))
+            if "clients" in settings:
+                self.clients = {address: float(rate) for address, rate in settings["clients"].items()}
+            for address, bucket in self.__client_buckets.items():
+                bucket.set_rate(self.clients.get(address, self.client_rate))
+
+    def client(self, address: str) -> TokenBucket:
+        """
+        Bucket shared by every connection of a client address
+        :param address: Client IP address
+        :return:
+        """
+        with self.__lock:
+            bucket = self.__client_buckets.get(address)
+            if bucket is None:
+                if len(self.__client_buckets) >= MAX_CLIENT_BUCKETS:
+                    for idle in [key for key, value in self.__client_buckets.items() if value.idle()]:
+                        del self.__client_buckets[idle]
+                bucket = TokenBucket(self.clients.get(address, self.client_rate))
+                self.__client_buckets[address] = bucket
+            return bucket
+
+    def network_delay(self, address: str, amount: int) -> float:
+        """
+        Account for bytes a client sent or received
+        :param address: Client IP address
+        :param amount: Number of bytes
+        :return: Seconds the connection should pause
+        """
+        return max(self.total.reserve(amount), self.client(address).reserve(amount))
+
+    def write(self, session, write, data) -> None:
+        """
+        Write a chunk in the session's turn and within the disk rate
+        :param session: Key of the writing session
+        :param write: Called with the chunk
+        :param data: Chunk content
+        :return:
+        """
+        if not self.scheduler.slots and not self.disk.rate:
+            write(data)
+            return
+        self.scheduler.acquire(session)
+        try:
+            self.disk.take(len(data))
+            write(data)
+        finally:
+            self.scheduler.release()
+
+
+def read_limits(limits_file: str) -> dict:
+    """
+    Read a limits file
+    :param limits_file: JSON object with any of LIMIT_KEYS
+    :return:
+    """
+    with open(limits_file) as limits:
+        settings = json.load(limits)
+    if not isinstance(settings, dict):
+        raise ValueError("limits file must hold a JSON object")
+    return {key: value for key, value in settings.items() if key in LIMIT_KEYS}
+
+
+def watch_limits(limits: Limits, limits_file: str) -> None:
+    """
+    Apply a limits file now, on SIGHUP and whenever it changes
+    :param limits: Limits to update
+    :param limits_file: JSON object with any of LIMIT_KEYS
+    :return:
+    """
+    changed = Event()
+
+    def apply() -> None:
+        """
+        Re-read the limits file, a broken file keeps the current limits
+        :return:
+        """
+        try:
+            settings = read_limits(limits_file)
+        except (OSError, ValueError) as error:
+            print(f"{datetime.now()} : Cannot read limits from {limits_file} : {str(error)}")
+            util.log_error(f"Cannot read limits from {limits_file} : {str(error)}")
+            return
+        limits.update(settings)
+        util.log_info(f"Limits from {limits_file} : {settings}")
+
+    def watch(modified) -> None:
+        """
+        Reload on request or when the file's modification time changes
+        :param modified: Modification time of the file already applied
+        :return:
+        """
+        while True:
+            changed.wait(LIMITS_POLL_INTERVAL)
+            try:
+                current = os.stat(limits_file).st_mtime_ns
+            except OSError:
+                current = None
+            if changed.is_set() or (current is not None and current != modified):
+                changed.clear()
+                apply()
+            modified = current
+
+    # Applied once right away, then by the watcher thread
+    apply()
+    try:
+        modified = os.stat(limits_file).st_mtime_ns
+    except OSError:
+        modified = None
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signal_number, frame: changed.set())
+    Thread(target=watch, args=(modified,), name="limits", daemon=True).start()
@@ -4,11 +4,23 @@ https://wingxel.github.io/website/index.html
 """
 
 import argparse
+import asyncio
+import ctypes
 import os
 import sys
+import time
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, SOMAXCONN
+from queue import Queue, Empty
+from threading import Condition, Event, Lock, Thread
 
+import integrity
+import metrics
+import protocol
+import ratelimit
+import tuning
 import util
 
 # The default folder to save received items
@@ -16,25 +28,749 @@ DEFAULT_SAVE_FOLDER = os.sep.join([str(Path.home()), "SharePY3"])
 # Port list to choose default port from
 LIST_OF_PORTS_TO_USE = [8000, 8001, 1578, 1233, 2578, 31293, 4319, 42780, 1783, 3301, 1890, 1234,
                         1901, 6490, 61514, 14312]
+# Pending connections the listening socket queues before refusing new ones
+LISTEN_BACKLOG = SOMAXCONN
+# Threads doing blocking disk work for the event-loop receiver
+DISK_THREADS = 8
+# Size of each receive pipeline buffer
+BUFFER_SIZE = 1024 * 1024
+# Memory all receive pipeline buffers together may use
+BUFFER_MEMORY = 64 * 1024 * 1024
+# Filled buffers a connection may queue for its writer (triple buffering
+# with the one being filled and the one being written)
+PIPELINE_DEPTH = 2
+# Seconds a striped file may go without a landed range before it is abandoned
+STRIPE_STALL_TIMEOUT = 120
+# Striped files being received, by token
+striped_files = {}
+striped_files_lock = Lock()
+# Send a digest of the bytes already held so the sender can check them before resuming
+RESUME_CHECKSUM = False
+# Linux fallocate mode reserving blocks without changing the file length
+FALLOC_FL_KEEP_SIZE = 1
+try:
+    libc_fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError, TypeError):
+    libc_fallocate = None
+# Process wide receive buffer pool, see get_buffer_pool
+buffer_pool = None
+buffer_pool_lock = Lock()
+# Process wide index of the save folder, see get_destination_index
+destination_index = None
+destination_index_lock = Lock()
+# Network and disk limits shared by every connection, unlimited unless configured
+limits = ratelimit.Limits()
+# Forwards landed files to a further receiver (see relay), None when not relaying
+relay = None
 # If the script is run on android device
 if os.path.exists("/sdcard/"):
     DEFAULT_SAVE_FOLDER = os.sep.join(["", "sdcard", "SharePy3"])
 
 
+def save_path(name: list) -> str:
+    """
+    Absolute destination path of a received item
+    :param name: Path parts relative to the save folder
+    :return:
+    """
+    return os.sep.join([DEFAULT_SAVE_FOLDER, os.sep.join(name)])
+
+
+def part_path(name: list) -> str:
+    """
+    Absolute path of a received item while it is incomplete
+    :param name: Path parts relative to the save folder
+    :return:
+    """
+    return part_file(save_path(name))
+
+
+def part_file(save_file: str) -> str:
+    """
+    Hidden reserved name of a destination file while it is incomplete, it is
+    renamed once complete and a leftover one is resumed instead of being skipped
+    as existing
+    :param save_file: Destination file absolute path
+    :return:
+    """
+    folder, name = os.path.split(save_file)
+    return os.path.join(folder, "." + name + protocol.PART_SUFFIX)
+
+
+def marker_file(save_file: str) -> str:
+    """
+    Hidden reserved name of the marker of a partial file, it holds the announced
+    size and only partial files with a marker were created by a receiver
+    :param save_file: Destination file absolute path
+    :return:
+    """
+    folder, name = os.path.split(save_file)
+    return os.path.join(folder, "." + name + protocol.MARKER_SUFFIX)
+
+
+def marked_size(save_file: str):
+    """
+    Size announced for the file a partial file was created for
+    :param save_file: Destination file absolute path
+    :return: None if there is no (readable) marker
+    """
+    try:
+        with open(marker_file(save_file), "r") as marker:
+            return int(marker.read())
+    except (OSError, ValueError):
+        return None
+
+
+def preallocate(fd: int, size: int, keep_size: bool = False, offset: int = 0) -> None:
+    """
+    Reserve the destination blocks up front from the announced size
+    :param fd: Destination file descriptor
+    :param size: Announced file size
+    :param keep_size: Do not change the file length, so the length of a
+                      partial file always equals the bytes that landed (Linux
+                      only, no preallocation elsewhere)
+    :param offset: Start of the range to reserve
+    :return:
+    """
+    if size <= offset:
+        return
+    if keep_size:
+        if libc_fallocate is not None and libc_fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, size - offset) != 0:
+            util.log_error(f"Preallocation failed : {os.strerror(ctypes.get_errno())}")
+    elif hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, offset, size - offset)
+        except OSError as error:
+            # Some filesystems cannot preallocate, the writes still work
+            util.log_error(f"Preallocation failed : {str(error)}")
+
+
+def write_fully(fd: int, data) -> None:
+    """
+    Write all of data to a file descriptor
+    :param fd: Destination file descriptor
+    :param data: Bytes-like chunk
+    :return:
+    """
+    view, written = memoryview(data), 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+
+
+class BufferPool:
+    def __init__(self, count: int, size: int) -> None:
+        """
+        Reused receive buffers, allocated on first use and never more than count
+        :param count: Most buffers that may exist
+        :param size: Size of each buffer
+        """
+        self.size, self.__count, self.__created = size, count, 0
+        self.__free = Queue()
+        self.__lock = Lock()
+
+    def acquire(self) -> bytearray:
+        """
+        Take a free buffer, waiting for one to be released when all are in use
+        :return:
+        """
+        try:
+            return self.__free.get_nowait()
+        except Empty:
+            pass
+        with self.__lock:
+            if self.__created < self.__count:
+                self.__created += 1
+                return bytearray(self.size)
+        return self.__free.get()
+
+    def release(self, buffer: bytearray) -> None:
+        """
+        Give a buffer back to the pool
+        :param buffer: Buffer taken with acquire
+        :return:
+        """
+        self.__free.put(buffer)
+
+
+def get_buffer_pool() -> BufferPool:
+    """
+    The process wide receive buffer pool, sized from BUFFER_MEMORY and BUFFER_SIZE
+    :return:
+    """
+    global buffer_pool
+    with buffer_pool_lock:
+        if buffer_pool is None:
+            buffer_pool = BufferPool(max(PIPELINE_DEPTH + 2, BUFFER_MEMORY // BUFFER_SIZE), BUFFER_SIZE)
+        return buffer_pool
+
+
+class DestinationIndex:
+    def __init__(self) -> None:
+        """
+        In-memory listing of the destination folders, each one read with a
+        single scandir and kept current as files land, so skip and resume
+        checks are set lookups. A folder whose modification time changed
+        outside this process is listed again
+        """
+        # Folder absolute path: (modification time, set of entry names)
+        self.__folders = {}
+        # Folder absolute path: number of changes this process is making in it
+        self.__changing = {}
+        self.__lock = Lock()
+
+    def __listing(self, folder: str):
+        """
+        Entry names of a folder, listed again when it changed (lock held)
+        :param folder: Folder absolute path
+        :return: Set of names, None if the folder does not exist
+        """
+        modified = folder_mtime(folder)
+        if modified is None:
+            self.__folders.pop(folder, None)
+            return None
+        cached = self.__folders.get(folder)
+        if cached is None or cached[0] != modified:
+            try:
+                with os.scandir(folder) as entries:
+                    cached = (modified, {entry.name for entry in entries})
+            except (FileNotFoundError, NotADirectoryError):
+                self.__folders.pop(folder, None)
+                return None
+            self.__folders[folder] = cached
+        return cached[1]
+
+    def exists(self, path: str) -> bool:
+        """
+        Check if a file (or folder) exists
+        :param path: Absolute path
+        :return:
+        """
+        folder, name = os.path.split(path)
+        with self.__lock:
+            listing = self.__listing(folder)
+            return listing is not None and name in listing
+
+    @contextmanager
+    def changing(self, folder: str):
+        """
+        Wrap a change this process makes in a folder (add and discard its
+        entries inside), a listing that was current before the change stays
+        current after it instead of being listed again
+        :param folder: Folder absolute path
+        :return:
+        """
+        before = folder_mtime(folder)
+        with self.__lock:
+            self.__changing[folder] = self.__changing.get(folder, 0) + 1
+        try:
+            yield
+        finally:
+            after = folder_mtime(folder)
+            with self.__lock:
+                self.__changing[folder] -= 1
+                cached = self.__folders.get(folder)
+                # Only the last of overlapping changes knows every entry was recorded
+                if not self.__changing[folder]:
+                    del self.__changing[folder]
+                    if cached is not None and before is not None and after is not None and cached[0] == before:
+                        self.__folders[folder] = (after, cached[1])
+
+    def add(self, path: str) -> None:
+        """
+        Record a file that was just created (see changing)
+        :param path: Absolute path
+        :return:
+        """
+        folder, name = os.path.split(path)
+        with self.__lock:
+            # A folder that was never listed will be listed with the file in it
+            if folder in self.__folders:
+                self.__folders[folder][1].add(name)
+
+    def discard(self, path: str) -> None:
+        """
+        Record a file that was just removed (see changing)
+        :param path: Absolute path
+        :return:
+        """
+        folder, name = os.path.split(path)
+        with self.__lock:
+            if folder in self.__folders:
+                self.__folders[folder][1].discard(name)
+
+    def makedirs(self, folder: str) -> None:
+        """
+        Create a folder and its parents, once per folder
+        :param folder: Folder absolute path
+        :return:
+        """
+        with self.__lock:
+            if self.__listing(folder) is not None:
+                return
+        with self.changing(os.path.dirname(folder)):
+            os.makedirs(folder, exist_ok=True)
+            self.add(folder)
+
+
+def folder_mtime(folder: str):
+    """
+    Modification time of a folder, it changes whenever an entry is added or removed
+    :param folder: Folder absolute path
+    :return: Nanoseconds, None if the folder does not exist
+    """
+    try:
+        return os.stat(folder).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def get_destination_index() -> DestinationIndex:
+    """
+    The process wide destination folder index
+    :return:
+    """
+    global destination_index
+    with destination_index_lock:
+        if destination_index is None:
+            destination_index = DestinationIndex()
+        return destination_index
+
+
+def create_part(save_file: str, size: int, flags: int = 0) -> int:
+    """
+    Open the partial file of a destination and mark it as ours
+    :param save_file: Destination file absolute path
+    :param size: Announced file size, recorded in the marker
+    :param flags: Extra os.open flags
+    :return: File descriptor opened for writing
+    """
+    index = get_destination_index()
+    with index.changing(os.path.dirname(save_file)):
+        # Marker first, a partial file without one is never resumed
+        with open(marker_file(save_file), "w") as marker:
+            marker.write(str(size))
+        index.add(marker_file(save_file))
+        fd = os.open(part_file(save_file), os.O_WRONLY | os.O_CREAT | flags, 0o666)
+        index.add(part_file(save_file))
+    return fd
+
+
+def remove_marker(save_file: str) -> None:
+    """
+    Delete the marker of a partial file (folder being changed)
+    :param save_file: Destination file absolute path
+    :return:
+    """
+    try:
+        os.remove(marker_file(save_file))
+    except FileNotFoundError:
+        pass
+    get_destination_index().discard(marker_file(save_file))
+
+
+def land(save_file: str) -> None:
+    """
+    Give a complete partial file its real name
+    :param save_file: Destination file absolute path
+    :return:
+    """
+    index = get_destination_index()
+    with index.changing(os.path.dirname(save_file)):
+        os.replace(part_file(save_file), save_file)
+        index.discard(part_file(save_file))
+        index.add(save_file)
+        remove_marker(save_file)
+    if relay is not None:
+        relay.forward(save_file)
+
+
+def remove_part(save_file: str) -> None:
+    """
+    Delete the partial file of a destination
+    :param save_file: Destination file absolute path
+    :return:
+    """
+    index = get_destination_index()
+    with index.changing(os.path.dirname(save_file)):
+        os.remove(part_file(save_file))
+        index.discard(part_file(save_file))
+        remove_marker(save_file)
+
+
+class StripedFile:
+    def __init__(self, save_file: str, size: int) -> None:
+        """
+        Pre-sized destination of a file received as ranges over several connections,
+        ranges land out of order so a striped file always starts over
+        :param save_file: Destination file absolute path, written under its partial name until complete
+        :param size: Full file size
+        """
+        self.save_file, self.size, self.landed, self.failed = save_file, size, 0, False
+        self.fd = create_part(save_file, size, os.O_TRUNC)
+        os.ftruncate(self.fd, size)
+        preallocate(self.fd, size)
+        self.__condition = Condition()
+
+    def write(self, offset: int, data: memoryview) -> None:
+        """
+        Write a chunk straight to its position, no reassembly needed
+        :param offset: Position of the first byte in the file
+        :param data: Chunk content
+        :return:
+        """
+        if offset + len(data) > self.size:
+            raise ValueError(f"Range past the end of {self.save_file}")
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fd, data[written:], offset + written)
+        with self.__condition:
+            self.landed += len(data)
+            self.__condition.notify_all()
+
+    def fail(self) -> None:
+        """
+        Mark the file as incomplete, a range connection broke
+        :return:
+        """
+        with self.__condition:
+            self.failed = True
+            self.__condition.notify_all()
+
+    def wait(self) -> bool:
+        """
+        Wait until every range has landed
+        :return: True if complete, False if failed or stalled
+        """
+        with self.__condition:
+            landed, deadline = self.landed, time.monotonic() + STRIPE_STALL_TIMEOUT
+            while self.landed < self.size and not self.failed and util.receiving:
+                if self.landed != landed:
+                    landed, deadline = self.landed, time.monotonic() + STRIPE_STALL_TIMEOUT
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(min(remaining, 1))
+            return self.landed == self.size and not self.failed
+
+    def close(self, complete: bool) -> None:
+        """
+        Close the destination file, renaming it into place if complete
+        :param complete: If every range landed
+        :return:
+        """
+        os.close(self.fd)
+        if complete:
+            land(self.save_file)
+        else:
+            # Out of order ranges cannot be resumed, start over next time
+            remove_part(self.save_file)
+
+
+class BlockingConnection:
+    def __init__(self, connection_socket: socket, pool: BufferPool) -> None:
+        """
+        Blocking socket behind the session coroutines, every awaited call
+        completes without suspending so the session runs on its own thread
+        :param connection_socket: Connection socket with the sending end
+        :param pool: Buffers payloads are received into
+        """
+        self.socket, self.__pool = connection_socket, pool
+        # Replaced by the session metrics and the client address once the session starts
+        self.metrics, self.client = metrics.SessionMetrics("receiver", ""), ""
+        self.__header = bytearray(protocol.HEADER.size)
+        # Filled buffers waiting for the writer thread, bounded for backpressure
+        self.__jobs = Queue(maxsize=PIPELINE_DEPTH)
+        self.__writer, self.__write_error = None, None
+        # How much of a buffer is filled before it goes to the writer, follows the throughput
+        self.__sizer = tuning.ChunkSizer(pool.size, maximum=pool.size)
+
+    async def recv_header(self):
+        """
+        Receive the next frame header
+        :return: (message type, payload length) or None if the sender is done
+        """
+        return protocol.recv_header(self.socket, self.__header)
+
+    async def recv_exact(self, length: int) -> bytearray:
+        """
+        Receive exactly length bytes
+        :param length: Number of bytes
+        :return:
+        """
+        data = protocol.recv_exact(self.socket, length)
+        self.__throttle(length)
+        return data
+
+    def __throttle(self, amount: int) -> None:
+        """
+        Pause receiving while the client is over its rate, TCP flow control
+        slows the sender down meanwhile
+        :param amount: Number of bytes just received
+        :return:
+        """
+        pause = limits.network_delay(self.client, amount)
+        if pause > 0:
+            time.sleep(pause)
+
+    async def receive_to(self, write, length: int) -> None:
+        """
+        Receive payload bytes into pool buffers while the writer thread saves
+        the previous ones, so the socket and the disk never wait on each other
+        :param write: Called with each filled chunk on the writer thread
+        :param length: Number of payload bytes
+        :return: Once every chunk has been written
+        """
+        if self.__writer is None:
+            self.__writer = Thread(target=self.__write_jobs, daemon=True)
+            self.__writer.start()
+        remaining = length
+        try:
+            while remaining > 0 and self.__write_error is None:
+                # Stop receiving if the receiver has stopped
+                if not util.receiving:
+                    raise ConnectionAbortedError("Receiver stopped")
+                # Waiting for a buffer or a queue slot means the disk is behind
+                waited = time.perf_counter()
+                buffer = self.__pool.acquire()
+                waited = time.perf_counter() - waited
+                size = min(len(buffer), remaining, self.__sizer.size)
+                started = time.perf_counter()
+                try:
+                    protocol.recv_exact_into(self.socket, memoryview(buffer)[:size])
+                except Exception:
+                    self.__pool.release(buffer)
+                    raise
+                self.__sizer.record(size, time.perf_counter() - started)
+                started = time.perf_counter()
+                self.__jobs.put((write, buffer, size))
+                self.metrics.add("disk_wait_seconds", waited + time.perf_counter() - started)
+                self.metrics.peak("write_queue_peak", self.__jobs.qsize())
+                remaining -= size
+                self.__throttle(size)
+        finally:
+            # Wait for the writer to catch up, the caller may close the file next
+            started = time.perf_counter()
+            written = Event()
+            self.__jobs.put(written)
+            written.wait()
+            self.metrics.add("disk_wait_seconds", time.perf_counter() - started)
+        if self.__write_error is not None:
+            error, self.__write_error = self.__write_error, None
+            raise error
+
+    def __write_jobs(self) -> None:
+        """
+        Writer thread saving filled buffers in order and recycling them
+        :return:
+        """
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+            if isinstance(job, Event):
+                job.set()
+                continue
+            write, buffer, size = job
+            try:
+                if self.__write_error is None:
+                    # Sessions take turns when disk writes are scheduled
+                    limits.write(self, write, memoryview(buffer)[:size])
+            except Exception as error:
+                self.__write_error = error
+            finally:
+                self.__pool.release(buffer)
+
+    async def send_frame(self, message_type: int, payload: bytes = b"") -> None:
+        """
+        Send a complete frame
+        :param message_type: One of the protocol message types
+        :param payload: Frame payload
+        :return:
+        """
+        protocol.send_frame(self.socket, message_type, payload)
+
+    async def run_disk(self, function, *args):
+        """
+        Run blocking disk work, inline on this connection thread
+        :param function: Callable
+        :param args: Arguments
+        :return: Whatever function returns
+        """
+        return function(*args)
+
+    async def wait(self, function, *args):
+        """
+        Run a call that blocks waiting for other connections
+        :param function: Callable
+        :param args: Arguments
+        :return: Whatever function returns
+        """
+        return function(*args)
+
+    async def close(self) -> None:
+        """
+        Close the connection and stop the writer thread
+        :return:
+        """
+        if self.__writer is not None:
+            self.__jobs.put(None)
+            self.__writer.join()
+        self.socket.close()
+
+
+class StreamConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, disk_executor) -> None:
+        """
+        asyncio stream behind the session coroutines, blocking disk work goes
+        to a bounded executor so the event loop only does network I/O
+        :param reader: Stream reader of the connection
+        :param writer: Stream writer of the connection
+        :param disk_executor: Bounded thread pool for disk work
+        """
+        self.reader, self.writer, self.__disk_executor = reader, writer, disk_executor
+        # Replaced by the session metrics and the client address once the session starts
+        self.metrics, self.client = metrics.SessionMetrics("receiver", ""), ""
+
+    async def recv_header(self):
+        """
+        Receive the next frame header
+        :return: (message type, payload length) or None if the sender is done
+        """
+        try:
+            header = await self.reader.readexactly(protocol.HEADER.size)
+        except asyncio.IncompleteReadError as error:
+            if not error.partial:
+                return None
+            raise ConnectionError("Connection closed in the middle of a frame header") from error
+        return protocol.parse_header(header)
+
+    async def recv_exact(self, length: int) -> bytes:
+        """
+        Receive exactly length bytes
+        :param length: Number of bytes
+        :return:
+        """
+        try:
+            data = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError as error:
+            raise ConnectionError(f"Connection closed after {len(error.partial)} of {length} bytes") from error
+        await self.__throttle(length)
+        return data
+
+    async def __throttle(self, amount: int) -> None:
+        """
+        Pause reading while the client is over its rate, other sessions keep going
+        :param amount: Number of bytes just received
+        :return:
+        """
+        pause = limits.network_delay(self.client, amount)
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def receive_to(self, write, length: int) -> None:
+        """
+        Receive payload chunks, each one written on the disk executor while the
+        next one is read (double buffering, writes stay in order)
+        :param write: Called with each chunk on a disk thread
+        :param length: Number of payload bytes
+        :return: Once every chunk has been written
+        """
+        loop, remaining, writing = asyncio.get_running_loop(), length, None
+        try:
+            while remaining > 0:
+                # Stop receiving if the receiver has stopped
+                if not util.receiving:
+                    raise ConnectionAbortedError("Receiver stopped")
+                data = await self.reader.read(min(remaining, BUFFER_SIZE))
+                if not data:
+                    raise ConnectionError(f"Connection closed with {remaining} payload bytes missing")
+                remaining -= len(data)
+                await self.__throttle(len(data))
+                if writing is not None:
+                    # Waiting here means the disk is behind the network
+                    started = time.perf_counter()
+                    await writing
+                    self.metrics.add("disk_wait_seconds", time.perf_counter() - started)
+                writing = loop.run_in_executor(self.__disk_executor, limits.write, self, write, data)
+        finally:
+            if writing is not None:
+                started = time.perf_counter()
+                await writing
+                self.metrics.add("disk_wait_seconds", time.perf_counter() - started)
+
+    async def send_frame(self, message_type: int, payload: bytes = b"") -> None:
+        """
+        Send a complete frame
+        :param message_type: One of the protocol message types
+        :param payload: Frame payload
+        :return:
+        """
+        self.writer.write(protocol.pack_header(message_type, len(payload)) + payload)
+        await self.writer.drain()
+
+    async def run_disk(self, function, *args):
+        """
+        Run blocking disk work on the bounded disk executor
+        :param function: Callable
+        :param args: Arguments
+        :return: Whatever function returns
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.__disk_executor, partial(function, *args))
+
+    async def wait(self, function, *args):
+        """
+        Run a call that blocks waiting for other connections, away from the
+        disk executor so it can never starve the writes it waits for
+        :param function: Callable
+        :param args: Arguments
+        :return: Whatever function returns
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args))
+
+    async def close(self) -> None:
+        """
+        Close the connection
+        :return:
+        """
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception as error:
+            util.log_error(str(error))
+
+
+def run_blocking(coroutine):
+    """
+    Drive a session coroutine over a BlockingConnection to completion on the
+    calling thread, no event loop involved
+    :param coroutine: Coroutine that never suspends
+    :return: The coroutine result
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("Blocking session tried to suspend")
+
+
 def port_is_available(port: int) -> bool:
     """
-    Check if provided port is available for use
+    Check if provided port is available for use, by binding it the way the server will
     :param port: 
     :return: 
     """
+    checker = socket(AF_INET, SOCK_STREAM)
     try:
-        checker = socket(AF_INET, SOCK_STREAM)
-        checker.connect(("", port))
-        checker.close()
+        tuning.tune_listener(checker)
+        checker.bind(("", port))
+        return True
+    except OSError as error:
+        util.log_debug(f"Port {port} is not available : {str(error)}")
         return False
-    except Exception as error:
-        util.log_error(str(error))
-    return True
+    finally:
+        checker.close()
 
 
 def get_available_port() -> int:
@@ -59,14 +795,93 @@ def get_receiver_args() -> dict:
         epilog="python3 Receiver.py -p port_number -s folder_to_save_received_file(s)_and/or_folder(s)"
     )
 
+    available_port = get_available_port()
     parser.add_argument(
-        "-p", "--port", default=str(get_available_port()),
-        help=f"Port address to use for receiving, if not {get_available_port()} will be used"
+        "-p", "--port", default=str(available_port),
+        help=f"Port address to use for receiving, if not {available_port} will be used"
     )
     parser.add_argument(
         "-s", "--save", default=DEFAULT_SAVE_FOLDER,
         help=f"Folder to save received items, if not provided {DEFAULT_SAVE_FOLDER} will be used"
     )
+    parser.add_argument(
+        "-e", "--event-loop", action="store_true",
+        help="Serve every sender from one asyncio event loop instead of a thread per connection"
+    )
+    parser.add_argument(
+        "--disk-threads", type=int, default=DISK_THREADS,
+        help=f"Threads doing disk writes in event-loop mode, {DISK_THREADS} if not provided"
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=LISTEN_BACKLOG,
+        help=f"Pending connections queued before new ones are refused, {LISTEN_BACKLOG} if not provided"
+    )
+    parser.add_argument(
+        "--buffer-size", type=int, default=BUFFER_SIZE,
+        help=f"Size of each receive buffer, {BUFFER_SIZE} if not provided"
+    )
+    parser.add_argument(
+        "--buffer-memory", type=int, default=BUFFER_MEMORY,
+        help=f"Memory all receive buffers together may use, {BUFFER_MEMORY} if not provided"
+    )
+    parser.add_argument(
+        "--resume-checksum", action="store_true",
+        help="Send a digest of partially received files so senders check them before resuming"
+    )
+    parser.add_argument(
+        "--log-level", choices=list(util.LOG_LEVELS), default=util.LOG_LEVEL,
+        help=f"Least important messages written to {util.LOG_FILE}"
+    )
+    parser.add_argument(
+        "--stats", metavar="FILE",
+        help="Append per-file records and periodic session metrics to this JSON-lines file"
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=10,
+        help="Seconds between metrics snapshots in the stats file, 10 if not provided"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="Serve Prometheus text metrics on http://127.0.0.1:PORT/metrics"
+    )
+    parser.add_argument(
+        "--rate", type=int, default=0, metavar="BYTES",
+        help="Bytes per second all senders together may send, unlimited if not provided"
+    )
+    parser.add_argument(
+        "--client-rate", type=int, default=0, metavar="BYTES",
+        help="Bytes per second each sender address may send, unlimited if not provided"
+    )
+    parser.add_argument(
+        "--disk-rate", type=int, default=0, metavar="BYTES",
+        help="Bytes per second written to disk, unlimited if not provided"
+    )
+    parser.add_argument(
+        "--disk-slots", type=int, default=0, metavar="N",
+        help="Chunks written at the same time, connections take turns for them (fair share of the disk)"
+    )
+    parser.add_argument(
+        "--socket-buffer", type=int, default=tuning.SOCKET_BUFFER, metavar="BYTES",
+        help="Send and receive buffer of every connection (about bandwidth x round trip on long fat networks), "
+             "kernel autotuning if not provided"
+    )
+    parser.add_argument(
+        "--notsent-lowat", type=int, default=tuning.NOTSENT_LOWAT, metavar="BYTES",
+        help="Unsent bytes a connection may queue in the kernel (TCP_NOTSENT_LOWAT, Linux and macOS)"
+    )
+    parser.add_argument(
+        "--relay", metavar="IP:PORT",
+        help="Send every file that lands on to the Receiver at IP:PORT (chain replication)"
+    )
+    parser.add_argument(
+        "--relay-verify", nargs="?", const="auto", choices=["auto"] + list(integrity.HASHES),
+        help="Check every relayed file end to end, the best hash both ends support if not provided"
+    )
+    parser.add_argument(
+        "--limits", metavar="FILE",
+        help="JSON file with any of rate, client_rate, clients ({address: rate}), disk_rate and disk_slots, "
+             "re-read when it changes or on SIGHUP"
+    )
 
     args = parser.parse_args()
 
@@ -84,7 +899,41 @@ def get_receiver_args() -> dict:
         except Exception as error:
             sys.exit(f"Error creating folder {save_folder}\n{str(error)}")
 
+    relay_target = None
+    if args.relay:
+        relay_address, _, relay_port = args.relay.rpartition(":")
+        if not relay_address or not len(util.PORT_REGEX.findall(relay_port)) == 1 or \
+                not util.check_if_port_valid(int(relay_port)):
+            sys.exit(f"Invalid relay target {args.relay}, expected IP:PORT")
+        relay_target = (relay_address, int(relay_port))
+
+    # Hashes offered to the next receiver, in order of preference
+    relay_hashes = []
+    if args.relay_verify == "auto":
+        relay_hashes = list(integrity.HASHES)
+    elif args.relay_verify:
+        relay_hashes = [args.relay_verify]
+
     return {
         "port": int(port_number),
-        "folder": save_folder
+        "folder": save_folder,
+        "event_loop": args.event_loop,
+        "disk_threads": max(1, args.disk_threads),
+        "backlog": max(1, args.backlog),
+        "buffer_size": max(4096, args.buffer_size),
+        "buffer_memory": max(4096, args.buffer_memory),
+        "resume_checksum": args.resume_checksum,
+        "log_level": args.log_level,
+        "stats": args.stats,
+        "stats_interval": max(0.1, args.stats_interval),
+        "metrics_port": args.metrics_port,
+        "rate": max(0, args.rate),
+        "client_rate": max(0, args.client_rate),
+        "disk_rate": max(0, args.disk_rate),
+        "disk_slots": max(0, args.disk_slots),
+        "limits": args.limits,
+        "socket_buffer": max(0, args.socket_buffer),
+        "notsent_lowat": max(0, args.notsent_lowat),
+        "relay": relay_target,
+        "relay_verify": relay_hashes
     }
@@ -0,0 +1,94 @@
+"""
+Relay - files a Receiver stored are sent on to a further Receiver
+https://wingxel.github.io/website/index.html
+
+Chain replication: the source sends once to the first receiver, each
+receiver forwards what lands to the next one, so the source uplink carries
+each file once whatever the length of the chain. Files are forwarded one at
+a time as they land, with delta updates for files the next receiver already
+has.
+"""
+
+import os
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+
+import Sender
+import receiver_utils
+import scanner
+import util
+
+
+class Relay:
+    def __init__(self, ip_address: str, port_number: int, verification: list = None) -> None:
+        """
+        Forward landed files from a background thread over one connection,
+        reconnecting after a failure
+        :param ip_address: Next receiver IP address
+        :param port_number: Next receiver port number
+        :param verification: Content hashes to offer in order of preference, None or empty to not verify
+        """
+        self.ip_address, self.port_number = ip_address, port_number
+        self.verification = verification or []
+        # Landed files waiting to be forwarded, None stops the thread
+        self.__queue = Queue()
+        self.__thread = Thread(target=self.__run, name="relay", daemon=True)
+        self.__thread.start()
+
+    def forward(self, save_file: str) -> None:
+        """
+        Queue a landed file
+        :param save_file: Destination file absolute path
+        :return:
+        """
+        self.__queue.put(save_file)
+
+    def __connect(self):
+        """
+        Connect to the next receiver and agree on the hash
+        :return: (connected Sender.Sender, hash name or None), (None, None) if it is not reachable
+        """
+        sender = Sender.Sender(self.ip_address, self.port_number)
+        if not sender.connect_to_receiver():
+            return None, None
+        verify = None
+        if self.verification:
+            verify = Sender.negotiate_verification(sender.client_socket, self.verification)
+        return sender, verify
+
+    def __run(self) -> None:
+        """
+        Forward queued files until closed
+        :return:
+        """
+        sender, verify = None, None
+        while True:
+            save_file = self.__queue.get()
+            if save_file is None:
+                break
+            name = os.path.relpath(save_file, receiver_utils.DEFAULT_SAVE_FOLDER).split(os.sep)
+            try:
+                if sender is None:
+                    sender, verify = self.__connect()
+                    if sender is None:
+                        raise ConnectionError(f"{self.ip_address}:{self.port_number} is not reachable")
+                metadata = scanner.describe(name, os.stat(save_file), 0)
+                Sender.send_files(sender.client_socket, metadata, save_file, sync=True, verify=verify)
+            except Exception as error:
+                # This file is not relayed, the next one reconnects
+                print(f"{datetime.now()} : Cannot relay {os.sep.join(name)} : {str(error)}")
+                util.log_error(f"Relay of {os.sep.join(name)} failed : {str(error)}")
+                if sender is not None:
+                    sender.disconnect()
+                sender = None
+        if sender is not None:
+            sender.disconnect()
+
+    def close(self) -> None:
+        """
+        Forward what is queued and stop
+        :return:
+        """
+        self.__queue.put(None)
+        self.__thread.join()
@@ -0,0 +1,111 @@
+"""
+Single-pass directory scanner building the Sender manifest
+https://wingxel.github.io/website/index.html
+
+Every entry is listed with os.scandir and stat'ed once. Files are described
+as soon as their directory is listed so sending starts before the scan ends,
+and directories can be listed by several threads on network filesystems.
+"""
+
+import os
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import protocol
+import util
+
+
+def describe(name: list, stat_result: os.stat_result, size_d: int) -> dict:
+    """
+    Build a file description
+    :param name: Path relative to the sent item, as a list of parts
+    :param stat_result: Result of the single stat of the file
+    :param size_d: Size of the whole item, 0 if not known yet (folders are streamed)
+    :return: {"name": [...], "size": int, "size_d": int, "mtime": int (nanoseconds)}
+    """
+    return {"name": name, "size": stat_result.st_size, "size_d": size_d, "mtime": stat_result.st_mtime_ns}
+
+
+def scan_directory(folder: str, prefix: list) -> tuple:
+    """
+    List one directory
+    :param folder: Directory absolute path
+    :param prefix: Name parts of the directory relative to the sent item
+    :return: ([(metadata, absolute file path)], [(sub-directory path, its prefix)])
+    """
+    files, folders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                # Partial files of a receiver (a save folder being sent on) are not sent
+                if protocol.is_reserved(entry.name):
+                    continue
+                try:
+                    # Symbolic links to folders are not followed, like os.walk
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append((entry.path, prefix + [entry.name]))
+                    elif entry.is_file():
+                        stat_result = entry.stat()
+                        # Don't send empty files
+                        if stat_result.st_size > 0:
+                            files.append((describe(prefix + [entry.name], stat_result, 0), entry.path))
+                except OSError as error:
+                    util.log_error(f"Skipping {entry.path} : {str(error)}")
+    except OSError as error:
+        print(f"{datetime.now()} : Cannot list {folder} : {str(error)}")
+        util.log_error(f"Cannot list {folder} : {str(error)}")
+    return files, folders
+
+
+def scan_tree(folder: str, prefix: list, workers: int = 1):
+    """
+    Describe every file under a folder
+    :param folder: Folder absolute path
+    :param prefix: Name parts of the folder (its base name)
+    :param workers: Number of directories listed at the same time
+    :return: Generator of (metadata, absolute file path)
+    """
+    if workers <= 1:
+        # Depth first, a folder's files before its sub-folders like os.walk
+        pending = [(folder, prefix)]
+        while pending:
+            files, folders = scan_directory(*pending.pop())
+            yield from files
+            pending.extend(reversed(folders))
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan") as executor:
+        # Breadth first, a few listings in flight while the oldest one is consumed
+        waiting, listing = deque([(folder, prefix)]), deque()
+        while waiting or listing:
+            while waiting and len(listing) < 2 * workers:
+                listing.append(executor.submit(scan_directory, *waiting.popleft()))
+            files, folders = listing.popleft().result()
+            waiting.extend(folders)
+            yield from files
+
+
+def scan(paths: list, workers: int = 1):
+    """
+    Describe every file to send
+    :param paths: List of file(s) and/or folder(s) to send to the receiver
+    :param workers: Number of directories listed at the same time
+    :return: Generator of (metadata, absolute file path)
+    """
+    for path in paths:
+        # A folder given with a path separator at the end (/) keeps its name
+        path = path.rstrip(os.sep) or os.sep
+        if protocol.is_reserved(os.path.basename(path)):
+            print(f"{path} : Partial file of a receiver, not sent")
+            continue
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            print(f"{path} : File or directory not found!")
+            continue
+        print(f"{datetime.now()} : Getting file metadata. Please wait...")
+        if stat.S_ISREG(stat_result.st_mode):
+            yield describe([os.path.basename(path)], stat_result, stat_result.st_size), path
+        elif stat.S_ISDIR(stat_result.st_mode):
+            yield from scan_tree(path, [os.path.basename(path)], workers)
@@ -0,0 +1,103 @@
+"""
+Work-stealing scheduler feeding manifest files to a pool of connections
+https://wingxel.github.io/website/index.html
+"""
+
+from collections import deque
+from threading import Condition, Lock
+
+# Manifest orderings, each maps the manifest to the order files should start in.
+# None keeps the order the files are found in, they are pulled from the scan as
+# workers need them so sending starts before the scan is done
+ORDERINGS = {
+    "manifest": None,
+    # Start big files first so no large file is left for the end (cuts tail latency)
+    "largest": lambda manifest: sorted(manifest, key=lambda item: item[0]["size"], reverse=True),
+    # Finish many files early for fast visible progress
+    "smallest": lambda manifest: sorted(manifest, key=lambda item: item[0]["size"]),
+}
+# Times a file is put back after the connection sending it failed, a file that
+# breaks every connection it is sent over is not allowed to break them all
+MAX_PUT_BACK = 1
+
+
+class WorkQueue:
+    def __init__(self, manifest, workers: int, ordering: str = "manifest") -> None:
+        """
+        Deal the ordered manifest round-robin into one deque per worker, or
+        pull it lazily in manifest order
+        :param manifest: Iterable of (metadata, absolute file path)
+        :param workers: Number of workers (connections)
+        :param ordering: Key of ORDERINGS
+        """
+        self.__condition = Condition()
+        self.__queues = [deque() for _ in range(workers)]
+        # Workers holding a file they may still put back, files put back by absolute file path
+        self.__sending, self.__put_back = set(), {}
+        # Not taken from the manifest yet, only pulled once the deques are empty
+        self.__manifest, self.__manifest_lock = iter(()), Lock()
+        if ORDERINGS[ordering] is None:
+            self.__manifest = iter(manifest)
+            return
+        for index, item in enumerate(ORDERINGS[ordering](manifest)):
+            self.__queues[index % workers].append(item)
+
+    def take(self, worker: int):
+        """
+        Next file for a worker (its previous file is done): the front of its own
+        deque, the back of the busiest other deque once its own is empty, then
+        the next manifest file
+        :param worker: Worker index
+        :return: (metadata, absolute file path) or None when all work is done
+        """
+        with self.__condition:
+            self.__sending.discard(worker)
+            self.__condition.notify_all()
+        while True:
+            with self.__condition:
+                item = self.__steal(worker)
+                if item is not None:
+                    return item
+            # The scan may still be listing folders, the other workers can steal meanwhile
+            with self.__manifest_lock:
+                item = next(self.__manifest, None)
+                if item is not None:
+                    with self.__condition:
+                        self.__sending.add(worker)
+                    return item
+            with self.__condition:
+                # A worker still sending may fail and put its file back
+                if not self.__sending and not any(self.__queues):
+                    return None
+                self.__condition.wait()
+
+    def __steal(self, worker: int):
+        """
+        Take from the deques (condition held)
+        :param worker: Worker index
+        :return: (metadata, absolute file path) or None if every deque is empty
+        """
+        own = self.__queues[worker]
+        victim = own if own else max(self.__queues, key=len)
+        if not victim:
+            return None
+        self.__sending.add(worker)
+        return own.popleft() if own else victim.pop()
+
+    def put_back(self, worker: int, item) -> bool:
+        """
+        Queue a file again after the connection sending it failed, the other
+        workers steal it from the deque of the failed one
+        :param worker: Index of the failed worker, it takes nothing more
+        :param item: (metadata, absolute file path)
+        :return: False if the file was put back MAX_PUT_BACK times already
+        """
+        with self.__condition:
+            self.__sending.discard(worker)
+            self.__condition.notify_all()
+            count = self.__put_back.get(item[1], 0)
+            if count >= MAX_PUT_BACK:
+                return False
+            self.__put_back[item[1]] = count + 1
+            self.__queues[worker].append(item)
+            return True
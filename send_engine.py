@@ -0,0 +1,137 @@
+"""
+Send engine - moves file payloads from disk to a connected socket
+https://wingxel.github.io/website/index.html
+"""
+
+import errno
+import os
+import time
+from socket import socket
+
+import metrics
+import ratelimit
+import tuning
+
+# Chunk size used when the payload has to be copied through user space
+BUFFER_SIZE = 1024 * 1024
+# Largest single os.sendfile call, some kernels refuse counts above 2 GiB
+SENDFILE_MAX_COUNT = 0x7FFFF000
+# Send paths reported by send_payload
+PATH_SENDFILE = "sendfile"
+PATH_BUFFERED = "buffered"
+# errno values meaning the kernel cannot sendfile this file/socket pair
+SENDFILE_UNSUPPORTED = {
+    errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EBADF
+}
+
+
+# Sender rate limit (the rate setting), shared by every connection of the process
+limits = ratelimit.Limits()
+
+
+class SendfileUnsupported(Exception):
+    """
+    Raised before any byte is sent when zero-copy is not possible
+    """
+
+
+def throttle(amount: int) -> None:
+    """
+    Wait until sending some more bytes keeps the process under its rate
+    :param amount: Number of bytes about to be sent
+    :return:
+    """
+    limits.total.take(amount)
+
+
+def send_with_sendfile(connection_socket: socket, the_file, offset: int, count: int) -> None:
+    """
+    Send part of a file with zero-copy os.sendfile
+    :param connection_socket: Blocking connection to the receiver
+    :param the_file: File opened for reading binary
+    :param offset: Position of the first byte to send
+    :param count: Number of bytes to send
+    :return:
+    """
+    if not hasattr(os, "sendfile") or connection_socket.gettimeout() is not None:
+        raise SendfileUnsupported()
+    socket_fd, file_fd, sent_total = connection_socket.fileno(), the_file.fileno(), 0
+    # Rate limited transfers go out a buffer at a time
+    largest = BUFFER_SIZE if limits.total.rate else SENDFILE_MAX_COUNT
+    while sent_total < count:
+        throttle(min(count - sent_total, largest))
+        try:
+            sent = os.sendfile(
+                socket_fd, file_fd, offset + sent_total, min(count - sent_total, largest)
+            )
+        except OSError as error:
+            # Only fall back when nothing went out yet, otherwise the stream is
+            # already committed to this path
+            if sent_total == 0 and error.errno in SENDFILE_UNSUPPORTED:
+                raise SendfileUnsupported() from error
+            raise
+        if sent == 0:
+            raise EOFError(f"File shrank while sending ({sent_total} of {count} bytes sent)")
+        sent_total += sent
+
+
+def send_with_buffer(connection_socket: socket, the_file, offset: int, count: int, hasher=None) -> None:
+    """
+    Send part of a file by reading it into reusable buffers
+    :param connection_socket: Connection to the receiver
+    :param the_file: File opened for reading binary
+    :param offset: Position of the first byte to send
+    :param count: Number of bytes to send
+    :param hasher: integrity.StreamHasher fed every chunk sent, None to not hash
+    :return:
+    """
+    # Chunks follow the connection throughput, starting from BUFFER_SIZE
+    sizer = tuning.ChunkSizer(BUFFER_SIZE)
+    sizer.measure_rtt(connection_socket)
+    # Two buffers when hashing: one is hashed in the background while the other is filled
+    buffers = [
+        memoryview(bytearray(max(1, min(sizer.maximum, count)))) for _ in range(1 if hasher is None else 2)
+    ]
+    the_file.seek(offset)
+    remaining, turn, reading = count, 0, 0.0
+    while remaining > 0:
+        started = time.perf_counter()
+        buffer = buffers[turn % len(buffers)]
+        read_size = the_file.readinto(buffer[:min(remaining, sizer.size)])
+        reading += time.perf_counter() - started
+        if not read_size:
+            raise EOFError(f"File shrank while sending ({count - remaining} of {count} bytes sent)")
+        if hasher is not None:
+            hasher.update(buffer[:read_size])
+        throttle(read_size)
+        connection_socket.sendall(buffer[:read_size])
+        sizer.record(read_size, time.perf_counter() - started)
+        remaining -= read_size
+        turn += 1
+    metrics.session_for(connection_socket).add("disk_read_seconds", reading)
+
+
+def send_payload(connection_socket: socket, the_file, offset: int = 0, count: int = None, hasher=None) -> str:
+    """
+    Send file content, zero-copy when possible and buffered otherwise
+    :param connection_socket: Connection to the receiver
+    :param the_file: File opened for reading binary (preferably unbuffered)
+    :param offset: Position of the first byte to send
+    :param count: Number of bytes to send, the rest of the file if not provided
+    :param hasher: integrity.StreamHasher fed every chunk sent, None to not hash
+    :return: The send path that was used (PATH_SENDFILE or PATH_BUFFERED)
+    """
+    if count is None:
+        count = os.fstat(the_file.fileno()).st_size - offset
+    if count <= 0:
+        return PATH_SENDFILE
+    if hasher is not None:
+        # Hashing needs the bytes in user space, read them once for both
+        send_with_buffer(connection_socket, the_file, offset, count, hasher)
+        return PATH_BUFFERED
+    try:
+        send_with_sendfile(connection_socket, the_file, offset, count)
+        return PATH_SENDFILE
+    except SendfileUnsupported:
+        send_with_buffer(connection_socket, the_file, offset, count)
+        return PATH_BUFFERED
@@ -6,10 +6,20 @@ import argparse
 import re
 import sys
 
+import compress
+import fanout
+import integrity
+import scheduler
+import sync_index
+import tuning
 import util
 
 # IP address regex
 IP_REGEX = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
+# Packing threshold used when --pack is given without a size
+DEFAULT_PACK_THRESHOLD = 64 * 1024
+# Range size of striped files if --stripe-size is not given
+DEFAULT_STRIPE_SIZE = 8 * 1024 * 1024
 
 
 def check_if_ip_valid(ip: str) -> bool:
@@ -38,8 +48,9 @@ def get_args() -> dict:
     )
 
     parser.add_argument(
-        "-a", "--address", required=True,
-        help="The IP address of the machine where Receiver is running"
+        "-a", "--address", required=True, nargs="+",
+        help="The IP address of the machine where Receiver is running, several (IP or IP:port) to send the "
+             "same files to every one of them reading each file once"
     )
     parser.add_argument(
         "-p", "--port", required=True,
@@ -49,19 +60,161 @@ def get_args() -> dict:
         "-f", "--files", required=True, nargs="+",
         help="The list of file(s) and/or folder(s) to send to the Receiver"
     )
+    parser.add_argument(
+        "-b", "--batch", action="store_true",
+        help="Send the whole manifest first and stream the wanted files without per-file round trips"
+    )
+    parser.add_argument(
+        "-k", "--pack", nargs="?", type=int, const=DEFAULT_PACK_THRESHOLD, default=0,
+        help=f"Pack files up to this many bytes into bundle frames, {DEFAULT_PACK_THRESHOLD} if no size is given"
+    )
+    parser.add_argument(
+        "-n", "--stripes", type=int, default=1,
+        help="Split large files into ranges sent in parallel over this many connections"
+    )
+    parser.add_argument(
+        "--stripe-size", type=int, default=DEFAULT_STRIPE_SIZE,
+        help=f"Size of each range of a striped file, {DEFAULT_STRIPE_SIZE} if not provided"
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=1,
+        help="Send this many whole files at the same time, each over its own connection"
+    )
+    parser.add_argument(
+        "-o", "--order", choices=sorted(scheduler.ORDERINGS), default="manifest",
+        help="Order concurrent files start in: largest first, smallest first or manifest order"
+    )
+    parser.add_argument(
+        "-d", "--delta", action="store_true",
+        help="Send only the changed blocks of files the Receiver already has (rsync-style delta)"
+    )
+    parser.add_argument(
+        "-z", "--compress", nargs="?", const="auto", choices=["auto"] + list(compress.CODECS),
+        help="Compress files that shrink with this codec, the best one both ends support if not provided"
+    )
+    parser.add_argument(
+        "-v", "--verify", nargs="?", const="auto", choices=["auto"] + list(integrity.HASHES),
+        help="Check every file with a digest computed as it streams and send it again if it does not match, "
+             "the best hash both ends support if not provided"
+    )
+    parser.add_argument(
+        "--scan-threads", type=int, default=1,
+        help="List this many directories at the same time while scanning (helps on network filesystems)"
+    )
+    parser.add_argument(
+        "-i", "--index", nargs="?", const=sync_index.DEFAULT_INDEX_FILE,
+        help=f"Remember what the Receiver holds in this SQLite file and only offer new or changed files, "
+             f"{sync_index.DEFAULT_INDEX_FILE} if no path is given"
+    )
+    parser.add_argument(
+        "--index-hash", action="store_true",
+        help="Also record a content digest in the index so files that were only touched are not resent"
+    )
+    parser.add_argument(
+        "-w", "--watch", type=float, default=0, metavar="SECONDS",
+        help="Keep the connection open and send new or changed files every SECONDS (uses the index)"
+    )
+    parser.add_argument(
+        "--log-level", choices=list(util.LOG_LEVELS), default=util.LOG_LEVEL,
+        help=f"Least important messages written to {util.LOG_FILE}"
+    )
+    parser.add_argument(
+        "--rate", type=int, default=0, metavar="BYTES",
+        help="Bytes per second sent over all connections, unlimited if not provided"
+    )
+    parser.add_argument(
+        "--limits", metavar="FILE",
+        help="JSON file with the rate, re-read when it changes or on SIGHUP"
+    )
+    parser.add_argument(
+        "--socket-buffer", type=int, default=tuning.SOCKET_BUFFER, metavar="BYTES",
+        help="Send and receive buffer of every connection (about bandwidth x round trip on long fat networks), "
+             "kernel autotuning if not provided"
+    )
+    parser.add_argument(
+        "--notsent-lowat", type=int, default=tuning.NOTSENT_LOWAT, metavar="BYTES",
+        help="Unsent bytes a connection may queue in the kernel (TCP_NOTSENT_LOWAT, Linux and macOS)"
+    )
+    parser.add_argument(
+        "--max-lag", type=int, default=fanout.DEFAULT_MAX_LAG, metavar="BYTES",
+        help=f"With several receivers, bytes a receiver may fall behind the fastest one and still share its "
+             f"reads (it reads from disk itself beyond that), {fanout.DEFAULT_MAX_LAG} if not provided"
+    )
+    parser.add_argument(
+        "--stats", metavar="FILE",
+        help="Append per-file records and periodic session metrics to this JSON-lines file"
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=10,
+        help="Seconds between metrics snapshots in the stats file, 10 if not provided"
+    )
 
     args = parser.parse_args()
-    ip_address = args.address
-
-    if not len(IP_REGEX.findall(ip_address)) == 1 or not check_if_ip_valid(ip_address):
-        sys.exit(f"Invalid IP address {ip_address}")
 
     port_number = args.port
     if not len(util.PORT_REGEX.findall(port_number)) == 1 or not util.check_if_port_valid(int(port_number)):
         sys.exit(f"Invalid port number {port_number}")
 
+    # Every receiver, -p is the port of those given without one
+    targets = []
+    for address in args.address:
+        ip_address, _, target_port = address.partition(":")
+        if not len(IP_REGEX.findall(ip_address)) == 1 or not check_if_ip_valid(ip_address):
+            sys.exit(f"Invalid IP address {ip_address}")
+        target_port = target_port or port_number
+        if not len(util.PORT_REGEX.findall(target_port)) == 1 or not util.check_if_port_valid(int(target_port)):
+            sys.exit(f"Invalid port number {target_port}")
+        targets.append((ip_address, int(target_port)))
+
+    # Several receivers walk one shared manifest file by file
+    if len(targets) > 1:
+        unsupported = [name for name, used in (
+            ("--batch", args.batch), ("--pack", args.pack), ("--stripes", args.stripes > 1),
+            ("--concurrency", args.concurrency > 1), ("--compress", args.compress), ("--index", args.index),
+            ("--index-hash", args.index_hash), ("--watch", args.watch > 0)
+        ) if used]
+        if unsupported:
+            sys.exit(f"{', '.join(unsupported)} cannot be used with several receivers")
+
+    # Codecs offered to the receiver, in order of preference
+    codecs = []
+    if args.compress == "auto":
+        codecs = list(compress.CODECS)
+    elif args.compress:
+        codecs = [args.compress]
+
+    # Hashes offered to the receiver, in order of preference
+    hashes = []
+    if args.verify == "auto":
+        hashes = list(integrity.HASHES)
+    elif args.verify:
+        hashes = [args.verify]
+
     return {
-        "address": ip_address,
-        "port": int(port_number),
-        "files": args.files
+        "address": targets[0][0],
+        "port": targets[0][1],
+        "targets": targets,
+        "files": args.files,
+        "batch": args.batch,
+        "pack": max(0, args.pack),
+        "stripes": max(1, args.stripes),
+        "stripe_size": max(1, args.stripe_size),
+        "concurrency": max(1, args.concurrency),
+        "order": args.order,
+        "delta": args.delta,
+        "compress": codecs,
+        "verify": hashes,
+        "scan_threads": max(1, args.scan_threads),
+        # Watching compares each scan with the index
+        "index": args.index or (sync_index.DEFAULT_INDEX_FILE if args.watch > 0 or args.index_hash else None),
+        "index_hash": args.index_hash,
+        "watch": max(0.0, args.watch),
+        "log_level": args.log_level,
+        "stats": args.stats,
+        "stats_interval": max(0.1, args.stats_interval),
+        "rate": max(0, args.rate),
+        "limits": args.limits,
+        "max_lag": max(0, args.max_lag),
+        "socket_buffer": max(0, args.socket_buffer),
+        "notsent_lowat": max(0, args.notsent_lowat)
     }
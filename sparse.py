@@ -0,0 +1,105 @@
+"""
+Sparse files - only the data extents travel, holes are recreated
+https://wingxel.github.io/website/index.html
+
+The Sender asks the filesystem where the data is (lseek SEEK_DATA and
+SEEK_HOLE) and sends the extent map followed by the extents only. The
+Receiver writes each extent at its offset and sets the final length, the
+bytes in between are never written so they stay holes.
+"""
+
+import errno
+import os
+
+import protocol
+
+# lseek errors meaning the filesystem cannot report holes
+SEEK_UNSUPPORTED = {errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS}
+
+
+def has_holes(stat_result: os.stat_result) -> bool:
+    """
+    If a file uses fewer blocks than its size, cheap test before looking for holes
+    :param stat_result: os.stat of the file
+    :return:
+    """
+    blocks = getattr(stat_result, "st_blocks", None)
+    return hasattr(os, "SEEK_DATA") and blocks is not None and blocks * 512 < stat_result.st_size
+
+
+def data_extents(fd: int, offset: int, count: int):
+    """
+    Data extents of part of a file
+    :param fd: File descriptor opened for reading
+    :param offset: Position of the first byte
+    :param count: Number of bytes
+    :return: [(file offset, length), ...] in file order, None if the part holds
+             no hole, the filesystem cannot tell or there are too many extents
+    """
+    end, position, extents = offset + count, offset, []
+    try:
+        while position < end:
+            try:
+                start = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as error:
+                # No data after position, the rest is one hole
+                if error.errno == errno.ENXIO:
+                    break
+                raise
+            if start >= end:
+                break
+            stop = min(os.lseek(fd, start, os.SEEK_HOLE), end)
+            extents.append((start, stop - start))
+            if len(extents) > protocol.MAX_EXTENTS:
+                return None
+            position = stop
+    except OSError as error:
+        if error.errno in SEEK_UNSUPPORTED:
+            return None
+        raise
+    if extents == [(offset, count)]:
+        return None
+    return extents
+
+
+def check_extents(extents: list, offset: int, end: int) -> int:
+    """
+    Check that announced extents are in order, do not overlap and stay in a range
+    :param extents: (file offset, length) of every data extent
+    :param offset: First byte of the range
+    :param end: End of the range
+    :return: Number of data bytes
+    """
+    position = offset
+    for start, length in extents:
+        if start < position or length == 0 or start + length > end:
+            raise protocol.ProtocolError(f"Invalid data extent ({start}, {length})")
+        position = start + length
+    return sum(length for _, length in extents)
+
+
+class ExtentWriter:
+    def __init__(self, fd: int, extents: list) -> None:
+        """
+        Write the concatenated extent content at the extent offsets, called
+        with the received chunks in order
+        :param fd: Destination file descriptor
+        :param extents: (file offset, length) of every data extent in file order
+        """
+        self.fd, self.extents = fd, extents
+        self.index, self.done = 0, 0
+
+    def __call__(self, data) -> None:
+        """
+        Write the next chunk, possibly spanning several extents
+        :param data: Bytes-like chunk
+        :return:
+        """
+        view = memoryview(data)
+        while len(view):
+            start, length = self.extents[self.index]
+            size = min(len(view), length - self.done)
+            written = os.pwrite(self.fd, view[:size], start + self.done)
+            view, self.done = view[written:], self.done + written
+            if self.done == length:
+                self.index, self.done = self.index + 1, 0
@@ -0,0 +1,129 @@
+"""
+Persistent record of what each receiver already holds, so repeated runs
+against the same folders only offer new or changed files
+https://wingxel.github.io/website/index.html
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+import util
+
+# Index used when --index is given without a path, next to the log file
+DEFAULT_INDEX_FILE = os.sep.join([util.LOG_FILE_LOCATION, "sync_index.sqlite3"])
+# Records written per transaction
+COMMIT_EVERY = 1000
+
+
+class SyncIndex:
+    def __init__(self, index_file: str = DEFAULT_INDEX_FILE, hashing: bool = False) -> None:
+        """
+        Open (or create) the index
+        :param index_file: SQLite database path
+        :param hashing: Also record a content digest so files that were only touched are not resent
+        """
+        folder = os.path.dirname(index_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.hashing = hashing
+        # Concurrent send workers record through the same connection
+        self.__lock = Lock()
+        self.__pending = 0
+        self.__database = sqlite3.connect(index_file, check_same_thread=False)
+        self.__database.execute(
+            "CREATE TABLE IF NOT EXISTS held ("
+            "receiver TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+            "digest BLOB, PRIMARY KEY (receiver, name))"
+        )
+        self.__database.commit()
+
+    @staticmethod
+    def key(metadata: dict) -> str:
+        """
+        Index key of a file description, its path relative to the sent item
+        :param metadata: File information
+        :return:
+        """
+        return "/".join(metadata["name"])
+
+    def digest(self, metadata: dict, filename: str) -> bytes:
+        """
+        Content digest of a file, computed once per description
+        :param metadata: File information, the digest is cached in it
+        :param filename: File absolute path
+        :return:
+        """
+        if "digest" not in metadata:
+            metadata["digest"] = util.prefix_digest(filename, metadata["size"])
+        return metadata["digest"]
+
+    def changed(self, receiver: str, manifest):
+        """
+        Drop the files the receiver is known to hold in the same version
+        :param receiver: Receiver key (address:port)
+        :param manifest: Iterable of (metadata, absolute file path)
+        :return: Generator of the new or changed (metadata, absolute file path)
+        """
+        unchanged = 0
+        for metadata, filename in manifest:
+            with self.__lock:
+                row = self.__database.execute(
+                    "SELECT size, mtime, digest FROM held WHERE receiver = ? AND name = ?",
+                    (receiver, self.key(metadata))
+                ).fetchone()
+            if row is not None and row[0] == metadata["size"]:
+                if row[1] == metadata["mtime"]:
+                    unchanged += 1
+                    continue
+                # Same size, new mtime: only the content digest can tell
+                if self.hashing and row[2] is not None and row[2] == self.digest(metadata, filename):
+                    self.record(receiver, metadata, filename)
+                    unchanged += 1
+                    continue
+            # The receiver held an older version, declining this one does not mean it has it
+            metadata["stale"] = row is not None
+            yield metadata, filename
+        if unchanged:
+            print(f"{datetime.now()} : {unchanged} unchanged files skipped (sync index)")
+
+    def record(self, receiver: str, metadata: dict, filename: str) -> None:
+        """
+        Remember that the receiver holds a file in this version
+        :param receiver: Receiver key (address:port)
+        :param metadata: File information, "skipped" if the receiver declined it
+                         and "stale" if the index held an older version
+        :param filename: File absolute path
+        :return:
+        """
+        if metadata.get("skipped") and metadata.get("stale"):
+            # Declined because of the older version, keep offering it (-d updates it)
+            return
+        digest = self.digest(metadata, filename) if self.hashing else None
+        with self.__lock:
+            self.__database.execute(
+                "INSERT OR REPLACE INTO held (receiver, name, size, mtime, digest) VALUES (?, ?, ?, ?, ?)",
+                (receiver, self.key(metadata), metadata["size"], metadata["mtime"], digest)
+            )
+            self.__pending += 1
+            if self.__pending >= COMMIT_EVERY:
+                self.__database.commit()
+                self.__pending = 0
+
+    def commit(self) -> None:
+        """
+        Write pending records to disk
+        :return:
+        """
+        with self.__lock:
+            self.__database.commit()
+            self.__pending = 0
+
+    def close(self) -> None:
+        """
+        Commit and close the index
+        :return:
+        """
+        self.commit()
+        self.__database.close()
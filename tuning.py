@@ -0,0 +1,138 @@
+"""
+Socket tuning shared by Sender and Receiver
+https://wingxel.github.io/website/index.html
+
+Every connection gets Nagle disabled (control frames go out at once
+instead of waiting for the acknowledgement of the previous segment),
+optionally fixed socket buffers for long fat networks and a low unsent-data
+watermark. Copies through user space use a chunk size that follows the
+measured throughput and round-trip time of the connection.
+"""
+
+import os
+import socket
+import struct
+import sys
+
+import util
+
+# Send and receive buffer of every socket, 0 keeps the kernel autotuning
+SOCKET_BUFFER = 0
+# Unsent bytes a socket may queue before it stops being writable, 0 keeps the kernel default
+NOTSENT_LOWAT = 0
+# Not exported by every Python build, the Linux value is stable
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT", 25 if sys.platform.startswith("linux") else None)
+# Smoothed round-trip time (microseconds) inside the Linux struct tcp_info
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+# Adaptive chunks: bytes moved in about CHUNK_SECONDS, and at least one round trip worth
+CHUNK_SECONDS = 0.05
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# Weight of the newest throughput sample
+RATE_WEIGHT = 0.3
+
+
+def set_buffers(connection_socket: socket.socket) -> None:
+    """
+    Apply SOCKET_BUFFER, before connect or listen so the window scale is negotiated for it
+    :param connection_socket: Socket to tune
+    :return:
+    """
+    if not SOCKET_BUFFER:
+        return
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        connection_socket.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        # The kernel caps the size (net.core.wmem_max and rmem_max on Linux)
+        granted = connection_socket.getsockopt(socket.SOL_SOCKET, option)
+        if granted < SOCKET_BUFFER:
+            util.log_error(f"Socket buffer capped at {granted} of {SOCKET_BUFFER} bytes", "warning")
+
+
+def tune_listener(server_socket: socket.socket) -> None:
+    """
+    Tune a listening socket before bind, accepted connections inherit its buffers
+    :param server_socket: Listening socket
+    :return:
+    """
+    try:
+        if os.name != "nt":
+            # A restarted receiver can listen again while old connections are in TIME_WAIT
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_buffers(server_socket)
+    except OSError as error:
+        util.log_error(f"Cannot tune listening socket : {str(error)}")
+
+
+def tune_connection(connection_socket, buffers: bool = True) -> None:
+    """
+    Tune a connection, tuning that fails leaves the defaults
+    :param connection_socket: Connected (or about to connect) socket
+    :param buffers: Apply SOCKET_BUFFER too, accepted connections already have the listener's
+    :return:
+    """
+    try:
+        connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if NOTSENT_LOWAT and TCP_NOTSENT_LOWAT is not None:
+            connection_socket.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+        if buffers:
+            set_buffers(connection_socket)
+    except OSError as error:
+        util.log_error(f"Cannot tune connection : {str(error)}")
+
+
+def round_trip_time(connection_socket: socket.socket):
+    """
+    Smoothed round-trip time the kernel measured for a connection
+    :param connection_socket: Connected socket
+    :return: Seconds, None where TCP_INFO is not available
+    """
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = connection_socket.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size
+        )
+    except OSError:
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return None
+    return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1e6
+
+
+class ChunkSizer:
+    def __init__(self, initial: int, minimum: int = MIN_CHUNK, maximum: int = MAX_CHUNK) -> None:
+        """
+        Chunk size following the throughput of a connection: small chunks on
+        slow links keep data flowing (and throttling smooth), large ones on
+        fast links save system calls
+        :param initial: Size used until the first measurement
+        :param minimum: Smallest size
+        :param maximum: Largest size
+        """
+        self.minimum, self.maximum = minimum, max(minimum, maximum)
+        self.size = min(max(initial, self.minimum), self.maximum)
+        self.rate, self.rtt = 0.0, 0.0
+
+    def measure_rtt(self, connection_socket: socket.socket) -> None:
+        """
+        Take the round-trip time of the connection into account
+        :param connection_socket: Connected socket
+        :return:
+        """
+        self.rtt = round_trip_time(connection_socket) or 0.0
+
+    def record(self, amount: int, seconds: float) -> None:
+        """
+        Account for a chunk that took some time to move and resize the next ones
+        :param amount: Bytes moved
+        :param seconds: Time it took
+        :return:
+        """
+        if seconds <= 0:
+            return
+        rate = amount / seconds
+        self.rate = rate if not self.rate else (1 - RATE_WEIGHT) * self.rate + RATE_WEIGHT * rate
+        target = self.rate * max(CHUNK_SECONDS, self.rtt)
+        # Whole multiples of the smallest size keep the chunks page aligned
+        self.size = int(min(max(target // self.minimum * self.minimum, self.minimum), self.maximum))
@@ -3,10 +3,14 @@ Common utility functions
 https://wingxel.github.io/website/index.html
 """
 
+import atexit
+import hashlib
 import os
 import re
 from datetime import datetime
 from pathlib import Path
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
 
 # Folder where the log file is at
 LOG_FILE_LOCATION = os.sep.join([str(Path.home()), ".FileSharePY3_Log"])
@@ -16,6 +20,20 @@ LOG_FILE = os.sep.join([LOG_FILE_LOCATION, "log_data.log"])
 # If the receiver is busy
 receiving = True
 
+# Log levels, messages below LOG_LEVEL are dropped before being queued
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL = "info"
+# Messages waiting for the log writer, callers never wait when it is full
+LOG_QUEUE_SIZE = 10000
+# Messages written per flush
+LOG_BATCH = 512
+# The log file is rotated past this size, keeping LOG_BACKUPS older files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+# Process wide log writer, see get_logger
+logger = None
+logger_lock = Lock()
+
 # Port number regex
 PORT_REGEX = re.compile(r"^\d{4,5}$")
 
@@ -29,21 +47,160 @@ def check_if_port_valid(port_number: int) -> bool:
     return 1025 <= port_number < 65536
 
 
-def log_error(what_to_log: str) -> None:
+class QueuedLogger:
+    def __init__(self, log_file: str) -> None:
+        """
+        Log file written by a single background thread, messages are queued
+        and written in batches so callers never wait on log I/O
+        :param log_file: Log file absolute path
+        """
+        self.log_file = log_file
+        self.dropped = 0
+        self.__queue = Queue(maxsize=LOG_QUEUE_SIZE)
+        self.__writer = Thread(target=self.__write, name="logger", daemon=True)
+        self.__writer.start()
+
+    def log(self, message: str, level: str) -> None:
+        """
+        Queue a message
+        :param message: Log message
+        :param level: Key of LOG_LEVELS
+        :return:
+        """
+        try:
+            self.__queue.put_nowait(f"{datetime.now()} : {level.upper()} : {message}\n")
+        except Full:
+            # Losing a log line is better than stalling a transfer
+            self.dropped += 1
+
+    def __open(self):
+        """
+        Open the log file for appending, creating its folder if needed
+        :return: File object or None if the log cannot be written
+        """
+        try:
+            os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+            return open(self.log_file, "a")
+        except OSError as error:
+            print(f"Error setting the logs {str(error)}")
+            return None
+
+    def __rotate(self, logger_file):
+        """
+        Shift the log file to .1, .2, ... and start a new one
+        :param logger_file: Current log file object
+        :return: New log file object
+        """
+        logger_file.close()
+        for index in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.log_file}.{index}"):
+                os.replace(f"{self.log_file}.{index}", f"{self.log_file}.{index + 1}")
+        os.replace(self.log_file, f"{self.log_file}.1")
+        return self.__open()
+
+    def __write(self) -> None:
+        """
+        Writer thread: wait for a message, then write it with everything else
+        queued in one go
+        :return:
+        """
+        logger_file = None
+        while True:
+            lines = [self.__queue.get()]
+            while len(lines) < LOG_BATCH:
+                try:
+                    lines.append(self.__queue.get_nowait())
+                except Empty:
+                    break
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if self.dropped:
+                lines.append(f"{datetime.now()} : WARNING : {self.dropped} log messages dropped\n")
+                self.dropped = 0
+            if lines and logger_file is None:
+                logger_file = self.__open()
+            if logger_file is not None and lines:
+                try:
+                    logger_file.writelines(lines)
+                    logger_file.flush()
+                    if logger_file.tell() >= LOG_MAX_BYTES:
+                        logger_file = self.__rotate(logger_file)
+                except OSError as error:
+                    print(f"Error writing the logs {str(error)}")
+            if stop:
+                if logger_file is not None:
+                    logger_file.close()
+                return
+
+    def close(self) -> None:
+        """
+        Write what is queued and stop the writer
+        :return:
+        """
+        if self.__writer.is_alive():
+            self.__queue.put(None)
+            self.__writer.join(timeout=5)
+
+
+def get_logger() -> QueuedLogger:
+    """
+    The process wide log writer, started on first use
+    :return:
+    """
+    global logger
+    with logger_lock:
+        if logger is None:
+            logger = QueuedLogger(LOG_FILE)
+            atexit.register(logger.close)
+        return logger
+
+
+def log_error(what_to_log: str, level: str = "error") -> None:
     """
     Write log
     :param what_to_log: Log message
+    :param level: Key of LOG_LEVELS
     :return:
     """
-    if not os.path.exists(LOG_FILE_LOCATION):
-        try:
-            os.mkdir(LOG_FILE_LOCATION)
-        except Exception as error:
-            print(f"Error setting the logs {str(error)}")
-            return
-    else:
-        with open(LOG_FILE, "a") as logger:
-            print(f"{datetime.now()} : {what_to_log}", file=logger)
+    if LOG_LEVELS[level] >= LOG_LEVELS[LOG_LEVEL]:
+        get_logger().log(what_to_log, level)
+
+
+def log_info(what_to_log: str) -> None:
+    """
+    Write an informational log message
+    :param what_to_log: Log message
+    :return:
+    """
+    log_error(what_to_log, "info")
+
+
+def log_debug(what_to_log: str) -> None:
+    """
+    Write a debug log message, dropped unless LOG_LEVEL is debug
+    :param what_to_log: Log message
+    :return:
+    """
+    log_error(what_to_log, "debug")
+
+
+def prefix_digest(filename: str, length: int) -> bytes:
+    """
+    BLAKE2b digest of the first length bytes of a file
+    :param filename: file absolute path
+    :param length: number of bytes to hash
+    :return:
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    buffer = memoryview(bytearray(1024 * 1024))
+    with open(filename, "rb", buffering=0) as the_file:
+        while length > 0:
+            size = the_file.readinto(buffer[:min(length, len(buffer))])
+            if not size:
+                break
+            digest.update(buffer[:size])
+            length -= size
+    return digest.digest()
 
 
 def get_dir_size(the_folder: str) -> int: